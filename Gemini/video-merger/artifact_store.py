@@ -0,0 +1,174 @@
+import os
+import hmac
+import json
+import time
+import shutil
+import hashlib
+import secrets
+import threading
+
+from observability import log
+
+# Root directory of the object store. Both services point at the same
+# directory when they share a host.
+ARTIFACT_STORE_DIR = os.environ.get("ARTIFACT_STORE_DIR", "/tmp/artifacts")
+# Secret used to sign artifact URLs. When unset, a key is generated once and
+# kept in the store directory, so every process on the host agrees on it.
+ARTIFACT_SIGNING_KEY = os.environ.get("ARTIFACT_SIGNING_KEY")
+# How long a published URL stays valid (clients download from the email link).
+ARTIFACT_URL_TTL = int(os.environ.get("ARTIFACT_URL_TTL", 7 * 24 * 3600))
+# Retention policy: artifacts older than this, or beyond the byte budget
+# (oldest first), are garbage-collected.
+ARTIFACT_RETENTION = int(os.environ.get("ARTIFACT_RETENTION", 14 * 24 * 3600))
+ARTIFACT_MAX_BYTES = int(os.environ.get("ARTIFACT_MAX_BYTES", 10 * 1024 * 1024 * 1024))
+ARTIFACT_GC_INTERVAL = int(os.environ.get("ARTIFACT_GC_INTERVAL", 3600))
+
+
+class ArtifactStore:
+    """
+    A local filesystem object store. Objects are addressed by the SHA-256 of
+    their content, written once, and handed out as signed, expiring URLs:
+
+        <base_url>/artifacts/<artifact_id>?expires=<unix time>&sig=<hmac>
+
+    Each object has a small JSON sidecar with its content type, size and
+    creation time.
+    """
+
+    def __init__(self, directory=ARTIFACT_STORE_DIR, signing_key=ARTIFACT_SIGNING_KEY):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._key = (signing_key or self._load_or_create_key()).encode("utf-8")
+        self._gc_thread = None
+
+    def _load_or_create_key(self):
+        key_path = os.path.join(self.directory, ".signing_key")
+        try:
+            fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(key_path) as f:
+                return f.read().strip()
+        with os.fdopen(fd, "w") as f:
+            key = secrets.token_hex(32)
+            f.write(key)
+        return key
+
+    def _object_path(self, artifact_id):
+        if len(artifact_id) != 64 or not all(c in "0123456789abcdef" for c in artifact_id):
+            raise ValueError("Invalid artifact ID.")
+        return os.path.join(self.directory, artifact_id[:2], artifact_id)
+
+    def put_file(self, src_path, content_type="application/octet-stream", move=True):
+        """
+        Adds a file to the store and returns its artifact ID. The file is
+        moved (or copied) in place, never read into memory. Storing the same
+        content twice returns the same ID and keeps a single copy.
+        """
+        digest = hashlib.sha256()
+        with open(src_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        artifact_id = digest.hexdigest()
+        path = self._object_path(artifact_id)
+
+        if os.path.exists(path):
+            os.utime(path) # restart the retention clock
+            if move:
+                os.remove(src_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if move:
+                shutil.move(src_path, path)
+            else:
+                shutil.copyfile(src_path, path)
+        with open(path + ".json", "w") as f:
+            json.dump({
+                "content_type": content_type,
+                "size": os.path.getsize(path),
+                "created_at": time.time(),
+            }, f)
+        return artifact_id
+
+    def open_object(self, artifact_id):
+        """Returns (path, metadata) for an artifact, or (None, None) if unknown."""
+        try:
+            path = self._object_path(artifact_id)
+            with open(path + ".json") as f:
+                metadata = json.load(f)
+        except (ValueError, OSError):
+            return None, None
+        if not os.path.exists(path):
+            return None, None
+        return path, metadata
+
+    def _signature(self, artifact_id, expires):
+        message = f"{artifact_id}:{expires}".encode("utf-8")
+        return hmac.new(self._key, message, hashlib.sha256).hexdigest()
+
+    def signed_url(self, base_url, artifact_id, ttl=ARTIFACT_URL_TTL):
+        expires = int(time.time() + ttl)
+        return f"{base_url.rstrip('/')}/artifacts/{artifact_id}?expires={expires}&sig={self._signature(artifact_id, expires)}"
+
+    def verify(self, artifact_id, expires, signature):
+        """Checks a URL signature and its expiry."""
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._signature(artifact_id, expires), signature or "")
+
+    def gc(self, retention=ARTIFACT_RETENTION, max_bytes=ARTIFACT_MAX_BYTES):
+        """
+        Deletes artifacts older than `retention` seconds, then the oldest ones
+        until the store fits in `max_bytes`. Returns the number removed.
+        """
+        now = time.time()
+        entries, total, removed = [], 0, 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if len(name) != 64:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > retention:
+                    removed += self._delete(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            removed += self._delete(path)
+            total -= size
+        return removed
+
+    def _delete(self, path):
+        for victim in (path, path + ".json"):
+            try:
+                os.remove(victim)
+            except OSError:
+                pass
+        return 1
+
+    def start_gc(self, interval=ARTIFACT_GC_INTERVAL):
+        """Runs gc() every `interval` seconds in a daemon thread."""
+        if self._gc_thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.gc()
+                    if removed:
+                        log("info", f"Artifact GC removed {removed} object(s).")
+                except Exception as e:
+                    log("error", "Artifact GC failed.", error=str(e))
+
+        self._gc_thread = threading.Thread(target=loop, name="artifact-gc", daemon=True)
+        self._gc_thread.start()
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from observability import log
+
+# Disk cache for downloaded inputs (images, audio), keyed by URL.
+ASSET_CACHE_DIR = os.environ.get("ASSET_CACHE_DIR", "/tmp/merger-assets")
+ASSET_CACHE_MAX_BYTES = int(os.environ.get("ASSET_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# How long a cached asset without validators (ETag/Last-Modified) is reused
+# without asking the origin again.
+ASSET_CACHE_FRESH_SECONDS = int(os.environ.get("ASSET_CACHE_FRESH_SECONDS", 3600))
+# Download chunk sizes: start small, grow for large bodies.
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def chunk_size_for(content_length):
+    """Picks a chunk size of roughly 1/16th of the body, within the min/max bounds."""
+    if not content_length:
+        return MIN_CHUNK_SIZE
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, int(content_length) // 16))
+
+
+class AssetCache:
+    """
+    Downloads merge inputs in parallel into a disk cache keyed by URL.
+
+    A cached asset is revalidated with If-None-Match / If-Modified-Since when
+    the origin gave us validators, so an unchanged brand background costs a
+    304 at most; assets without validators are reused for
+    ASSET_CACHE_FRESH_SECONDS. The cache is kept under a byte budget by
+    evicting the least recently used files, except those pinned by a merge
+    still using them (see using()).
+    """
+
+    def __init__(self, session, timeout, directory=ASSET_CACHE_DIR, max_bytes=ASSET_CACHE_MAX_BYTES,
+                 fresh_seconds=ASSET_CACHE_FRESH_SECONDS):
+        self.session = session
+        self.timeout = timeout
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self._locks = [threading.Lock() for _ in range(64)] # striped per-URL locks
+        self._pins = {} # data path -> merges using it
+        self._pin_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="asset-fetch")
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + ".bin", base + ".json"
+
+    def _lock_for(self, url):
+        return self._locks[hash(url) % len(self._locks)]
+
+    def _pin(self, path):
+        with self._pin_lock:
+            self._pins[path] = self._pins.get(path, 0) + 1
+
+    def release(self, path):
+        """Unpins a path returned by fetch(), letting eviction remove it again."""
+        with self._pin_lock:
+            count = self._pins.pop(path, 0) - 1
+            if count > 0:
+                self._pins[path] = count
+
+    def fetch(self, url):
+        """
+        Returns (path, stats) for the asset at url, downloading it only when
+        the cached copy is missing or stale. stats holds the url, bytes
+        transferred, seconds spent and whether the cache was used. The path
+        stays pinned, safe from eviction, until release(path).
+        """
+        data_path, meta_path = self._paths(url)
+        start = time.monotonic()
+        # Pinned before looking at the cache, so an eviction running now
+        # either removes the file first (and it is downloaded again) or keeps it
+        self._pin(data_path)
+        try:
+            result = self._fetch(url, data_path, meta_path, start)
+        except BaseException:
+            self.release(data_path)
+            raise
+        if result[1]["cache"] == "miss":
+            self._evict()
+        return result
+
+    def _fetch(self, url, data_path, meta_path, start):
+        with self._lock_for(url): # one download per URL at a time
+            meta = None
+            if os.path.exists(data_path) and os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+
+            if meta and not meta.get("etag") and not meta.get("last_modified") \
+                    and time.time() - meta["fetched_at"] < self.fresh_seconds:
+                return self._hit(data_path, url, start, "fresh")
+
+            headers = {}
+            if meta and meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta and meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+            with self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as r:
+                if r.status_code == 304 and meta:
+                    return self._hit(data_path, url, start, "revalidated")
+                r.raise_for_status()
+                chunk_size = chunk_size_for(r.headers.get("Content-Length"))
+                partial_path = f"{data_path}.{threading.get_ident()}.partial"
+                size = 0
+                try:
+                    with open(partial_path, "wb") as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            size += len(chunk)
+                    os.replace(partial_path, data_path)
+                    # The metadata is replaced atomically too, so a crash never
+                    # leaves a truncated file that fails every later fetch
+                    with open(partial_path, "w") as f:
+                        json.dump({
+                            "url": url,
+                            "etag": r.headers.get("ETag"),
+                            "last_modified": r.headers.get("Last-Modified"),
+                            "fetched_at": time.time(),
+                        }, f)
+                    os.replace(partial_path, meta_path)
+                finally:
+                    if os.path.exists(partial_path):
+                        os.remove(partial_path)
+
+        return data_path, {"url": url, "bytes": size, "seconds": round(time.monotonic() - start, 3), "cache": "miss"}
+
+    def fetch_all(self, urls):
+        """
+        Fetches several assets concurrently. Returns [(path, stats), ...] in
+        order, every path pinned until released; if one fetch fails, the
+        others are released and its error raised.
+        """
+        futures = [self._executor.submit(self.fetch, url) for url in urls]
+        results, error = [], None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except BaseException as e:
+                error = error or e
+        if error is not None:
+            for path, _ in results:
+                self.release(path)
+            raise error
+        return results
+
+    @contextmanager
+    def using(self, urls):
+        """Fetches the assets (see fetch_all) and keeps them from eviction for the duration of the block."""
+        results = self.fetch_all(urls)
+        try:
+            yield results
+        finally:
+            for path, _ in results:
+                self.release(path)
+
+    def _hit(self, data_path, url, start, how):
+        os.utime(data_path) # mark as recently used
+        return data_path, {"url": url, "bytes": 0, "seconds": round(time.monotonic() - start, 3), "cache": how}
+
+    def _evict(self):
+        with self._evict_lock: # one pass at a time; concurrent ones would evict twice as much
+            entries, total = [], 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(".bin"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # Checked and removed under the pin lock, so a fetch cannot pin
+                # the file in between
+                with self._pin_lock:
+                    if path in self._pins:
+                        continue
+                    for victim in (path, path[:-len(".bin")] + ".json"):
+                        try:
+                            os.remove(victim)
+                        except OSError:
+                            pass
+                total -= size
+                log("info", "Evicted cached asset.", path=path)
+
+
+def log_fetch_stats(stats):
+    for s in stats:
+        log("info", "Asset fetched.", url=s['url'], cache=s['cache'], bytes=s['bytes'], seconds=s['seconds'])
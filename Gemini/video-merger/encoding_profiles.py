@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import hashlib
+import resource
+
+# Profile used when a /merge request does not name one. "still" and
+# "still-reuse" encode much faster at a lower resolution and frame rate, so
+# they are opt-in: set them here or per request.
+MERGE_PROFILE = os.environ.get("MERGE_PROFILE", "default")
+# Where pre-encoded video tracks are kept for profiles with reuse_video.
+SEGMENT_CACHE_DIR = os.environ.get("SEGMENT_CACHE_DIR", "/tmp/merger-segments")
+# Tracks unused for SEGMENT_CACHE_MAX_AGE seconds are deleted, then the least
+# recently used ones until the cache fits in SEGMENT_CACHE_MAX_BYTES.
+SEGMENT_CACHE_MAX_BYTES = int(os.environ.get("SEGMENT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+SEGMENT_CACHE_MAX_AGE = int(os.environ.get("SEGMENT_CACHE_MAX_AGE", 7 * 24 * 3600))
+
+# Encoding settings per profile:
+#   framerate    - frames per second of the output (None keeps FFmpeg's 25)
+#   scale        - scale filter applied to the image before encoding
+#   preset/crf   - libx264 speed/quality trade-off (None keeps the defaults)
+#   tune         - libx264 tuning; "stillimage" suits a picture that never changes
+#   reuse_video  - encode a short video track once per image and loop it with
+#                  stream copy for any audio length, instead of re-encoding
+#   segment_seconds - length of that reusable track
+PROFILES = {
+    # The original settings: full resolution at 25 fps.
+    "default": {
+        "framerate": None, "scale": None, "preset": None, "crf": None, "tune": None,
+        "reuse_video": False,
+    },
+    # Fast path for a static image: few frames, pre-scaled, tuned for stills.
+    "still": {
+        "framerate": 2, "scale": "1280:-2", "preset": "veryfast", "crf": 28, "tune": "stillimage",
+        "reuse_video": False,
+    },
+    # Same as "still", but the video track is encoded once per image and reused.
+    "still-reuse": {
+        "framerate": 2, "scale": "1280:-2", "preset": "veryfast", "crf": 28, "tune": "stillimage",
+        "reuse_video": True, "segment_seconds": 10,
+    },
+}
+
+
+def get_profile(name=None):
+    """ Returns the settings of a profile, raising ValueError for unknown names. """
+    name = name or MERGE_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown encoding profile '{name}'. Available: {', '.join(sorted(PROFILES))}")
+    return PROFILES[name]
+
+
+def _video_args(profile):
+    args = []
+    filters = []
+    if profile["scale"]:
+        filters.append(f"scale={profile['scale']}")
+    filters.append("format=yuv420p")
+    args += ["-vf", ",".join(filters), "-c:v", "libx264"]
+    if profile["tune"]:
+        args += ["-tune", profile["tune"]]
+    if profile["preset"]:
+        args += ["-preset", profile["preset"]]
+    if profile["crf"] is not None:
+        args += ["-crf", str(profile["crf"])]
+    if profile["framerate"]:
+        # One keyframe per second keeps stream-copied cuts close to the audio end
+        args += ["-r", str(profile["framerate"]), "-g", str(profile["framerate"])]
+    return args
+
+
+def _image_input(image_path, profile):
+    args = ["-loop", "1"]
+    if profile["framerate"]:
+        args += ["-framerate", str(profile["framerate"])]
+    return args + ["-i", image_path]
+
+
+def build_command(image_path, audio_path, output_path, profile):
+    """ The FFmpeg command that loops a still image over an audio track. """
+    return (
+        ["ffmpeg", "-y"] # Overwrite output files without asking
+        + _image_input(image_path, profile)
+        + ["-i", audio_path]
+        + _video_args(profile)
+        + ["-c:a", "aac", "-b:a", "192k", "-shortest", "-movflags", "+faststart", output_path]
+    )
+
+
+def build_segment_command(image_path, segment_path, profile):
+    """ The FFmpeg command that encodes the reusable, silent video track. """
+    return (
+        ["ffmpeg", "-y"]
+        + _image_input(image_path, profile)
+        + ["-t", str(profile.get("segment_seconds", 10))]
+        + _video_args(profile)
+        + ["-an", "-movflags", "+faststart", segment_path]
+    )
+
+
+def build_reuse_command(segment_path, audio_path, output_path):
+    """ Loops the pre-encoded track under the audio without re-encoding the video. """
+    return [
+        "ffmpeg", "-y",
+        "-stream_loop", "-1", "-i", segment_path,
+        "-i", audio_path,
+        "-map", "0:v", "-map", "1:a",
+        "-c:v", "copy",
+        "-c:a", "aac", "-b:a", "192k",
+        "-shortest", "-movflags", "+faststart",
+        output_path
+    ]
+
+
+def segment_path_for(image_path, profile_name):
+    """ Reusable tracks are keyed on the image content and the profile. """
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    digest.update(profile_name.encode("utf-8"))
+    return os.path.join(SEGMENT_CACHE_DIR, f"{digest.hexdigest()}.mp4")
+
+
+def benchmark(image_path, audio_path, names=None, output_dir="/tmp"):
+    """
+    Encodes the same inputs with each profile and reports wall time, FFmpeg CPU
+    time (user + system of the child processes) and output size per profile.
+    For reuse profiles the first run also pays for the reusable track, so it
+    is reported separately from a warm run.
+    """
+    from ffmpeg_pipeline import merge_files
+
+    results = {}
+    for name in names or sorted(PROFILES):
+        runs = ["cold", "warm"] if PROFILES[name]["reuse_video"] else ["cold"]
+        for run in runs:
+            output_path = os.path.join(output_dir, f"bench_{name}_{run}.mp4")
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.monotonic()
+            merge_files(image_path, audio_path, output_path, profile=name)
+            wall = time.monotonic() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+            label = name if run == "cold" else f"{name} (warm)"
+            results[label] = {
+                "wall_seconds": round(wall, 2),
+                "cpu_seconds": round(cpu, 2),
+                "output_bytes": os.path.getsize(output_path),
+            }
+            os.remove(output_path)
+    return results
+
+
+# Benchmark the profiles on real inputs:
+#   python encoding_profiles.py image.jpg audio.mp3 [profile ...]
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python encoding_profiles.py IMAGE AUDIO [PROFILE ...]")
+        sys.exit(1)
+    report = benchmark(sys.argv[1], sys.argv[2], sys.argv[3:] or None)
+    print(f"\n{'profile':<20}{'wall s':>10}{'cpu s':>10}{'bytes':>12}")
+    for label, r in report.items():
+        print(f"{label:<20}{r['wall_seconds']:>10}{r['cpu_seconds']:>10}{r['output_bytes']:>12}")
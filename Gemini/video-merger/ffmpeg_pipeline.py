@@ -0,0 +1,129 @@
+import os
+import time
+import subprocess
+import threading
+
+from encoding_profiles import (
+    MERGE_PROFILE, SEGMENT_CACHE_DIR, SEGMENT_CACHE_MAX_BYTES, SEGMENT_CACHE_MAX_AGE,
+    get_profile, build_command, build_segment_command, build_reuse_command, segment_path_for
+)
+from observability import log
+
+# Characters of FFmpeg's stderr kept when it fails; the rest is progress noise.
+FFMPEG_STDERR_TAIL = 2000
+# A track used this recently may be about to be opened by FFmpeg, in this
+# process or another one sharing the directory, so eviction leaves it alone.
+# A partial track this old was left behind by a crash.
+_SEGMENT_IN_USE_SECONDS = 300
+_STALE_PARTIAL_SECONDS = 3600
+
+_segment_lock = threading.Lock()
+_segment_stats = {"files": 0, "bytes": 0, "evictions": 0}
+
+
+def _run_ffmpeg(command, output_path, on_process=None):
+    log("debug", "Running FFmpeg.", command=" ".join(command))
+
+    # Execute FFmpeg, keeping its stderr for errors. on_process receives the
+    # running process so a caller can kill it to cancel the merge.
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if on_process is not None:
+        on_process(process)
+    _, stderr = process.communicate()
+
+    if process.returncode != 0:
+        tail = stderr[-FFMPEG_STDERR_TAIL:]
+        log("error", "FFmpeg failed.", exit_code=process.returncode, stderr=tail)
+        raise Exception(f"FFmpeg failed with exit code {process.returncode}. Stderr: {tail}")
+
+    # Check if the output file was actually created and is not empty
+    size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+    if size == 0:
+        raise Exception(f"FFmpeg did not create a valid output file. Path: {output_path}, Size: {size}. FFmpeg Stderr: {stderr[-FFMPEG_STDERR_TAIL:]}")
+
+def merge_files(image_path, audio_path, output_path, profile=None, on_process=None):
+    """
+    Merges a local image and a local audio file into an MP4 at output_path,
+    using the named encoding profile (MERGE_PROFILE by default).
+    Used by the /merge route and, when the agent runs on the same host, by the
+    agent's local merge backend, so both go through the same FFmpeg pipeline.
+    Raises an Exception if FFmpeg fails or produces no output.
+    """
+    name = profile or MERGE_PROFILE
+    settings = get_profile(name)
+
+    if settings["reuse_video"]:
+        segment_path = segment_path_for(image_path, name)
+        try:
+            os.utime(segment_path) # Marks it as recently used, out of eviction's reach
+            log("debug", "Reusing encoded video track.", path=segment_path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+            partial_path = f"{segment_path}.{os.getpid()}.{threading.get_ident()}.partial.mp4"
+            try:
+                _run_ffmpeg(build_segment_command(image_path, partial_path, settings), partial_path, on_process)
+                os.replace(partial_path, segment_path)
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+            evict_segments()
+        _run_ffmpeg(build_reuse_command(segment_path, audio_path, output_path), output_path, on_process)
+    else:
+        _run_ffmpeg(build_command(image_path, audio_path, output_path, settings), output_path, on_process)
+
+    log("info", "Video merged.", path=output_path, profile=name)
+
+
+def evict_segments(directory=SEGMENT_CACHE_DIR, max_bytes=SEGMENT_CACHE_MAX_BYTES, max_age=SEGMENT_CACHE_MAX_AGE):
+    """
+    Deletes reusable tracks unused for max_age seconds, then the least
+    recently used ones until the cache fits in max_bytes, sparing tracks in
+    use. Runs after every new track. Returns the number of tracks deleted.
+    """
+    with _segment_lock: # one pass at a time; concurrent ones would evict twice as much
+        now = time.time()
+        entries, total, removed, evicted = [], 0, 0, 0
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".partial.mp4"):
+                if now - st.st_mtime > _STALE_PARTIAL_SECONDS:
+                    removed += _remove(path)
+                continue
+            if now - st.st_mtime > max_age:
+                removed += _remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if now - mtime < _SEGMENT_IN_USE_SECONDS:
+                continue
+            if _remove(path):
+                evicted += 1
+                total -= size
+        removed += evicted
+        _segment_stats["files"] = len(entries) - evicted
+        _segment_stats["bytes"] = total
+        _segment_stats["evictions"] += removed
+    if removed:
+        log("info", f"Evicted {removed} reusable video track(s).", bytes=total)
+    return removed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
+
+
+def segment_stats():
+    """Files and bytes of the reusable track cache as of the last eviction pass, and tracks evicted so far."""
+    with _segment_lock:
+        return dict(_segment_stats)
@@ -0,0 +1,230 @@
+import os
+import time
+import uuid
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from observability import log
+
+# Number of FFmpeg processes allowed to run at once. Defaults to one per CPU
+# core so throughput scales with the host without oversubscribing it.
+FFMPEG_WORKERS = int(os.environ.get("FFMPEG_WORKERS", os.cpu_count() or 1))
+# FFmpeg slots only high-priority jobs may use, so a rush order never waits
+# for a bulk campaign's encodes to finish. The rest are shared by everyone.
+FFMPEG_RESERVED_WORKERS = int(os.environ.get("FFMPEG_RESERVED_WORKERS", 1 if FFMPEG_WORKERS > 1 else 0))
+# Priorities (the "priority" of a merge request, a class of the agent's
+# scheduler) that count as high priority.
+FFMPEG_RESERVED_PRIORITIES = set(os.environ.get("FFMPEG_RESERVED_PRIORITIES", "rush").split(","))
+# How long finished jobs (and their output files) are kept for polling clients.
+MERGE_JOB_RETENTION = int(os.environ.get("MERGE_JOB_RETENTION", 3600))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled."""
+
+
+class MergeJob:
+    def __init__(self, audio_url, image_url, profile=None, callback_url=None, priority=None, deadline=None):
+        self.id = uuid.uuid4().hex
+        self.audio_url = audio_url
+        self.image_url = image_url
+        self.profile = profile
+        self.callback_url = callback_url
+        self.priority = priority
+        self.deadline = deadline
+        self.status = QUEUED
+        self.error = None
+        self.output_path = None
+        self.artifact_id = None # set when the output lives in the artifact store
+        self.base_url = None # public URL of this service, for signed result URLs
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.downloads = [] # per-asset download stats (url, bytes, seconds, cache)
+        self.process = None # the running FFmpeg process, so it can be killed
+        self.done = threading.Event() # set once the job is finished
+        self.cancelled = threading.Event()
+
+    @property
+    def high_priority(self):
+        return self.priority in FFMPEG_RESERVED_PRIORITIES
+
+    def sort_key(self):
+        """High priority first, then earliest deadline; jobs without one are due on arrival."""
+        return (0 if self.high_priority else 1, self.deadline or self.created_at)
+
+    def set_process(self, process):
+        """Registers the FFmpeg process; kills it right away if already cancelled."""
+        self.process = process
+        if self.cancelled.is_set():
+            process.kill()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"Job {self.id} was cancelled.")
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "profile": self.profile,
+            "priority": self.priority,
+            "downloads": self.downloads,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_seconds": round((self.started_at or time.time()) - self.created_at, 3),
+            "run_seconds": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None,
+        }
+
+
+class MergeJobManager:
+    """
+    Holds the merge job table and runs jobs on a pool of FFMPEG_WORKERS
+    threads, each driving at most one FFmpeg process. `runner(job)` performs
+    the actual work and returns the path of the finished video.
+
+    Queued jobs wait in a priority queue rather than in submission order: a
+    free slot takes the most urgent job (see MergeJob.sort_key), and
+    `reserved` of the slots only take high-priority jobs.
+    """
+
+    def __init__(self, runner, workers=FFMPEG_WORKERS, retention=MERGE_JOB_RETENTION,
+                 reserved=FFMPEG_RESERVED_WORKERS):
+        self.runner = runner
+        self.workers = workers
+        self.reserved = min(reserved, workers - 1)
+        self.retention = retention
+        self._jobs = {}
+        self._queue = [] # heap of (sort key, sequence, job)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        # Every submitted job schedules one run on the shared slots (and a
+        # high-priority job one more on the reserved slots); each run takes
+        # the most urgent job it may take, so no job is ever left behind.
+        self._executor = ThreadPoolExecutor(max_workers=workers - self.reserved, thread_name_prefix="ffmpeg")
+        self._reserved_executor = (ThreadPoolExecutor(max_workers=self.reserved, thread_name_prefix="ffmpeg-reserved")
+                                   if self.reserved else None)
+        self._completed = 0
+        self._failed = 0
+
+    def submit(self, audio_url, image_url, profile=None, callback_url=None, base_url=None, priority=None,
+               deadline=None):
+        self._prune()
+        job = MergeJob(audio_url, image_url, profile, callback_url, priority, deadline)
+        job.base_url = base_url
+        with self._lock:
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (job.sort_key(), next(self._sequence), job))
+        self._executor.submit(self._run_next, False)
+        if job.high_priority and self._reserved_executor is not None:
+            self._reserved_executor.submit(self._run_next, True)
+        return job
+
+    def _run_next(self, reserved_slot):
+        """Runs the most urgent queued job; a reserved slot only runs high-priority jobs."""
+        with self._lock:
+            if not self._queue or (reserved_slot and not self._queue[0][2].high_priority):
+                return
+            job = heapq.heappop(self._queue)[2]
+        self._run(job)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancels a queued or running job. Returns the job, or None if unknown."""
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        job.cancelled.set()
+        with self._lock:
+            queued = [entry for entry in self._queue if entry[2] is job]
+            for entry in queued:
+                self._queue.remove(entry)
+            heapq.heapify(self._queue)
+        if queued:
+            self._finish(job, CANCELLED, None)
+        elif job.process is not None:
+            job.process.kill()
+        return job
+
+    def metrics(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            completed, failed = self._completed, self._failed
+        return {
+            "workers": self.workers,
+            "reserved_workers": self.reserved,
+            "queued": sum(1 for j in jobs if j.status == QUEUED),
+            "running": sum(1 for j in jobs if j.status == RUNNING),
+            "completed": completed,
+            "failed": failed,
+            "retained_jobs": len(jobs),
+        }
+
+    def _run(self, job):
+        if job.cancelled.is_set():
+            self._finish(job, CANCELLED, None)
+            return
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            job.output_path = self.runner(job)
+            job.check_cancelled()
+        except JobCancelled:
+            self._finish(job, CANCELLED, None)
+        except Exception as e:
+            if job.cancelled.is_set():
+                self._finish(job, CANCELLED, None)
+            else:
+                log("error", f"Merge job {job.id} failed.", job_id=job.id, error=str(e))
+                self._finish(job, FAILED, str(e))
+        else:
+            self._finish(job, DONE, None)
+
+    def _finish(self, job, status, error):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        job.process = None
+        job.done.set()
+        with self._lock:
+            if status == DONE:
+                self._completed += 1
+            elif status == FAILED:
+                self._failed += 1
+        if job.callback_url:
+            self._send_callback(job)
+
+    def _send_callback(self, job):
+        try:
+            requests.post(job.callback_url, json=job.to_dict(), timeout=10)
+        except requests.exceptions.RequestException as e:
+            log("warning", f"Callback for merge job {job.id} failed.", job_id=job.id,
+                callback_url=job.callback_url, error=str(e))
+
+    def _prune(self):
+        """Forgets finished jobs past the retention period and deletes their output."""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [j for j in self._jobs.values() if j.status in FINISHED and j.finished_at < cutoff]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            # Stored artifacts follow the store's own retention policy
+            if job.artifact_id is None and job.output_path and os.path.exists(job.output_path):
+                os.remove(job.output_path)
@@ -1,120 +1,262 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 import requests
-import uuid
 import os
-import subprocess
-import sys # Added for sys.stdout.flush()
+from requests.adapters import HTTPAdapter
+
+from ffmpeg_pipeline import merge_files, evict_segments, segment_stats
+from encoding_profiles import get_profile
+from merge_jobs import MergeJobManager, DONE
+from asset_cache import AssetCache, log_fetch_stats
+from artifact_store import ArtifactStore, ARTIFACT_URL_TTL
+from observability import registry, span, log, SIZE_BUCKETS
 
 app = Flask(__name__)
 
+# Shared keep-alive session for downloading assets, so repeated downloads from
+# the agent and the image CDN reuse pooled connections instead of paying a new
+# TCP+TLS handshake each time.
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 120))
+DOWNLOAD_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_MAXSIZE)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+assets = AssetCache(session, DOWNLOAD_TIMEOUT)
+store = ArtifactStore()
+store.start_gc()
+evict_segments() # Applies the track cache budget to what earlier runs left, and fills its stats
+
+# Public URL of this service used in signed artifact URLs; defaults to the
+# host the request came in on.
+MERGER_PUBLIC_URL = os.environ.get("MERGER_PUBLIC_URL")
+
+QUEUE_WAIT_SECONDS = registry.histogram(
+    "merge_queue_wait_seconds", "Time merge jobs wait for an FFmpeg slot.", ["priority"]
+)
+MERGE_SECONDS = registry.histogram(
+    "merge_job_seconds", "Duration of merge jobs, downloads included.", ["outcome"]
+)
+DOWNLOAD_SECONDS = registry.histogram(
+    "merge_download_seconds", "Duration of input downloads.", ["cache"]
+)
+DOWNLOAD_BYTES = registry.counter(
+    "merge_download_bytes_total", "Bytes of inputs fetched, by cache outcome.", ["cache"]
+)
+FFMPEG_SECONDS = registry.histogram(
+    "merge_ffmpeg_seconds", "Duration of FFmpeg encodes.", ["profile", "outcome"]
+)
+OUTPUT_BYTES = registry.histogram(
+    "merge_output_bytes", "Size of merged videos.", buckets=SIZE_BUCKETS
+)
+
+def _public_base_url():
+    return MERGER_PUBLIC_URL or request.host_url.rstrip('/')
+
+def run_merge_job(job):
+    """
+    Fetches the inputs of a merge job (in parallel, through the asset cache),
+    runs FFmpeg and returns the path of the finished video. Runs on one of the
+    merge job manager's FFmpeg slots.
+    """
+    output_path = f"/tmp/output_{job.id}.mp4"
+    QUEUE_WAIT_SECONDS.observe(job.started_at - job.created_at, priority=job.priority or "none")
+
+    # The job ID is the trace ID of the merge's spans and log lines
+    with span("merge", MERGE_SECONDS, trace_id=job.id):
+        try:
+            job.check_cancelled()
+            # The inputs stay in the asset cache until FFmpeg is done with them
+            with assets.using([job.audio_url, job.image_url]) as inputs:
+                (audio_path, audio_stats), (image_path, image_stats) = inputs
+                job.downloads = [audio_stats, image_stats]
+                log_fetch_stats(job.downloads)
+                for stats in job.downloads:
+                    DOWNLOAD_SECONDS.observe(stats["seconds"], cache=stats["cache"])
+                    DOWNLOAD_BYTES.inc(stats["bytes"], cache=stats["cache"])
+                job.check_cancelled()
+                with span("ffmpeg", FFMPEG_SECONDS, profile=job.profile or "default"):
+                    merge_files(image_path, audio_path, output_path, profile=job.profile,
+                                on_process=job.set_process)
+            OUTPUT_BYTES.observe(os.path.getsize(output_path))
+            # Write the video once into the artifact store; from here on it is
+            # only referenced by URL
+            job.artifact_id = store.put_file(output_path, "video/mp4")
+        except requests.exceptions.RequestException as e:
+            response = e.response
+            log("error", "Error downloading audio or image.", error=str(e),
+                status=response.status_code if response is not None else None,
+                body=response.text if response is not None else None)
+            raise Exception(f"Failed to download input files: {e}")
+
+    return store.open_object(job.artifact_id)[0]
+
+jobs = MergeJobManager(run_merge_job)
+
+def _parse_merge_request():
+    """ Returns (audio_url, image_url, profile, error_response). """
+    data = request.get_json(silent=True) or {}
+    audio_url = data.get("audio_url")
+    image_url = data.get("image_url")
+    profile = data.get("profile") # Optional encoding profile, see encoding_profiles.py
+
+    if not audio_url or not image_url:
+        return None, None, None, (jsonify({"error": "Missing audio_url or image_url"}), 400)
+    try:
+        get_profile(profile)
+    except ValueError as e:
+        return None, None, None, (jsonify({"error": str(e)}), 400)
+    return audio_url, image_url, profile, None
+
+def _schedule():
+    """ The priority class and deadline (epoch seconds) the agent sends with a merge, if any. """
+    data = request.get_json(silent=True) or {}
+    try:
+        deadline = float(data["deadline"]) if data.get("deadline") is not None else None
+    except (TypeError, ValueError):
+        deadline = None
+    return data.get("priority"), deadline
+
+def _job_result(job):
+    """ The video reference returned for a finished job. """
+    _, metadata = store.open_object(job.artifact_id)
+    return {
+        "video_url": store.signed_url(job.base_url, job.artifact_id),
+        "artifact_id": job.artifact_id,
+        "size": metadata["size"] if metadata else None,
+    }
+
 @app.route("/merge", methods=["POST"])
 def merge_video():
-    try:
-        data = request.get_json()
-        audio_url = data.get("audio_url")
-        image_url = data.get("image_url")
-
-        if not audio_url or not image_url:
-            return jsonify({"error": "Missing audio_url or image_url"}), 400
-
-        uid = uuid.uuid4().hex
-        audio_path = f"/tmp/audio_{uid}.mp3"
-        image_path = f"/tmp/image_{uid}.jpg"
-        output_path = f"/tmp/output_{uid}.mp4"
-
-        print(f"[*] Downloading audio from: {audio_url}")
-        sys.stdout.flush()
-        with requests.get(audio_url, stream=True) as r:
-            r.raise_for_status()
-            with open(audio_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        print(f"[*] Audio downloaded to: {audio_path}")
-        sys.stdout.flush()
-
-        print(f"[*] Downloading image from: {image_url}")
-        sys.stdout.flush()
-        with requests.get(image_url, stream=True) as r:
-            r.raise_for_status()
-            with open(image_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        print(f"[*] Image downloaded to: {image_path}")
-        sys.stdout.flush()
-
-        command = [
-            "ffmpeg",
-            "-y", # Overwrite output files without asking
-            "-loop", "1",
-            "-i", image_path,
-            "-i", audio_path,
-            "-c:v", "libx264",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-shortest",
-            "-movflags", "+faststart",
-            "-pix_fmt", "yuv420p",
-            output_path
-        ]
-        
-        print(f"[*] Executing FFmpeg command: {' '.join(command)}")
-        sys.stdout.flush()
-
-        # Execute FFmpeg and capture its output
-        process = subprocess.run(command, capture_output=True, text=True, check=False)
-        
-        print(f"[*] FFmpeg stdout:\n{process.stdout}")
-        print(f"[*] FFmpeg stderr:\n{process.stderr}")
-        print(f"[*] FFmpeg exit code: {process.returncode}")
-        sys.stdout.flush()
-
-        if process.returncode != 0:
-            raise Exception(f"FFmpeg failed with exit code {process.returncode}. Stderr: {process.stderr}")
-
-        # Check if the output file was actually created and is not empty
-        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-            raise Exception(f"FFmpeg did not create a valid output file. Path: {output_path}, Size: {os.path.getsize(output_path)}. FFmpeg Stderr: {process.stderr}")
-
-        print(f"[*] Video merged successfully to: {output_path}")
-        sys.stdout.flush()
-
-        # Clean up temporary files
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-            print(f"[*] Cleaned up temporary audio file: {audio_path}")
-            sys.stdout.flush()
-        if os.path.exists(image_path):
-            os.remove(image_path)
-            print(f"[*] Cleaned up temporary image file: {image_path}")
-            sys.stdout.flush()
-        
-        # Send the file and then clean it up
-        response = send_file(output_path, mimetype="video/mp4")
-        
-        # Schedule cleanup of the output video file after sending
-        @response.call_on_close
-        def cleanup_output_file():
-            if os.path.exists(output_path):
-                os.remove(output_path)
-                print(f"[*] Cleaned up temporary output video file: {output_path}")
-                sys.stdout.flush()
-
-        return response
-
-    except requests.exceptions.RequestException as e:
-        print(f"[!] Error downloading audio or image: {e}")
-        if e.response is not None:
-            print(f"[!] Response status: {e.response.status_code}")
-            print(f"[!] Response body: {e.response.text}")
-        return jsonify({"error": f"Failed to download input files: {e}"}), 500
-    except Exception as e:
-        print(f"[!] An error occurred during video merging: {e}")
-        sys.stdout.flush()
-        return jsonify({"error": str(e)}), 500
+    """
+    Synchronous merge: waits for the job and answers with a signed video_url
+    pointing at the artifact store. Pass ?download=1 to get the MP4 body
+    instead. It goes through the same FFmpeg pool as /jobs, so it cannot
+    oversubscribe the host.
+    """
+    audio_url, image_url, profile, error = _parse_merge_request()
+    if error:
+        return error
+
+    priority, deadline = _schedule()
+    job = jobs.submit(audio_url, image_url, profile, base_url=_public_base_url(), priority=priority, deadline=deadline)
+    job.done.wait()
+    if job.status != DONE:
+        return jsonify({"error": job.error or f"Merge job {job.status}"}), 500
+
+    if request.args.get("download") == "1":
+        return send_file(job.output_path, mimetype="video/mp4", conditional=True)
+    return jsonify(_job_result(job))
+
+@app.route("/artifacts/<artifact_id>", methods=["GET"])
+def serve_artifact(artifact_id):
+    """
+    Serves a stored artifact to holders of a valid signed URL. Supports Range
+    and conditional requests, and HEAD for the size without the body.
+    """
+    if not store.verify(artifact_id, request.args.get("expires"), request.args.get("sig")):
+        return jsonify({"error": "Invalid or expired link"}), 403
+    path, metadata = store.open_object(artifact_id)
+    if path is None:
+        return jsonify({"error": "Not found"}), 404
+    return send_file(path, mimetype=metadata["content_type"], conditional=True, etag=artifact_id,
+                     max_age=ARTIFACT_URL_TTL)
+
+@app.route("/jobs", methods=["POST"])
+def submit_merge_job():
+    """
+    Asynchronous merge: queues the job and answers right away with its ID.
+    Poll GET /jobs/<id>, or pass a callback_url to be notified when it ends.
+    """
+    audio_url, image_url, profile, error = _parse_merge_request()
+    if error:
+        return error
+
+    callback_url = (request.get_json(silent=True) or {}).get("callback_url")
+    priority, deadline = _schedule()
+    job = jobs.submit(audio_url, image_url, profile, callback_url, base_url=_public_base_url(),
+                      priority=priority, deadline=deadline)
+    body = job.to_dict()
+    body["status_url"] = f"{request.host_url.rstrip('/')}/jobs/{job.id}"
+    return jsonify(body), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_merge_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    body = job.to_dict()
+    if job.status == DONE:
+        body.update(_job_result(job))
+        body["result_url"] = body["video_url"]
+    return jsonify(body)
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_merge_job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None or job.status != DONE or not os.path.exists(job.output_path or ""):
+        return jsonify({"error": "Result not available"}), 404
+    return send_file(job.output_path, mimetype="video/mp4", conditional=True)
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_merge_job(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+def _collect_metrics():
+    """ Merge job counters, read on every /metrics scrape. """
+    stats = jobs.metrics()
+    for status in ("queued", "running"):
+        yield "merge_jobs", "gauge", "Merge jobs waiting or running.", {"status": status}, stats[status]
+    yield "merge_jobs_completed_total", "counter", "Merge jobs that succeeded.", {}, stats["completed"]
+    yield "merge_jobs_failed_total", "counter", "Merge jobs that failed.", {}, stats["failed"]
+    yield "merge_ffmpeg_workers", "gauge", "FFmpeg slots of this process.", {}, stats["workers"]
+    yield ("merge_ffmpeg_reserved_workers", "gauge", "FFmpeg slots kept for high-priority jobs.",
+           {}, stats["reserved_workers"])
+    segments = segment_stats()
+    yield "merge_segment_cache_bytes", "gauge", "Disk used by reusable video tracks.", {}, segments["bytes"]
+    yield "merge_segment_cache_files", "gauge", "Reusable video tracks on disk.", {}, segments["files"]
+    yield ("merge_segment_cache_evictions_total", "counter", "Reusable video tracks deleted by the cache budget.",
+           {}, segments["evictions"])
+
+registry.register_collector(_collect_metrics)
+
+@app.route("/metrics")
+def metrics():
+    """ Every metric of the merger in the Prometheus text format. """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/stats/latency")
+def latency_stats():
+    """ p50/p95/p99 of queue wait, download, FFmpeg and whole-job durations. """
+    return jsonify(registry.latency_summary())
+
+@app.route("/stats/jobs")
+def job_stats():
+    """ Queue depth and outcome counters of the FFmpeg pool, and the reusable track cache. """
+    return jsonify(dict(jobs.metrics(), segment_cache=segment_stats()))
 
 @app.route("/")
 def index():
     return "FFmpeg Video Merger is running."
 
+@app.route("/stats/connections")
+def connection_stats():
+    """ Reports how many connections the download session opened versus requests sent per host. """
+    hosts = {}
+    for key in list(_adapter.poolmanager.pools.keys()):
+        pool = _adapter.poolmanager.pools.get(key)
+        if pool is not None:
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+    return jsonify(hosts)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=10000)
@@ -1,158 +1,489 @@
 import os
-import threading
-from flask import Flask, request, jsonify, send_from_directory # Added send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, send_file # Added send_from_directory
 from dotenv import load_dotenv
-import sys # Import sys for stdout.flush()
 
 # Import your custom modules
-from content_generator import generate_script_and_image
-from voice_generator import generate_voice_over
-from video_processor import merge_audio_and_image
-from notification import send_video_to_client
+from content_generator import (generate_script, generate_image, generate_script_async, generate_image_async,
+                               image_url_life)
+from voice_generator import generate_voice_over, generate_voice_over_async
+from video_processor import merge_audio_and_image, merge_audio_and_image_async, get_artifact_store
+from notification import send_video_to_client, send_video_to_client_async, get_mail_dispatcher
+from job_queue import JobQueue, WorkerPool, QueueFull, current_job_id, notify_workers
+from coordination import get_coordinator
+from job_status import (broker, EventStream, StreamsExhausted, job_summary, events_url, serve_streams,
+                        JOB_EVENTS_PORT, JOB_EVENTS_KEEPALIVE)
+from tally_schema import registry as tally_schema
+from idempotency import submission_keys, SUBMISSION_DEDUP_WINDOW, SUBMISSION_INDEX_TTL
+from pipeline import Pipeline, Stage, PipelineError, format_timings
+from http_session import connection_metrics
+from content_cache import cache, TTL_SCRIPT
+from rate_limiter import limiter, tenant_scope
+from resilience import resilience, is_retryable
+from scratch import scratch
+import scheduling
+from observability import registry, log
+from bulk import parse_briefs, submit_batch, batch_status, stream_progress, BriefError
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = Flask(__name__)
+# Let a fronting web server send files via X-Sendfile instead of the app
+app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE") == "1"
 
-def create_video_task(form_data):
+# "threads" runs each job on a worker thread with blocking I/O. "async" runs
+# every job on one shared event loop so a single process can keep hundreds of
+# jobs in flight while they wait on remote APIs.
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "threads")
+# Maximum number of jobs in flight on the event loop in async mode.
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get("ASYNC_MAX_IN_FLIGHT", 200))
+# Jobs of bulk batches run concurrently (worker threads, or jobs in flight in
+# async mode), separately from the webhook workers.
+BULK_WORKERS = int(os.environ.get("BULK_WORKERS", 8))
+# "1" runs the worker pools inside every web process. "0" keeps the web tier
+# stateless: jobs are run by `python worker.py` processes sharing the job
+# database, and capacity grows with the number of those processes.
+RUN_WORKERS_IN_WEB = os.environ.get("RUN_WORKERS_IN_WEB", "1") == "1"
+# How long a merged video URL is reused by a retry of its job. The voice-over
+# is not checkpointed: its file lives in the scratch directory of the failed
+# attempt, and the content cache makes redoing it cheap.
+CHECKPOINT_TTL_MERGE = int(os.environ.get("CHECKPOINT_TTL_MERGE", 24 * 3600))
+
+def build_video_pipeline(form_data):
     """
-    The main task to be run in a background thread.
-    It orchestrates the entire video creation process.
+    Describes the video creation process as a dependency graph:
+
+        script ──> voice ──┐
+        image ─────────────┴──> merge ──> notify
+
+    Script and image generation run at the same time, and the image is ready
+    long before the voice-over, so the total time follows the longest path.
+    Script, image and merge results are checkpointed, so a retried job does
+    not pay for them again.
     """
-    print("[*] DEBUG: create_video_task function entered.")
-    sys.stdout.flush() # Force flush
+    project_name = form_data.get("projectName")
+    video_goal = form_data.get("videoGoal")
+    central_message = form_data.get("centralMessage")
+    tone = form_data.get("tone")
+    target_audience = form_data.get("targetAudience")
+    call_to_action = form_data.get("callToAction")
+    client_email = form_data.get("email")
 
-    try:
-        # Extract data from the form
-        project_name = form_data.get("projectName")
-        video_goal = form_data.get("videoGoal")
-        central_message = form_data.get("centralMessage")
-        tone = form_data.get("tone")
-        target_audience = form_data.get("targetAudience")
-        call_to_action = form_data.get("callToAction")
-        client_email = form_data.get("email")
-
-        print(f"[*] Starting video creation for {project_name}...")
-        sys.stdout.flush() # Force flush
-
-        # 1. Generate script and image
-        print("[*] DEBUG: Calling generate_script_and_image...")
-        sys.stdout.flush() # Force flush
-        script, image_url = generate_script_and_image(
+    def script_stage():
+        script = generate_script(
             project_name, video_goal, central_message, tone, target_audience, call_to_action
         )
-        print(f"[*] Script and image generated successfully.")
-        print(f" - Script: {script[:80]}...")
-        print(f" - Image URL: {image_url}")
-        sys.stdout.flush() # Force flush
-
-
-        # 2. Generate voice-over
-        print("[*] DEBUG: Calling generate_voice_over...")
-        sys.stdout.flush() # Force flush
-        audio_file_url = generate_voice_over(script) # Changed to audio_file_url
-        print(f"[*] Voice-over generated and saved to: {audio_file_url}") # Changed to audio_file_url
-        sys.stdout.flush() # Force flush
-
-        # 3. Merge image and audio into a video
-        print("[*] DEBUG: Calling merge_audio_and_image...")
-        sys.stdout.flush() # Force flush
-        video_url = merge_audio_and_image(image_url, audio_file_url) # Changed to audio_file_url
-        print(f"[*] Video merged successfully. URL: {video_url}")
-        sys.stdout.flush() # Force flush
-
-        # 4. Send the final video to the client
-        print("[*] DEBUG: Calling send_video_to_client...")
-        sys.stdout.flush() # Force flush
-        send_video_to_client(client_email, video_url, project_name)
-        print(f"[*] Video sent to {client_email}.")
-        sys.stdout.flush() # Force flush
-
-        # 5. Clean up local temporary files (optional but recommended)
-        # Note: The audio file is now served from /tmp and will be cleaned up by the OS or on restart
-        # if os.path.exists(audio_file_path): # This line is removed as audio_file_path is no longer returned
-        #     os.remove(audio_file_path)
-        #     print(f"[*] Cleaned up temporary file: {audio_file_path}")
-        #     sys.stdout.flush() # Force flush
-
-        print(f"[+] Video creation process for {project_name} completed successfully.")
-        sys.stdout.flush() # Force flush
-
-    except Exception as e:
-        print(f"[!] An error occurred during the video creation process: {e}")
-        sys.stdout.flush() # Force flush
+        log("info", "Script generated successfully.", script=script[:80])
+        return script
+
+    def image_stage():
+        image = generate_image(project_name, central_message, tone)
+        log("info", "Image generated successfully.", image_url=image["url"])
+        return image
+
+    def voice_stage(script):
+        audio_file_url = generate_voice_over(script)
+        log("info", "Voice-over generated.", audio_url=audio_file_url)
+        return audio_file_url
+
+    def merge_stage(image, voice):
+        video_url = merge_audio_and_image(image["url"], voice)
+        log("info", "Video merged successfully.", video_url=video_url)
+        return video_url
+
+    def notify_stage(merge):
+        send_video_to_client(client_email, merge, project_name)
+        log("info", "Video sent.", email=client_email)
+
+    return Pipeline([
+        Stage("script", script_stage, checkpoint_ttl=TTL_SCRIPT),
+        Stage("image", image_stage, checkpoint_ttl=image_url_life),
+        Stage("voice", voice_stage, deps=["script"]),
+        Stage("merge", merge_stage, deps=["image", "voice"], checkpoint_ttl=CHECKPOINT_TTL_MERGE),
+        Stage("notify", notify_stage, deps=["merge"]),
+    ])
+
+def build_video_pipeline_async(form_data):
+    """ Same graph as build_video_pipeline, built from the async service calls. """
+    project_name = form_data.get("projectName")
+    video_goal = form_data.get("videoGoal")
+    central_message = form_data.get("centralMessage")
+    tone = form_data.get("tone")
+    target_audience = form_data.get("targetAudience")
+    call_to_action = form_data.get("callToAction")
+    client_email = form_data.get("email")
+
+    async def script_stage():
+        return await generate_script_async(
+            project_name, video_goal, central_message, tone, target_audience, call_to_action
+        )
+
+    async def image_stage():
+        return await generate_image_async(project_name, central_message, tone)
+
+    async def voice_stage(script):
+        return await generate_voice_over_async(script)
+
+    async def merge_stage(image, voice):
+        return await merge_audio_and_image_async(image["url"], voice)
+
+    async def notify_stage(merge):
+        await send_video_to_client_async(client_email, merge, project_name)
+
+    return Pipeline([
+        Stage("script", script_stage, checkpoint_ttl=TTL_SCRIPT),
+        Stage("image", image_stage, checkpoint_ttl=image_url_life),
+        Stage("voice", voice_stage, deps=["script"]),
+        Stage("merge", merge_stage, deps=["image", "voice"], checkpoint_ttl=CHECKPOINT_TTL_MERGE),
+        Stage("notify", notify_stage, deps=["merge"]),
+    ])
+
+def _job_checkpoints():
+    """ Checkpoints of the job being run by a worker, or None when called directly. """
+    job_id = current_job_id()
+    return job_queue.checkpoints(job_id) if job_id else None
+
+def _job_progress():
+    """ Reports stage transitions to the job's status and event stream, or None when called directly. """
+    job_id = current_job_id()
+    return job_queue.progress(job_id) if job_id else None
+
+def create_video_task(form_data):
+    """
+    The main task run by the background worker pool.
+    It orchestrates the entire video creation process.
+    Errors are re-raised so the job queue can record the failure.
+    """
+    project_name = form_data.get("projectName")
+    try:
+        log("info", "Starting video creation.", project=project_name)
+
+        # Intermediate files live in a job directory that is deleted once
+        # the video has been sent. Provider calls are shared fairly between
+        # customers, identified by their email.
+        with scratch.job(), tenant_scope(form_data.get("email")):
+            results, timings = build_video_pipeline(form_data).run(_job_checkpoints(), _job_progress())
+
+        log("info", "Video creation completed successfully.", project=project_name, timings=format_timings(timings))
+
+    except PipelineError as e:
+        log("error", "Video creation failed.", project=project_name, error=str(e), timings=format_timings(e.timings))
         # Optional: Send an error notification to yourself
         # send_error_notification(str(e), form_data)
+        raise
+
+async def create_video_task_async(form_data):
+    """
+    Async variant of create_video_task, run on the shared event loop when
+    PIPELINE_MODE is "async".
+    """
+    project_name = form_data.get("projectName")
+    try:
+        log("info", "Starting video creation (async).", project=project_name)
+
+        with scratch.job(), tenant_scope(form_data.get("email")):
+            results, timings = await build_video_pipeline_async(form_data).run_async(
+                _job_checkpoints(), _job_progress())
+
+        log("info", "Video creation completed successfully.", project=project_name, timings=format_timings(timings))
+
+    except PipelineError as e:
+        log("error", "Video creation failed.", project=project_name, error=str(e), timings=format_timings(e.timings))
+        raise
+
+
+# Persistent job queue and bounded worker pools. Submissions are stored before
+# we acknowledge Tally, so a recycled worker never loses an in-flight job.
+# Jobs that fail on a timeout, an outage or an open circuit are retried later.
+job_queue = JobQueue()
+worker_pool = bulk_pool = None
+
+def start_workers():
+    """
+    Starts this process's video and bulk worker pools (see also worker.py),
+    and the GC of the scratch space their jobs write to. Returns the pools.
+    """
+    global worker_pool, bulk_pool
+    scratch.start_gc()
+    if PIPELINE_MODE == "async":
+        worker_pool = WorkerPool(job_queue, create_video_task_async, size=ASYNC_MAX_IN_FLIGHT,
+                                 should_retry=is_retryable)
+        bulk_pool = WorkerPool(job_queue, create_video_task_async, size=BULK_WORKERS, batch=True,
+                               should_retry=is_retryable)
+    else:
+        worker_pool = WorkerPool(job_queue, create_video_task, should_retry=is_retryable)
+        bulk_pool = WorkerPool(job_queue, create_video_task, size=BULK_WORKERS, batch=True,
+                               should_retry=is_retryable)
+    worker_pool.start()
+    bulk_pool.start()
+    return worker_pool, bulk_pool
+
+_web_started = False
+
+def init_web():
+    """
+    Starts the background services of a web process: the worker pools when
+    RUN_WORKERS_IN_WEB is set, the poller that brings other processes' job
+    events to the streams, and the async stream server on JOB_EVENTS_PORT.
+    Importing this module starts nothing, so worker.py can use it without
+    running them; call this once per web process (create_app does).
+    """
+    global _web_started
+    if _web_started:
+        return
+    _web_started = True
+    if RUN_WORKERS_IN_WEB:
+        start_workers()
+    broker.start_polling(job_queue)
+    if JOB_EVENTS_PORT:
+        serve_streams(job_queue, JOB_EVENTS_PORT)
+
+def create_app():
+    """ WSGI entry point of the web tier: `gunicorn "app:create_app()"`. """
+    init_web()
+    return app
+
+
+def _collect_metrics():
+    """ State owned by other components, read on every /metrics scrape. """
+    for (status, kind), jobs in job_queue.depth().items():
+        yield "job_queue_jobs", "gauge", "Jobs waiting or running.", {"status": status, "kind": kind}, jobs
+    stats = cache.stats()
+    for result in ("memory_hits", "disk_hits", "misses", "coalesced"):
+        yield ("content_cache_lookups_total", "counter", "Content cache lookups by result.",
+               {"result": result}, stats.get(result, 0))
+    yield "content_cache_hit_ratio", "gauge", "Share of content cache lookups served from cache.", {}, stats["hit_rate"]
+    for provider, stats in limiter.metrics().items():
+        labels = {"provider": provider}
+        yield "rate_limit_in_flight", "gauge", "Calls in flight per provider.", labels, stats["in_flight"]
+        yield "rate_limit_waiting", "gauge", "Calls waiting for a slot per provider.", labels, stats["waiting"]
+        yield ("rate_limit_concurrency_limit", "gauge", "Adaptive concurrency limit per provider.",
+               labels, stats["concurrency_limit"])
+        yield "rate_limit_throttled_total", "counter", "429 responses per provider.", labels, stats["throttled"]
+    for dependency, stats in resilience.metrics().items():
+        labels = {"dependency": dependency}
+        yield ("circuit_breaker_open", "gauge", "1 while the dependency's circuit is not closed.",
+               labels, int(stats["state"] != "closed"))
+        yield "outbound_retries_total", "counter", "Retried calls per dependency.", labels, stats["retries"]
+    mail = get_mail_dispatcher().metrics()
+    yield "mail_pending", "gauge", "Emails waiting for the next Mailjet batch.", {}, mail["pending"]
+    yield "scratch_bytes", "gauge", "Disk used by job scratch directories.", {}, scratch.stats()["bytes"]
+    events = broker.metrics()
+    yield "job_event_watchers", "gauge", "Open job event streams.", {}, events["watchers"]
+    yield ("job_event_streams_rejected_total", "counter", "Event streams refused at the stream cap.",
+           {}, events["streams_rejected"])
+    for member, info in get_coordinator().members().items():
+        labels = {"member": member, "kind": info["kind"]}
+        yield "worker_pool_size", "gauge", "Job slots of each live worker pool.", labels, info["size"]
+        yield "worker_pool_running", "gauge", "Jobs running in each live worker pool.", labels, info["running"]
+
+registry.register_collector(_collect_metrics)
 
 
 @app.route('/webhook/tally', methods=['POST'])
 def tally_webhook():
-    print("[*] DEBUG: Webhook function entered.")
-    sys.stdout.flush() # Force flush
     """
-    Receives the webhook from Tally.so, starts the video creation
-    in a background thread, and returns an immediate response.
+    Receives the webhook from Tally.so, queues the video creation
+    for the worker pool, and returns an immediate response. The priority
+    class is the form's in FORM_PRIORITIES, unless the request asks for one
+    with ?priority= and carries PRIORITY_KEY (see scheduling); nothing the
+    submitter fills in can change it.
     """
     if request.json:
-        print(f"[*] Received raw JSON from Tally: {request.json}")
-        sys.stdout.flush() # Force flush
+        log("debug", "Received raw JSON from Tally.", body=request.json)
         data = request.json.get('data', {})
-        fields = data.get('fields', [])
-
-        # Transform the Tally fields array into a simple key-value dictionary
-        form_data = {}
-        field_mapping = {
-            "What’s the name of your project or brand?": "projectName",
-            "What’s the goal of your video?": "videoGoal",
-            "What is the core message you want to convey?": "centralMessage",
-            "What tone do you want for the video?": "tone",
-            "Who is your target audience?": "targetAudience",
-            "What should the final call-to-action be?": "callToAction",
-            "What’s your email address to receive the final video?": "email"
-        }
-
-        for field in fields:
-            label = field.get('label')
-            key = field_mapping.get(label)
-            if key:
-                if field.get('type') == 'MULTIPLE_CHOICE':
-                    selected_option_id = field.get('value')[0] if field.get('value') else None
-                    if selected_option_id:
-                        for option in field.get('options', []):
-                            if option.get('id') == selected_option_id:
-                                form_data[key] = option.get('text')
-                                break
-                else:
-                    form_data[key] = field.get('value')
-        print(f"[*] Debug: Parsed form_data: {form_data}")
-        print(f"[*] Received form data: {form_data}")
-        sys.stdout.flush() # Force flush
-
-        # Run the video creation process in a background thread
-        # to avoid Tally webhook timeouts.
-        thread = threading.Thread(target=create_video_task, args=(form_data,))
-        thread.start()
-
-        # Immediately confirm receipt to Tally
-        return jsonify({'status': 'success', 'message': 'Video creation process started.'}), 200
+
+        # Transform the Tally fields array into a simple key-value dictionary,
+        # using the field mapping compiled once per Tally form
+        form_data = tally_schema.parse(data)
+        log("info", "Received form data.", form_data=form_data)
+
+        # Queue the video creation for the worker pool to avoid Tally
+        # webhook timeouts. Retried deliveries and double-submits resolve to
+        # the job already created for them. When the queue is full, ask Tally
+        # to retry later.
+        try:
+            job_id, created = job_queue.enqueue_once(
+                form_data, submission_keys(request.json, form_data),
+                SUBMISSION_DEDUP_WINDOW, SUBMISSION_INDEX_TTL,
+                priority=_requested_priority() or scheduling.form_priority(data.get('formId'))
+            )
+        except QueueFull as e:
+            log("warning", "Job queue is full, rejecting submission.", retry_after=e.retry_after)
+            response = jsonify({'status': 'error', 'message': 'Too many videos in progress, please retry later.'})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 503
+        if not created:
+            job = job_queue.get(job_id)
+            log("info", "Duplicate submission, not starting a new video.", job_id=job_id, job_status=job['status'])
+            return jsonify({'status': 'success', 'message': 'Video already requested.',
+                            'job_id': job_id, 'job_status': job['status'], **_job_urls(job_id)}), 200
+        notify_workers("video")
+
+        # Immediately confirm receipt to Tally, with where to follow the job
+        return jsonify({'status': 'success', 'message': 'Video creation process started.',
+                        'job_id': job_id, **_job_urls(job_id)}), 200
     else:
         return jsonify({'status': 'error', 'message': 'Invalid request format.'}), 400
 
+def _requested_priority():
+    return scheduling.requested_priority(request.args.get('priority'), request.headers.get('X-Priority-Key'))
+
+def _job_urls(job_id):
+    base_url = request.host_url.rstrip('/')
+    return {'status_url': f"{base_url}/jobs/{job_id}", 'events_url': events_url(base_url, job_id)}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """ Status of a job, with the state and timings of each pipeline stage of its current attempt. """
+    summary = job_summary(job_queue, job_id)
+    if summary is None:
+        return jsonify({'status': 'error', 'message': 'Unknown job.'}), 404
+    summary.update(_job_urls(job_id))
+    return jsonify(summary)
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Streams the job's status changes and stage transitions as Server-Sent
+    Events until it is done or failed. A reconnecting EventSource resumes
+    after its Last-Event-ID; ?after=<id> does the same for other clients.
+    Each stream holds a request thread, so at most JOB_EVENTS_MAX_STREAMS
+    are served here; the stream server (JOB_EVENTS_PORT) takes the rest.
+    """
+    if job_queue.get(job_id) is None:
+        return jsonify({'status': 'error', 'message': 'Unknown job.'}), 404
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('after') or 0)
+    except ValueError:
+        last_event_id = 0
+    # Tell nginx-style proxies not to buffer the stream
+    try:
+        stream = EventStream(job_queue, job_id, last_event_id)
+    except StreamsExhausted:
+        return (jsonify({'status': 'error', 'message': 'Too many event streams, retry later or poll the status URL.'}),
+                503, {'Retry-After': str(int(JOB_EVENTS_KEEPALIVE))})
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream, mimetype='text/event-stream', headers=headers)
+
+@app.route('/bulk', methods=['POST'])
+def bulk_submit():
+    """
+    Queues a campaign: the request body is a CSV (with a header row) or JSON
+    Lines file of briefs, one video per row. Columns are form_data keys or the
+    Tally question labels. Identical briefs share one job, and briefs with the
+    same image prompt share one image through the content cache.
+    ?priority= picks the batch's priority class, with PRIORITY_KEY in the
+    X-Priority-Key header; batches get the bulk class otherwise.
+    """
+    try:
+        briefs = parse_briefs(request.get_data(as_text=True), request.args.get('format'))
+    except BriefError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not briefs:
+        return jsonify({'status': 'error', 'message': 'No briefs found.'}), 400
+
+    summary = submit_batch(job_queue, briefs, _requested_priority())
+    notify_workers("bulk")
+    log("info", "Bulk batch queued.", batch_id=summary['batch_id'], unique_jobs=summary['unique_jobs'],
+        briefs=len(briefs), rejected=len(summary['rejected']))
+    base_url = request.host_url.rstrip('/')
+    summary['status_url'] = f"{base_url}/bulk/{summary['batch_id']}"
+    summary['progress_url'] = f"{base_url}/bulk/{summary['batch_id']}/progress"
+    return jsonify(summary), 202
+
+@app.route('/bulk/<batch_id>', methods=['GET'])
+def bulk_status(batch_id):
+    status = batch_status(job_queue, batch_id)
+    if status is None:
+        return jsonify({'status': 'error', 'message': 'Unknown batch.'}), 404
+    return jsonify(status)
+
+@app.route('/bulk/<batch_id>/progress', methods=['GET'])
+def bulk_progress(batch_id):
+    """ Streams one NDJSON line per finished job, then a summary line. """
+    if batch_status(job_queue, batch_id) is None:
+        return jsonify({'status': 'error', 'message': 'Unknown batch.'}), 404
+    return Response(stream_progress(job_queue, batch_id), mimetype='application/x-ndjson')
+
 @app.route('/', methods=['GET'])
 def index():
-    print("[*] DEBUG: Homepage accessed. Original code is running!")
-    sys.stdout.flush() # Force flush
     return "Video Automation Agent is running."
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """ Every metric of the process in the Prometheus text format. """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats/latency', methods=['GET'])
+def latency_stats():
+    """ p50/p95/p99 of job, stage and outbound call durations. """
+    return jsonify(registry.latency_summary())
+
+@app.route('/stats/connections', methods=['GET'])
+def connection_stats():
+    """ Connection reuse per host for the shared outbound HTTP session. """
+    return jsonify(connection_metrics())
+
+@app.route('/stats/scratch', methods=['GET'])
+def scratch_stats():
+    """ Disk usage of the per-job scratch space and garbage collection counters. """
+    return jsonify(scratch.stats())
+
+@app.route('/stats/mail', methods=['GET'])
+def mail_stats():
+    """ Batching, retry and rate-limit counters of the Mailjet dispatcher. """
+    return jsonify(get_mail_dispatcher().metrics())
+
+@app.route('/stats/limits', methods=['GET'])
+def limit_stats():
+    """ Adaptive concurrency limits, waits and 429 counts per external provider. """
+    return jsonify(limiter.metrics())
+
+@app.route('/stats/resilience', methods=['GET'])
+def resilience_stats():
+    """ Circuit breaker state, retries and call deadlines per external dependency. """
+    return jsonify(resilience.metrics())
+
+@app.route('/stats/workers', methods=['GET'])
+def worker_stats():
+    """ Live worker pools of every process, as last reported by their heartbeats. """
+    return jsonify(get_coordinator().members())
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    """ Hit/miss statistics for the script, image and voice-over cache. """
+    return jsonify(cache.stats())
+
 # New route to serve temporary files
 @app.route('/temp_files/<path:filename>')
 def serve_temp_file(filename):
-    print(f"[*] Serving temporary file: {filename}")
-    sys.stdout.flush()
-    return send_from_directory('/tmp', filename)
+    """
+    Serves a generated file without loading it into memory. By Flask's
+    defaults the response supports HTTP Range requests and conditional GETs
+    (with an ETag), and the body is handed to the server's file wrapper,
+    which gunicorn sends with sendfile(2). With USE_X_SENDFILE=1 a fronting
+    nginx/Apache serves the file instead.
+    Only the scratch space is exposed, not the rest of /tmp.
+    """
+    log("debug", "Serving temporary file.", filename=filename)
+    return send_from_directory(scratch.root, filename)
+
+@app.route('/artifacts/<artifact_id>')
+def serve_artifact(artifact_id):
+    """
+    Serves a video merged by the local backend to holders of a valid signed
+    URL, with the same Range and conditional GET support as /temp_files.
+    """
+    store = get_artifact_store()
+    if not store.verify(artifact_id, request.args.get('expires'), request.args.get('sig')):
+        return jsonify({"error": "Invalid or expired link"}), 403
+    path, metadata = store.open_object(artifact_id)
+    if path is None:
+        return jsonify({"error": "Not found"}), 404
+    return send_file(path, mimetype=metadata["content_type"], conditional=True, etag=artifact_id)
 
 if __name__ == '__main__':
     # Get port from environment variable or default to 5000
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    create_app().run(host='0.0.0.0', port=port)
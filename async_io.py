@@ -0,0 +1,94 @@
+import os
+import asyncio
+import threading
+
+import httpx
+from openai import AsyncOpenAI
+
+from http_session import (
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_POOL_MAXSIZE, HTTP_POOL_SIZES, OPENAI_TIMEOUT, parse_pool_sizes,
+    count_bytes,
+)
+
+# Upper bound on concurrent connections held by the shared httpx client.
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 200))
+
+try:
+    import h2 # noqa: F401 -- httpx only speaks HTTP/2 when the h2 package is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_lock = threading.Lock()
+_loop = None
+_http_client = None
+_openai_client = None
+
+
+def get_loop():
+    """
+    Returns the process-wide event loop, starting it in a daemon thread on
+    first use. Every async job in the process runs on this single loop.
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="async-io-loop", daemon=True)
+            thread.start()
+            _loop = loop
+    return _loop
+
+
+def submit(coro):
+    """Schedules a coroutine on the shared loop and returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro):
+    """Runs a coroutine on the shared loop and blocks the calling thread until it finishes."""
+    return submit(coro).result()
+
+
+async def _count_bytes(response):
+    sent = response.request.headers.get("Content-Length")
+    count_bytes(response.request.url.host, int(sent) if sent and sent.isdigit() else 0,
+                response.headers.get("Content-Length"))
+
+
+def get_http_client():
+    """
+    Returns the shared httpx.AsyncClient. Must be called from the shared loop.
+    It uses HTTP/2 when available and the same per-host pool sizes and
+    timeouts as the synchronous session in http_session.
+    """
+    global _http_client
+    if _http_client is None:
+        mounts = {
+            f"all://{host}": httpx.AsyncHTTPTransport(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+            )
+            for host, size in parse_pool_sizes(HTTP_POOL_SIZES).items()
+        }
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=HTTP_POOL_MAXSIZE),
+            mounts=mounts,
+            follow_redirects=True,
+            event_hooks={"response": [_count_bytes]},
+        )
+    return _http_client
+
+
+def get_openai_client():
+    """
+    Returns the shared AsyncOpenAI client. It picks up OPENAI_API_KEY from the
+    environment and leaves retries to the rate limiter and the resilience
+    layer, like the synchronous client in content_generator.
+    """
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(http_client=get_http_client(), max_retries=0, timeout=OPENAI_TIMEOUT)
+    return _openai_client
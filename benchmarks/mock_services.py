@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Latencies (mean, jitter) in seconds and payload sizes of the real services,
+# as observed in production. time_scale shrinks every latency (and raises
+# every rate limit accordingly) so a benchmark runs in minutes, not hours.
+DEFAULT_PROFILE = {
+    "chat": {"latency": (4.0, 1.5), "rpm": 500},
+    "image": {"latency": (12.0, 3.0), "rpm": 5, "bytes": 3 * 1024 * 1024},
+    # ElevenLabs streams ~1.1 KB of 128 kbps MP3 per character, after a
+    # first-byte delay, about four times faster than real time
+    "tts": {"latency": (1.0, 0.3), "seconds_per_char": 0.017, "bytes_per_char": 1100, "concurrency": 4},
+    "merge": {"latency": (20.0, 5.0), "slots": 2, "video_bytes": 6 * 1024 * 1024},
+    "mail": {"latency": (0.4, 0.1), "rpm": 300},
+}
+
+_BLOCK = os.urandom(256 * 1024) # the body of every generated file, repeated
+_CHUNK = 64 * 1024
+# One MPEG-1 layer III frame (128 kbps, 44.1 kHz, joint stereo) with a random
+# body, repeated: the TTS audio, which the agent joins frame by frame.
+_MP3_FRAME = b"\xff\xfb\x90\x64" + os.urandom(144 * 128000 // 44100 - 4)
+_MP3_BLOCK = _MP3_FRAME * (_CHUNK // len(_MP3_FRAME))
+
+
+def _delay(latency, scale):
+    mean, jitter = latency
+    return max(0.0, random.uniform(mean - jitter, mean + jitter)) * scale
+
+
+class _Bucket:
+    """Requests per minute, scaled; take() returns the Retry-After when empty."""
+
+    def __init__(self, rpm, scale):
+        self.rate = rpm / 60.0 / scale
+        self.capacity = max(1.0, self.rate * 10 * scale) # ten (real) seconds of burst
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.level >= 1:
+                self.level -= 1
+                return None
+            return (1 - self.level) / self.rate
+
+
+class MockServices:
+    """
+    Local stand-ins for OpenAI, the ElevenLabs proxy, the video merger and
+    Mailjet on one HTTP port, with the latency, payload sizes and 429s of
+    DEFAULT_PROFILE. Routes:
+
+        POST /openai/v1/chat/completions, /openai/v1/images/generations
+        POST /elevenlabs
+        POST /merger/merge, /merger/jobs; GET, DELETE /merger/jobs/<id>
+        POST /mailjet/v3.1/send
+        GET, HEAD /files/<kind>/<name>  (generated images and videos)
+        GET /files/real/<name>          (real media from `media_dir`, for FFmpeg)
+        GET /stats                      (requests and 429s per service)
+    """
+
+    def __init__(self, time_scale=1.0, profile=None, media_dir=None, host="127.0.0.1", port=0):
+        self.scale = time_scale
+        self.profile = {name: dict(settings) for name, settings in DEFAULT_PROFILE.items()}
+        for name, settings in (profile or {}).items():
+            self.profile[name].update(settings)
+        self.media_dir = media_dir
+        self.buckets = {name: _Bucket(s["rpm"], time_scale) for name, s in self.profile.items() if s.get("rpm")}
+        self.tts_slots = threading.BoundedSemaphore(self.profile["tts"]["concurrency"])
+        self.merge_slots = threading.BoundedSemaphore(self.profile["merge"]["slots"])
+        self.merge_jobs = {}
+        self.stats = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, service, key="requests"):
+        with self._lock:
+            stats = self.stats.setdefault(service, {"requests": 0, "throttled": 0})
+            stats[key] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+    def _handler_class(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, like the real APIs
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _json(self, status, payload, headers=None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _throttled(self, service):
+                services.count(service)
+                bucket = services.buckets.get(service)
+                retry_after = bucket.take() if bucket else None
+                if retry_after is None:
+                    return False
+                services.count(service, "throttled")
+                self._json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit"}},
+                           {"Retry-After": f"{retry_after:.2f}"})
+                return True
+
+            def _stream(self, size, content_type, pace=0.0, head=False, block=_BLOCK):
+                """Sends `size` bytes of `block` over and over, sleeping `pace` seconds per chunk."""
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                if head:
+                    return
+                sent = 0
+                while sent < size:
+                    chunk = block[:min(_CHUNK, len(block), size - sent)]
+                    if pace:
+                        time.sleep(pace)
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if parts == ["stats"]:
+                    return self._json(200, services.snapshot())
+                if len(parts) == 3 and parts[0] == "files":
+                    kind, name = parts[1], parts[2]
+                    if kind == "real" and services.media_dir:
+                        path = os.path.join(services.media_dir, os.path.basename(name))
+                        if os.path.isfile(path):
+                            with open(path, "rb") as f:
+                                data = f.read()
+                            self.send_response(200)
+                            self.send_header("Content-Length", str(len(data)))
+                            self.end_headers()
+                            if not head:
+                                self.wfile.write(data)
+                            return
+                    elif kind == "image":
+                        return self._stream(services.profile["image"]["bytes"], "image/png", head=head)
+                    elif kind == "video":
+                        return self._stream(services.profile["merge"]["video_bytes"], "video/mp4", head=head)
+                if len(parts) == 3 and parts[:2] == ["merger", "jobs"]:
+                    return self._merge_job_status(parts[2])
+                self._json(404, {"error": "Not found"})
+
+            def do_DELETE(self):
+                parts = self.path.strip("/").split("/")
+                job = services.merge_jobs.pop(parts[-1], None)
+                self._json(200 if job else 404, {"job_id": parts[-1], "status": "cancelled"})
+
+            def do_POST(self):
+                body = self._body()
+                path = self.path.split("?")[0].rstrip("/")
+                if path == "/openai/v1/chat/completions":
+                    return self._chat(json.loads(body))
+                if path == "/openai/v1/images/generations":
+                    return self._image()
+                if path == "/elevenlabs":
+                    return self._tts(json.loads(body))
+                if path == "/merger/merge":
+                    return self._merge()
+                if path == "/merger/jobs":
+                    return self._submit_merge_job()
+                if path == "/mailjet/v3.1/send":
+                    return self._mail(json.loads(body))
+                self._json(404, {"error": "Not found"})
+
+            def _chat(self, request):
+                if self._throttled("chat"):
+                    return
+                time.sleep(_delay(services.profile["chat"]["latency"], services.scale))
+                # Distinct sentences, so cached voice chunks do not hide the TTS work
+                words = " ".join(f"Discover what makes moment {random.getrandbits(32)} count." for _ in range(18))
+                self._json(200, {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+                    "model": request.get("model", "gpt-4-turbo"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": words},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 200, "completion_tokens": 140, "total_tokens": 340},
+                })
+
+            def _image(self):
+                if self._throttled("image"):
+                    return
+                time.sleep(_delay(services.profile["image"]["latency"], services.scale))
+                self._json(200, {"created": int(time.time()),
+                                 "data": [{"url": f"{services.url}/files/image/{uuid.uuid4().hex}.png"}]})
+
+            def _tts(self, request):
+                services.count("tts")
+                profile = services.profile["tts"]
+                with services.tts_slots:
+                    time.sleep(_delay(profile["latency"], services.scale))
+                    characters = len(request.get("text", ""))
+                    size = max(1, characters * profile["bytes_per_char"] // len(_MP3_FRAME)) * len(_MP3_FRAME)
+                    chunks = max(1, size // len(_MP3_BLOCK))
+                    self._stream(size, "audio/mpeg", characters * profile["seconds_per_char"] * services.scale / chunks,
+                                 block=_MP3_BLOCK)
+
+            def _merge(self):
+                services.count("merge")
+                with services.merge_slots:
+                    time.sleep(_delay(services.profile["merge"]["latency"], services.scale))
+                self._json(200, {"video_url": f"{services.url}/files/video/{uuid.uuid4().hex}.mp4"})
+
+            def _submit_merge_job(self):
+                services.count("merge")
+                job_id = uuid.uuid4().hex
+                ready_at = time.monotonic() + _delay(services.profile["merge"]["latency"], services.scale)
+                services.merge_jobs[job_id] = ready_at
+                self._json(202, {"job_id": job_id, "status": "queued",
+                                 "status_url": f"{services.url}/merger/jobs/{job_id}"})
+
+            def _merge_job_status(self, job_id):
+                ready_at = services.merge_jobs.get(job_id)
+                if ready_at is None:
+                    return self._json(404, {"error": "Unknown job"})
+                if time.monotonic() < ready_at:
+                    return self._json(200, {"job_id": job_id, "status": "running"})
+                video_url = f"{services.url}/files/video/{job_id}.mp4"
+                self._json(200, {"job_id": job_id, "status": "done", "video_url": video_url, "result_url": video_url})
+
+            def _mail(self, request):
+                if self._throttled("mail"):
+                    return
+                time.sleep(_delay(services.profile["mail"]["latency"], services.scale))
+                self._json(200, {"Messages": [
+                    {"Status": "success", "To": [{"Email": to["Email"], "MessageID": random.getrandbits(48)}
+                                                 for to in message.get("To", [])]}
+                    for message in request.get("Messages", [])
+                ]})
+
+        return Handler
@@ -0,0 +1,373 @@
+"""
+Offline benchmarks of the agent and the merger against local stand-ins for
+OpenAI, ElevenLabs, Mailjet and the merger (see mock_services.py). Run from
+the repository root:
+
+    python -m benchmarks.run pipeline --jobs 40 --concurrency 8
+    python -m benchmarks.run webhook --jobs 200 --concurrency 32
+    python -m benchmarks.run merge --jobs 8 --concurrency 4     # needs ffmpeg
+
+Each run reports throughput, latency percentiles, peak RSS, peak open file
+descriptors and threads. --save-baseline stores the results under
+benchmarks/baselines/<scenario>.json; later runs compare against it and
+exit with status 1 when a metric regressed by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.mock_services import MockServices
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MERGER_DIR = os.path.join(ROOT, "Gemini", "video-merger")
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+# Metrics compared against a baseline, and whether higher is better.
+COMPARED = {
+    "throughput_per_minute": True,
+    "latency_p50": False,
+    "latency_p95": False,
+    "latency_p99": False,
+    "peak_rss_mb": False,
+    "peak_fds": False,
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ResourceSampler:
+    """Samples RSS, open file descriptors and threads of this process in the background."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_fds = 0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+
+    def _sample(self):
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        self.peak_rss = max(self.peak_rss, int(line.split()[1]) * 1024)
+            self.peak_fds = max(self.peak_fds, len(os.listdir("/proc/self/fd")))
+        except OSError:
+            # No procfs (macOS): fall back to the peak RSS the kernel tracks
+            self.peak_rss = max(self.peak_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def configure_agent(mocks, workdir, args):
+    """Points the agent at the mocks. Must run before any agent module is imported."""
+    os.environ.update({
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"{mocks.url}/openai/v1",
+        "ELEVENLABS_PROXY_URL": f"{mocks.url}/elevenlabs",
+        "VIDEO_MERGER_URL": f"{mocks.url}/merger/merge",
+        "VIDEO_MERGER_JOBS_URL": f"{mocks.url}/merger/jobs",
+        "MERGER_POLL_INTERVAL": str(max(0.05, 2 * args.time_scale)),
+        "MAILJET_SEND_URL": f"{mocks.url}/mailjet/v3.1/send",
+        "MAILJET_API_KEY": "benchmark",
+        "MAILJET_API_SECRET": "benchmark",
+        "SENDER_EMAIL": "benchmark@example.com",
+        "EMAIL_PREVIEW_ENABLED": "0",
+        "MERGE_BACKEND": args.merge_backend,
+        "PIPELINE_MODE": args.mode,
+        "JOB_WORKERS": str(args.concurrency),
+        "ASYNC_MAX_IN_FLIGHT": str(args.concurrency),
+        "JOB_QUEUE_MAX": str(max(args.jobs, 100)),
+        "JOB_QUEUE_DB": os.path.join(workdir, "jobs.db"),
+        "CONTENT_CACHE_DIR": os.path.join(workdir, "cache"),
+        "SCRATCH_ROOT": os.path.join(workdir, "scratch"),
+        "RENDER_EXTERNAL_HOSTNAME": "http://127.0.0.1:5000",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "warning"),
+    })
+    sys.path.insert(0, ROOT)
+
+
+def brief(index):
+    """A distinct brief per job, so the content cache does not hide the work."""
+    return {
+        "projectName": f"Benchmark {index}",
+        "videoGoal": "Promote our new analytics platform.",
+        "centralMessage": f"Unlock the power of your data, variant {index}.",
+        "tone": "Inspiring and professional",
+        "targetAudience": "Tech startups",
+        "callToAction": "Request a demo today.",
+        "email": f"bench{index}@example.com",
+    }
+
+
+def tally_payload(index):
+    from tally_schema import DEFAULT_LABELS
+
+    form_data = brief(index)
+    return {
+        "eventId": uuid.uuid4().hex,
+        "data": {"formId": "benchmark", "fields": [
+            {"key": f"question_{key}", "label": label, "type": "INPUT_TEXT", "value": form_data[key]}
+            for label, key in DEFAULT_LABELS.items()
+        ]},
+    }
+
+
+def run_pipeline(args):
+    """Calls create_video_task directly, `concurrency` jobs at a time."""
+    import app
+
+    latencies, errors = [], []
+
+    def one(index):
+        start = time.monotonic()
+        try:
+            if args.mode == "async":
+                import async_io
+                async_io.run(app.create_video_task_async(brief(index)))
+            else:
+                app.create_video_task(brief(index))
+            latencies.append(time.monotonic() - start)
+        except Exception as e:
+            errors.append(str(e))
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(args.jobs)))
+    return latencies, errors, {"stages": _stage_latencies()}
+
+
+def run_webhook(args):
+    """
+    Posts Tally submissions to /webhook/tally, `concurrency` at a time, and
+    waits for the worker pool to finish every job. Latency is measured from
+    the webhook call to the end of the job; the webhook's own response time
+    is reported separately.
+    """
+    import app
+
+    client = app.create_app().test_client
+    submitted, webhook_latencies, errors = {}, [], []
+    lock = threading.Lock()
+
+    def post(index):
+        start = time.monotonic()
+        response = client().post("/webhook/tally", json=tally_payload(index))
+        webhook_latencies.append(time.monotonic() - start)
+        body = response.get_json() or {}
+        if response.status_code != 200 or "job_id" not in body:
+            errors.append(f"HTTP {response.status_code}: {body.get('message')}")
+            return
+        with lock:
+            submitted[body["job_id"]] = start
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(post, range(args.jobs)))
+
+    latencies = []
+    deadline = time.monotonic() + args.timeout
+    pending = dict(submitted)
+    while pending and time.monotonic() < deadline:
+        for job_id in list(pending):
+            job = app.job_queue.get(job_id)
+            if job["status"] in ("done", "failed"):
+                latencies.append(time.monotonic() - pending.pop(job_id))
+                if job["status"] == "failed":
+                    errors.append(job["error"])
+        time.sleep(0.05)
+    errors.extend(f"Job {job_id} still unfinished after {args.timeout}s." for job_id in pending)
+    return latencies, errors, {
+        "webhook_p50": _round(percentile(webhook_latencies, 0.5)),
+        "webhook_p99": _round(percentile(webhook_latencies, 0.99)),
+        "stages": _stage_latencies(),
+    }
+
+
+def make_media(directory):
+    """Creates a real MP3 and PNG for the merger to encode. Requires ffmpeg."""
+    if shutil.which("ffmpeg") is None:
+        raise SystemExit("The merge benchmark needs ffmpeg on the PATH.")
+    audio = os.path.join(directory, "voice.mp3")
+    image = os.path.join(directory, "background.png")
+    quiet = ["-hide_banner", "-loglevel", "error", "-y"]
+    subprocess.run(["ffmpeg", *quiet, "-f", "lavfi", "-i", "sine=frequency=220:duration=45",
+                    "-b:a", "128k", audio], check=True)
+    subprocess.run(["ffmpeg", *quiet, "-f", "lavfi", "-i", "testsrc2=size=1792x1024",
+                    "-frames:v", "1", image], check=True)
+
+
+def run_merge(args, mocks):
+    """Posts to the real merger's /merge, with inputs served by the mocks."""
+    sys.path.insert(0, MERGER_DIR)
+    import server
+
+    client = server.app.test_client
+    # Unique query strings defeat the merger's asset cache, like new jobs would
+    latencies, errors = [], []
+
+    def one(index):
+        payload = {"audio_url": f"{mocks.url}/files/real/voice.mp3?job={index}",
+                   "image_url": f"{mocks.url}/files/real/background.png?job={index}"}
+        start = time.monotonic()
+        response = client().post("/merge", json=payload)
+        if response.status_code == 200:
+            latencies.append(time.monotonic() - start)
+        else:
+            errors.append(f"HTTP {response.status_code}: {(response.get_json() or {}).get('error')}")
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(args.jobs)))
+    return latencies, errors, {"stages": _stage_latencies(server.registry)}
+
+
+def _stage_latencies(registry=None):
+    if registry is None:
+        from observability import registry
+    summary = registry.latency_summary()
+    stages = {}
+    for name in ("pipeline_stage_seconds", "outbound_call_seconds", "merge_ffmpeg_seconds",
+                 "merge_download_seconds", "merge_queue_wait_seconds"):
+        for entry in summary.get(name, []):
+            label = ",".join(f"{k}={v}" for k, v in entry["labels"].items() if k != "outcome")
+            stages[f"{name}{{{label}}}"] = {"count": entry["count"], "p50": entry["p50"], "p95": entry["p95"]}
+    return stages
+
+
+def _round(value, digits=3):
+    return round(value, digits) if value is not None else None
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions of results against a baseline."""
+    regressions = []
+    if baseline.get("params") != results["params"]:
+        print(f"[!] Baseline was recorded with different parameters: {baseline.get('params')}")
+    for metric, higher_is_better in COMPARED.items():
+        old, new = baseline.get("results", {}).get(metric), results["results"].get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f"{metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the video pipeline against local mock services.")
+    parser.add_argument("scenario", choices=["pipeline", "webhook", "merge"])
+    parser.add_argument("--jobs", type=int, default=20, help="number of videos (default: 20)")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs in flight at once (default: 4)")
+    parser.add_argument("--time-scale", type=float, default=0.05,
+                        help="factor applied to the services' real latencies (default: 0.05)")
+    parser.add_argument("--mode", choices=["threads", "async"], default="threads", help="PIPELINE_MODE")
+    parser.add_argument("--merge-backend", choices=["remote", "jobs"], default="remote", help="MERGE_BACKEND")
+    parser.add_argument("--profile", help="JSON overrides of mock_services.DEFAULT_PROFILE")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for queued jobs")
+    parser.add_argument("--baseline", help="baseline file (default: benchmarks/baselines/<scenario>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="relative change tolerated before a metric counts as regressed (default: 0.15)")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="video-agent-bench-")
+    profile = json.loads(args.profile) if args.profile else None
+    mocks = MockServices(args.time_scale, profile, media_dir=workdir).start()
+    try:
+        if args.scenario == "merge":
+            make_media(workdir)
+            os.environ.setdefault("ARTIFACT_STORE_DIR", os.path.join(workdir, "artifacts"))
+            os.environ.setdefault("ASSET_CACHE_DIR", os.path.join(workdir, "assets"))
+        else:
+            configure_agent(mocks, workdir, args)
+
+        start = time.monotonic()
+        with ResourceSampler() as sampler:
+            if args.scenario == "pipeline":
+                latencies, errors, extra = run_pipeline(args)
+            elif args.scenario == "webhook":
+                latencies, errors, extra = run_webhook(args)
+            else:
+                latencies, errors, extra = run_merge(args, mocks)
+        wall = time.monotonic() - start
+    finally:
+        mocks.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "scenario": args.scenario,
+        "params": {"jobs": args.jobs, "concurrency": args.concurrency, "time_scale": args.time_scale,
+                   "mode": args.mode, "merge_backend": args.merge_backend, "profile": profile},
+        "results": {
+            "completed": len(latencies),
+            "errors": len(errors),
+            "wall_seconds": _round(wall),
+            "throughput_per_minute": _round(len(latencies) / wall * 60 if wall else 0.0),
+            "latency_p50": _round(percentile(latencies, 0.5)),
+            "latency_p95": _round(percentile(latencies, 0.95)),
+            "latency_p99": _round(percentile(latencies, 0.99)),
+            "latency_max": _round(max(latencies) if latencies else None),
+            "peak_rss_mb": _round(sampler.peak_rss / 1024 / 1024, 1),
+            "peak_fds": sampler.peak_fds,
+            "peak_threads": sampler.peak_threads,
+        },
+        "mock_services": mocks.snapshot(),
+    }
+    results["results"].update({k: v for k, v in extra.items() if k != "stages"})
+    results["stages"] = extra.get("stages", {})
+
+    print(json.dumps(results, indent=2))
+    for error in errors[:10]:
+        print(f"[!] {error}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f"{args.scenario}.json")
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump({k: results[k] for k in ("scenario", "params", "results")}, f, indent=2)
+        print(f"[*] Baseline saved to {baseline_path}")
+        return 0
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[!] Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"[*] No regression against {baseline_path}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import os
+import io
+import csv
+import sys
+import json
+import time
+import uuid
+import argparse
+
+from tally_schema import DEFAULT_LABELS, normalize_label
+from idempotency import submission_keys
+
+# Largest campaign accepted in one upload.
+BULK_MAX_ROWS = int(os.environ.get("BULK_MAX_ROWS", 1000))
+# How often the progress stream checks the job table.
+BULK_PROGRESS_INTERVAL = float(os.environ.get("BULK_PROGRESS_INTERVAL", 1.0))
+
+FORM_KEYS = list(DEFAULT_LABELS.values())
+# Column names accepted for each form_data key: the key itself, its
+# snake_case form, or the question label of the Tally form.
+_COLUMNS = {}
+for _label, _key in DEFAULT_LABELS.items():
+    _COLUMNS[normalize_label(_key)] = _key
+    _COLUMNS[normalize_label("".join(f"_{c.lower()}" if c.isupper() else c for c in _key))] = _key
+    _COLUMNS[normalize_label(_label)] = _key
+
+FINISHED = ("done", "failed")
+
+
+class BriefError(ValueError):
+    """Raised for an upload that cannot be read as a list of briefs."""
+
+
+def parse_briefs(text, fmt=None):
+    """
+    Reads a campaign file into a list of form_data dicts, one per brief.
+    fmt is "csv" or "jsonl"; by default it is guessed from the first character.
+    Unknown columns are ignored.
+    """
+    fmt = fmt or ("jsonl" if text.lstrip().startswith("{") else "csv")
+    if fmt == "jsonl":
+        rows = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError as e:
+                raise BriefError(f"Line {number} is not valid JSON: {e}")
+    elif fmt == "csv":
+        rows = list(csv.DictReader(io.StringIO(text)))
+    else:
+        raise BriefError(f"Unknown format '{fmt}', expected csv or jsonl.")
+
+    if len(rows) > BULK_MAX_ROWS:
+        raise BriefError(f"{len(rows)} briefs exceed the limit of {BULK_MAX_ROWS} per upload.")
+    briefs = []
+    for row in rows:
+        if not isinstance(row, dict):
+            raise BriefError("Every brief must be an object.")
+        brief = {}
+        for column, value in row.items():
+            key = _COLUMNS.get(normalize_label(column or ""))
+            if key and value not in (None, ""):
+                brief[key] = str(value).strip()
+        briefs.append(brief)
+    return briefs
+
+
+def submit_batch(queue, briefs, priority=None):
+    """
+    Queues the briefs as one batch, in the given priority class (the bulk
+    class by default). Identical briefs collapse into a single job; briefs
+    without an email are rejected. Returns the batch summary:
+    {"batch_id", "jobs": [{"row", "job_id"}], "rejected": [{"row", "error"}]}.
+    """
+    batch_id = uuid.uuid4().hex
+    rows, payloads, rejected, seen = [], [], [], {}
+    for row, brief in enumerate(briefs, 1):
+        if not brief.get("email"):
+            rejected.append({"row": row, "error": "Missing email."})
+            continue
+        key = submission_keys({}, brief)[-1][1]
+        if key not in seen:
+            seen[key] = len(payloads)
+            payloads.append(brief)
+        rows.append((row, seen[key]))
+
+    job_ids = queue.enqueue_batch(payloads, batch_id, priority) if payloads else []
+    return {
+        "batch_id": batch_id,
+        "jobs": [{"row": row, "job_id": job_ids[index]} for row, index in rows],
+        "unique_jobs": len(job_ids),
+        "rejected": rejected,
+    }
+
+
+def batch_status(queue, batch_id):
+    """ Counts the jobs of a batch per status, or None if the batch is unknown. """
+    jobs = queue.batch_jobs(batch_id)
+    if not jobs:
+        return None
+    counts = {}
+    for job in jobs:
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    return {"batch_id": batch_id, "jobs": len(jobs), "counts": counts,
+            "finished": all(job["status"] in FINISHED for job in jobs)}
+
+
+def stream_progress(queue, batch_id, interval=BULK_PROGRESS_INTERVAL):
+    """
+    Yields one NDJSON line per job as it finishes, then a summary line once
+    the whole batch is done.
+    """
+    reported = set()
+    start = time.monotonic()
+    while True:
+        jobs = queue.batch_jobs(batch_id)
+        for job in jobs:
+            if job["status"] in FINISHED and job["id"] not in reported:
+                reported.add(job["id"])
+                yield json.dumps({"job_id": job["id"], "status": job["status"], "error": job["error"],
+                                  "finished": len(reported), "total": len(jobs)}) + "\n"
+        if len(reported) == len(jobs):
+            summary = batch_status(queue, batch_id) or {"batch_id": batch_id, "jobs": 0}
+            summary["seconds"] = round(time.monotonic() - start, 1)
+            yield json.dumps(summary) + "\n"
+            return
+        time.sleep(interval)
+
+
+def main(argv=None):
+    """
+    Uploads a campaign file to a running agent and prints its progress:
+
+        python bulk.py campaign.csv --url https://your-agent.onrender.com
+    """
+    import requests
+
+    parser = argparse.ArgumentParser(description="Generate a batch of videos from a CSV or JSONL file of briefs.")
+    parser.add_argument("file", help="CSV with a header row, or JSON Lines; one brief per row")
+    parser.add_argument("--url", default=os.environ.get("AGENT_URL", "http://localhost:5000"),
+                        help="base URL of the agent (default: $AGENT_URL or http://localhost:5000)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="file format (guessed by default)")
+    parser.add_argument("--priority", help="priority class of the batch (default: the bulk class)")
+    parser.add_argument("--priority-key", default=os.environ.get("PRIORITY_KEY"),
+                        help="the agent's PRIORITY_KEY, needed for --priority (default: $PRIORITY_KEY)")
+    parser.add_argument("--no-wait", action="store_true", help="submit and exit without following progress")
+    args = parser.parse_args(argv)
+
+    with open(args.file, encoding="utf-8") as f:
+        body = f.read()
+    params = {key: value for key, value in (("format", args.format), ("priority", args.priority)) if value}
+    headers = {"Content-Type": "text/plain; charset=utf-8"}
+    if args.priority and args.priority_key:
+        headers["X-Priority-Key"] = args.priority_key
+    response = requests.post(f"{args.url.rstrip('/')}/bulk", data=body.encode("utf-8"), params=params,
+                             headers=headers)
+    summary = response.json()
+    if response.status_code != 202:
+        print(f"[!] Upload rejected ({response.status_code}): {summary.get('message')}")
+        return 1
+    print(f"[*] Batch {summary['batch_id']}: {len(summary['jobs'])} brief(s), "
+          f"{summary['unique_jobs']} unique job(s), {len(summary['rejected'])} rejected.")
+    for rejected in summary["rejected"]:
+        print(f"[!] Row {rejected['row']}: {rejected['error']}")
+    sys.stdout.flush()
+    if args.no_wait:
+        return 0
+
+    with requests.get(summary["progress_url"], stream=True) as progress:
+        for line in progress.iter_lines():
+            if line:
+                print(line.decode("utf-8"))
+                sys.stdout.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
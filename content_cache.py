@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import shutil
+import struct
+import hashlib
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Where cached scripts, image URLs and voice-overs are stored on disk.
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR", "/tmp/video-agent-cache")
+# Total size of the disk tier before least recently used entries are evicted.
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+# Number of entries kept in the in-memory tier (0 disables it), and the largest
+# value it will hold so that voice-overs do not pin megabytes of RAM.
+CONTENT_CACHE_MEMORY_ITEMS = int(os.environ.get("CONTENT_CACHE_MEMORY_ITEMS", 256))
+CONTENT_CACHE_MEMORY_MAX_ITEM = int(os.environ.get("CONTENT_CACHE_MEMORY_MAX_ITEM", 64 * 1024))
+# Set to 0 to turn the cache off entirely.
+CONTENT_CACHE_ENABLED = os.environ.get("CONTENT_CACHE_ENABLED", "1") != "0"
+
+# Time-to-live per kind of content, in seconds. DALL·E image URLs expire after
+# about an hour, so TTL_IMAGE is how long a URL is trusted after it was issued.
+TTL_SCRIPT = int(os.environ.get("CONTENT_CACHE_TTL_SCRIPT", 30 * 24 * 3600))
+TTL_IMAGE = int(os.environ.get("CONTENT_CACHE_TTL_IMAGE", 50 * 60))
+TTL_VOICE = int(os.environ.get("CONTENT_CACHE_TTL_VOICE", 30 * 24 * 3600))
+# An image URL is only handed to a job while it stays valid for at least this
+# long, so that the voice-over and the merge finish before it expires.
+IMAGE_URL_MIN_LIFE = int(os.environ.get("CONTENT_CACHE_IMAGE_MIN_LIFE", 20 * 60))
+
+_HEADER = struct.Struct(">d") # expiry timestamp stored in front of every disk entry
+# A temporary file of a put older than this was left behind by a crash.
+_STALE_TMP_SECONDS = 3600
+
+
+def _normalize(value):
+    """Normalizes prompt inputs so cosmetic differences hash to the same key."""
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def cache_key(namespace, params):
+    """
+    Returns the content address for a request: a SHA-256 of the namespace and
+    the normalized request parameters (prompt inputs and model settings).
+    """
+    canonical = json.dumps([namespace, _normalize(params)], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ContentCache:
+    """
+    A two-tier content-addressed cache: a small LRU dict in memory in front of
+    files on disk. Disk entries carry their own expiry, and the disk tier is
+    kept under a byte budget by evicting the least recently used files (the
+    file mtime is refreshed on every hit).
+    """
+
+    def __init__(self, directory=CONTENT_CACHE_DIR, max_bytes=CONTENT_CACHE_MAX_BYTES,
+                 memory_items=CONTENT_CACHE_MEMORY_ITEMS, memory_max_item=CONTENT_CACHE_MEMORY_MAX_ITEM):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory_max_item = memory_max_item
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0, "expired": 0,
+                       "coalesced": 0}
+        self._flights = {} # key -> Future of the computation in progress
+        self._async_flights = {} # same, for coroutines on the shared event loop
+        self._disk_bytes = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, namespace, params):
+        """Returns the cached bytes for a request, or None on a miss."""
+        key = cache_key(namespace, params)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires_at, = _HEADER.unpack(f.read(_HEADER.size))
+                if expires_at <= now:
+                    value = None
+                else:
+                    value = f.read()
+        except (OSError, struct.error):
+            self._count("misses")
+            return None
+
+        if value is None:
+            self._remove(path)
+            self._count("expired")
+            self._count("misses")
+            return None
+
+        try:
+            os.utime(path) # mark as recently used for LRU eviction
+        except OSError:
+            pass
+        self._remember(key, expires_at, value)
+        self._count("disk_hits")
+        return value
+
+    def put(self, namespace, params, value, ttl):
+        """Stores bytes for a request with the given time-to-live in seconds."""
+        key = cache_key(namespace, params)
+        expires_at = time.time() + ttl
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(expires_at))
+            f.write(value)
+        os.replace(tmp_path, path) # atomic, so readers never see a partial entry
+        self._remember(key, expires_at, value)
+        self._count("writes")
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += _HEADER.size + len(value)
+            over_budget = self._disk_bytes is None or self._disk_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def get_file(self, namespace, params, dest_path):
+        """
+        Copies a cached entry to dest_path without loading it into memory.
+        Returns True on a hit, False on a miss. Used for audio files.
+        """
+        key = cache_key(namespace, params)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expires_at, = _HEADER.unpack(f.read(_HEADER.size))
+                if expires_at <= time.time():
+                    self._remove(path)
+                    self._count("expired")
+                    self._count("misses")
+                    return False
+                with open(dest_path, "wb") as out:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+            os.utime(path)
+        except (OSError, struct.error):
+            self._count("misses")
+            return False
+        self._count("disk_hits")
+        return True
+
+    def put_file(self, namespace, params, src_path, ttl):
+        """Stores the contents of a file on disk only, streaming it in chunks."""
+        key = cache_key(namespace, params)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(src_path, "rb") as src, open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(time.time() + ttl))
+            shutil.copyfileobj(src, f, 1024 * 1024)
+        os.replace(tmp_path, path)
+        self._count("writes")
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += os.path.getsize(path)
+            over_budget = self._disk_bytes is None or self._disk_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def get_or_compute(self, namespace, params, compute, ttl):
+        """
+        Returns the cached bytes for a request, calling compute() to fill a
+        miss. Concurrent misses for the same request share a single compute()
+        call: the first caller runs it and the others wait for its result, so
+        a batch of jobs with the same prompt costs one API call.
+        Returns (value, computed), computed being True for the caller that ran it.
+        """
+        value = self.get(namespace, params)
+        if value is not None:
+            return value, False
+        key = cache_key(namespace, params)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+            else:
+                self._stats["coalesced"] += 1
+        if not leader:
+            return flight.result(), False
+
+        try:
+            value = compute()
+            self.put(namespace, params, value, ttl)
+            flight.set_result(value)
+            return value, True
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    async def get_or_compute_async(self, namespace, params, compute, ttl):
+        """ Same as get_or_compute, for a coroutine function run on the shared event loop. """
+        value = self.get(namespace, params)
+        if value is not None:
+            return value, False
+        key = cache_key(namespace, params)
+        flight = self._async_flights.get(key)
+        if flight is not None:
+            self._count("coalesced")
+            return await asyncio.shield(flight), False
+
+        flight = self._async_flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await compute()
+            self.put(namespace, params, value, ttl)
+            flight.set_result(value)
+            return value, True
+        except BaseException as e:
+            flight.set_exception(e)
+            flight.exception() # retrieved, so a flight without waiters does not log a warning
+            raise
+        finally:
+            self._async_flights.pop(key, None)
+
+    def evict(self):
+        """
+        Removes expired entries, then the least recently used ones until the
+        disk tier fits within max_bytes again. The temporary files of puts in
+        progress are left alone.
+        """
+        now = time.time()
+        entries, total = [], 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    try:
+                        if os.stat(path).st_mtime < now - _STALE_TMP_SECONDS:
+                            os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    st = os.stat(path)
+                    with open(path, "rb") as f:
+                        expires_at, = _HEADER.unpack(f.read(_HEADER.size))
+                except (OSError, struct.error):
+                    continue
+                if expires_at <= now:
+                    if self._remove(path):
+                        self._count("expired")
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if self._remove(path):
+                total -= size
+                self._count("evictions")
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+    def _remember(self, key, expires_at, value):
+        if self.memory_items <= 0 or len(value) > self.memory_max_item:
+            return
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+class _DisabledCache(ContentCache):
+    """Stand-in used when CONTENT_CACHE_ENABLED=0: every lookup is a miss."""
+
+    def get(self, namespace, params):
+        self._count("misses")
+        return None
+
+    def put(self, namespace, params, value, ttl):
+        pass
+
+    def get_file(self, namespace, params, dest_path):
+        self._count("misses")
+        return False
+
+    def put_file(self, namespace, params, src_path, ttl):
+        pass
+
+
+cache = ContentCache() if CONTENT_CACHE_ENABLED else _DisabledCache()
@@ -1,20 +1,24 @@
 
 import os
+import json
+import time
 from openai import OpenAI
 
-# Initialize the OpenAI client
-# It will automatically use the OPENAI_API_KEY from your .env file
-client = OpenAI()
+import async_io
+import resilience
+from content_cache import cache, TTL_SCRIPT, TTL_IMAGE, IMAGE_URL_MIN_LIFE
+from http_session import OPENAI_TIMEOUT
+from rate_limiter import estimate_chat_tokens
+from observability import log
 
-def generate_script_and_image(project_name, video_goal, central_message, tone, target_audience, call_to_action):
-    """
-    Generates a video script using GPT-4 and a background image using DALL·E 3.
+# Initialize the OpenAI client
+# It will automatically use the OPENAI_API_KEY from your .env file.
+# Retries are left to the rate limiter, so that every 429 adjusts our pace,
+# and to the resilience layer for timeouts and server errors.
+client = OpenAI(max_retries=0, timeout=OPENAI_TIMEOUT)
 
-    Returns:
-        tuple: A tuple containing the generated script (str) and the image URL (str).
-    """
-    
-    # 1. Generate the video script
+def _script_request(project_name, video_goal, central_message, tone, target_audience, call_to_action):
+    """ Builds the chat completion parameters for the script, shared by the sync and async paths. """
     script_prompt = f"""
     You are a professional scriptwriter for short, impactful promotional videos.
     Create a script for a 30-60 second video based on the following details:
@@ -30,23 +34,18 @@ def generate_script_and_image(project_name, video_goal, central_message, tone, t
     
     Output ONLY the script text, without any titles, headings, or formatting.
     """
+    return {
+        "model": "gpt-4-turbo",
+        "messages": [
+            {"role": "system", "content": "You are a professional scriptwriter for short, impactful promotional videos."},
+            {"role": "user", "content": script_prompt}
+        ],
+        "temperature": 0.7,
+        "max_tokens": 250
+    }
 
-    try:
-        script_response = client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "You are a professional scriptwriter for short, impactful promotional videos."},
-                {"role": "user", "content": script_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=250
-        )
-        script = script_response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"[!] OpenAI Script Generation Error: {e}")
-        raise
-
-    # 2. Generate the background image
+def _image_request(project_name, central_message, tone):
+    """ Builds the image generation parameters, shared by the sync and async paths. """
     image_prompt = f"""
     Create a visually stunning, high-quality, professional background image for a promotional video. The image should be abstract and cinematic, subtly reflecting the following themes:
 
@@ -57,21 +56,133 @@ def generate_script_and_image(project_name, video_goal, central_message, tone, t
     The image must be clean, aesthetically pleasing, and suitable for overlaying text or a logo. Avoid any text or complex subjects. Focus on textures, gradients, and mood.
     Style: 16:9 aspect ratio, cinematic, high resolution.
     """
+    return {
+        "model": "dall-e-3",
+        "prompt": image_prompt,
+        "n": 1,
+        "size": "1792x1024",  # 16:9 aspect ratio
+        "quality": "standard"
+    }
 
-    try:
-        image_response = client.images.generate(
-            model="dall-e-3",
-            prompt=image_prompt,
-            n=1,
-            size="1792x1024",  # 16:9 aspect ratio
-            quality="standard"
-        )
-        image_url = image_response.data[0].url
-    except Exception as e:
-        print(f"[!] OpenAI Image Generation Error: {e}")
-        raise
-
-    return script, image_url
+def _issued_image(url):
+    """
+    Records when an image URL stops being trusted, counted from the moment
+    DALL·E issued it. The cache entry expires IMAGE_URL_MIN_LIFE earlier, so
+    a cached URL always has at least that long left.
+    """
+    return json.dumps({"url": url, "expires_at": time.time() + TTL_IMAGE}).encode("utf-8")
+
+def image_url_life(image):
+    """ Seconds an image returned by generate_image stays usable by a job, used as its checkpoint TTL. """
+    return image["expires_at"] - IMAGE_URL_MIN_LIFE - time.time()
+
+def generate_script(project_name, video_goal, central_message, tone, target_audience, call_to_action):
+    """
+    Generates a video script using GPT-4.
+    Concurrent jobs asking for the same script share one API call.
+
+    Returns:
+        str: The generated script.
+    """
+    script_request = _script_request(project_name, video_goal, central_message, tone, target_audience, call_to_action)
+
+    def compute():
+        try:
+            script_response = resilience.call(
+                "openai-chat",
+                lambda: client.chat.completions.create(**script_request, timeout=resilience.request_timeout(OPENAI_TIMEOUT)),
+                estimate_chat_tokens(script_request)
+            )
+            return script_response.choices[0].message.content.strip().encode("utf-8")
+        except Exception as e:
+            log("error", "OpenAI script generation failed.", error=str(e))
+            raise
+
+    script, computed = cache.get_or_compute("script", script_request, compute, TTL_SCRIPT)
+    if not computed:
+        log("info", "Script served from cache.")
+    return script.decode("utf-8")
+
+def generate_image(project_name, central_message, tone):
+    """
+    Generates a background image using DALL·E 3.
+    It does not depend on the script, so it can run alongside generate_script.
+    Concurrent jobs with the same image prompt (e.g. campaign variants of one
+    brand) share one API call.
+
+    DALL·E URLs expire about an hour after they are issued, so the result
+    carries the time the URL stops being trusted (see image_url_life).
+
+    Returns:
+        dict: {"url": the URL of the generated image, "expires_at": timestamp}.
+    """
+    image_request = _image_request(project_name, central_message, tone)
+
+    def compute():
+        try:
+            image_response = resilience.call(
+                "openai-image",
+                lambda: client.images.generate(**image_request, timeout=resilience.request_timeout(OPENAI_TIMEOUT))
+            )
+            return _issued_image(image_response.data[0].url)
+        except Exception as e:
+            log("error", "OpenAI image generation failed.", error=str(e))
+            raise
+
+    image, computed = cache.get_or_compute("image-url", image_request, compute, TTL_IMAGE - IMAGE_URL_MIN_LIFE)
+    if not computed:
+        log("info", "Image URL served from cache.")
+    return json.loads(image)
+
+async def generate_script_async(project_name, video_goal, central_message, tone, target_audience, call_to_action):
+    """ Async variant of generate_script using the shared AsyncOpenAI client. """
+    script_request = _script_request(project_name, video_goal, central_message, tone, target_audience, call_to_action)
+
+    async def compute():
+        try:
+            script_response = await resilience.call_async(
+                "openai-chat", lambda: async_io.get_openai_client().chat.completions.create(**script_request),
+                estimate_chat_tokens(script_request)
+            )
+            return script_response.choices[0].message.content.strip().encode("utf-8")
+        except Exception as e:
+            log("error", "OpenAI script generation failed.", error=str(e))
+            raise
+
+    script, computed = await cache.get_or_compute_async("script", script_request, compute, TTL_SCRIPT)
+    if not computed:
+        log("info", "Script served from cache.")
+    return script.decode("utf-8")
+
+async def generate_image_async(project_name, central_message, tone):
+    """ Async variant of generate_image using the shared AsyncOpenAI client. """
+    image_request = _image_request(project_name, central_message, tone)
+
+    async def compute():
+        try:
+            image_response = await resilience.call_async(
+                "openai-image", lambda: async_io.get_openai_client().images.generate(**image_request)
+            )
+            return _issued_image(image_response.data[0].url)
+        except Exception as e:
+            log("error", "OpenAI image generation failed.", error=str(e))
+            raise
+
+    image, computed = await cache.get_or_compute_async("image-url", image_request, compute, TTL_IMAGE - IMAGE_URL_MIN_LIFE)
+    if not computed:
+        log("info", "Image URL served from cache.")
+    return json.loads(image)
+
+def generate_script_and_image(project_name, video_goal, central_message, tone, target_audience, call_to_action):
+    """
+    Generates a video script using GPT-4 and a background image using DALL·E 3.
+
+    Returns:
+        tuple: A tuple containing the generated script (str) and the image URL (str).
+    """
+    script = generate_script(project_name, video_goal, central_message, tone, target_audience, call_to_action)
+    image = generate_image(project_name, central_message, tone)
+    return script, image["url"]
 
 # Example usage (for testing)
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import sqlite3
+import importlib
+import threading
+
+# "sqlite" coordinates the processes of one host through COORDINATION_DB.
+# "package.module:ClassName" loads another Coordinator implementation, e.g.
+# one backed by Redis when web and worker processes run on several hosts.
+COORDINATION_BACKEND = os.environ.get("COORDINATION_BACKEND", "sqlite")
+# SQLite file shared by the web and worker processes of this host.
+COORDINATION_DB = os.environ.get("COORDINATION_DB", "/tmp/video_coordination.db")
+# How often a process checks for signals sent by other processes.
+COORDINATION_POLL_INTERVAL = float(os.environ.get("COORDINATION_POLL_INTERVAL", 0.25))
+
+
+class Coordinator:
+    """
+    State shared by the web and worker processes, besides the job table:
+
+      - leases: a named lock held by one owner until it is released or its
+        TTL runs out, so a crashed holder cannot keep it (e.g. the one worker
+        that requeues jobs whose lease expired);
+      - members: worker processes announcing themselves with heartbeats, and
+        forgotten when they stop;
+      - signals: a version number per channel, bumped by notify() (e.g. the
+        webhook telling workers that a job is waiting).
+
+    Subclasses implement the primitives below on a shared store; with
+    Redis they map to SET NX PX, a hash with expiry times, and INCR. The
+    base class delivers signals to subscribe() callbacks by polling version().
+    """
+
+    def __init__(self, poll_interval=COORDINATION_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._subscribers = {} # channel -> [callback]
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    # Primitives
+
+    def acquire(self, name, owner, ttl):
+        """Takes or renews the lease `name` for `ttl` seconds. Returns False if another owner holds it."""
+        raise NotImplementedError
+
+    def release(self, name, owner):
+        raise NotImplementedError
+
+    def heartbeat(self, member, info, ttl):
+        """Registers or refreshes a member for `ttl` seconds, with a JSON-serializable info dict."""
+        raise NotImplementedError
+
+    def leave(self, member):
+        raise NotImplementedError
+
+    def members(self):
+        """{member: info} of the members whose last heartbeat has not expired."""
+        raise NotImplementedError
+
+    def _bump(self, channel):
+        raise NotImplementedError
+
+    def version(self, channel):
+        raise NotImplementedError
+
+    # Signals
+
+    def notify(self, channel):
+        """Wakes the subscribers of a channel, in this process right away and elsewhere within a poll."""
+        self._bump(channel)
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            callback()
+
+    def subscribe(self, channel, callback):
+        """Calls callback() (from a background thread) whenever another process notifies the channel."""
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+            self._versions.setdefault(channel, self.version(channel))
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name="coordination-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                channels = list(self._subscribers)
+            for channel in channels:
+                try:
+                    version = self.version(channel)
+                except Exception:
+                    continue # The store is unavailable; workers still poll the queue
+                if version != self._versions.get(channel):
+                    self._versions[channel] = version
+                    with self._lock:
+                        callbacks = list(self._subscribers[channel])
+                    for callback in callbacks:
+                        callback()
+
+
+class SQLiteCoordinator(Coordinator):
+    """Coordinates the processes of a single host through a shared SQLite file."""
+
+    def __init__(self, db_path=COORDINATION_DB, poll_interval=COORDINATION_POLL_INTERVAL):
+        super().__init__(poll_interval)
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, "
+                     "expires_at REAL NOT NULL) WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS members (id TEXT PRIMARY KEY, info TEXT NOT NULL, "
+                     "expires_at REAL NOT NULL) WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS signals (channel TEXT PRIMARY KEY, version INTEGER NOT NULL) "
+                     "WITHOUT ROWID")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, name, owner, ttl):
+        now = time.time()
+        # One statement, so two processes cannot both take a free lease
+        cursor = self._connect().execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (name, owner, now + ttl, now),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, name, owner):
+        self._connect().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def heartbeat(self, member, info, ttl):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO members (id, info, expires_at) VALUES (?, ?, ?)",
+            (member, json.dumps(info), time.time() + ttl),
+        )
+
+    def leave(self, member):
+        self._connect().execute("DELETE FROM members WHERE id = ?", (member,))
+
+    def members(self):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("DELETE FROM members WHERE expires_at < ?", (now,))
+        rows = conn.execute("SELECT id, info FROM members ORDER BY id").fetchall()
+        return {member: json.loads(info) for member, info in rows}
+
+    def _bump(self, channel):
+        self._connect().execute(
+            "INSERT INTO signals (channel, version) VALUES (?, 1) "
+            "ON CONFLICT (channel) DO UPDATE SET version = version + 1",
+            (channel,),
+        )
+
+    def version(self, channel):
+        row = self._connect().execute("SELECT version FROM signals WHERE channel = ?", (channel,)).fetchone()
+        return row[0] if row else 0
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator():
+    """The process-wide coordinator selected by COORDINATION_BACKEND, created on first use."""
+    global _coordinator
+    if _coordinator is None:
+        with _coordinator_lock:
+            if _coordinator is None:
+                if COORDINATION_BACKEND == "sqlite":
+                    _coordinator = SQLiteCoordinator()
+                else:
+                    module, _, name = COORDINATION_BACKEND.partition(":")
+                    _coordinator = getattr(importlib.import_module(module), name)()
+    return _coordinator
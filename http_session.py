@@ -0,0 +1,121 @@
+import os
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from resilience import request_timeout
+from observability import registry
+
+# Connection pool sizing. HTTP_POOL_MAXSIZE is the number of keep-alive
+# connections kept per host; HTTP_POOL_SIZES overrides it for specific hosts,
+# e.g. "api.openai.com=20,api.mailjet.com=4".
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 10))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 10))
+HTTP_POOL_SIZES = os.environ.get("HTTP_POOL_SIZES", "")
+# Default timeouts (seconds) applied to every call that does not pass its own.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 300))
+# Timeout (seconds) of a single OpenAI request; the SDK's own default is ten minutes.
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 60))
+
+HTTP_BYTES = registry.counter(
+    "http_bytes_total", "Bytes sent and received over HTTP, from Content-Length headers and request bodies.",
+    ["host", "direction"]
+)
+
+_lock = threading.Lock()
+_session = None
+
+
+def parse_pool_sizes(spec):
+    """Parses "host=size,host2=size" into a {host: size} dict."""
+    sizes = {}
+    for item in spec.split(","):
+        host, _, size = item.strip().partition("=")
+        if host and size.isdigit():
+            sizes[host] = int(size)
+    return sizes
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that applies a default timeout when the caller sets none,
+    and never waits past the deadline of the resilience call in progress.
+    """
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        timeout = kwargs.get("timeout")
+        if timeout is None:
+            timeout = self.timeout
+        if not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        kwargs["timeout"] = tuple(request_timeout(HTTP_READ_TIMEOUT if t is None else t) for t in timeout)
+        response = super().send(request, **kwargs)
+        try:
+            sent = len(request.body) if request.body is not None else 0
+        except TypeError:
+            sent = 0 # a generator body of unknown size
+        count_bytes(urlparse(request.url).hostname, sent, response.headers.get("Content-Length"))
+        return response
+
+
+def count_bytes(host, sent, received):
+    """Adds a request's body size and a response's Content-Length header to the byte counters."""
+    if sent:
+        HTTP_BYTES.inc(sent, host=host, direction="sent")
+    if received and received.isdigit():
+        HTTP_BYTES.inc(int(received), host=host, direction="received")
+
+
+def get_session():
+    """
+    Returns the process-wide requests.Session. Connections are pooled and kept
+    alive per host, so repeated calls to the same service skip the TCP and TLS
+    handshakes. The session is thread-safe for the way we use it (one request
+    per call, no shared cookies).
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            default = TimeoutHTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", default)
+            session.mount("http://", default)
+            for host, size in parse_pool_sizes(HTTP_POOL_SIZES).items():
+                adapter = TimeoutHTTPAdapter(pool_connections=1, pool_maxsize=size)
+                session.mount(f"https://{host}/", adapter)
+                session.mount(f"http://{host}/", adapter)
+            _session = session
+    return _session
+
+
+def connection_metrics():
+    """
+    Reports connection reuse per host for the shared session. `connections` is
+    the number of TCP connections opened, `requests` the number of requests sent
+    over them; the closer reuse_ratio is to 1, the fewer handshakes we pay for.
+    """
+    if _session is None:
+        return {}
+    hosts = {}
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats = hosts.setdefault(f"{pool.scheme}://{pool.host}:{pool.port}", {"connections": 0, "requests": 0})
+            stats["connections"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+    for stats in hosts.values():
+        if stats["requests"]:
+            stats["reuse_ratio"] = round(1 - stats["connections"] / stats["requests"], 3)
+        else:
+            stats["reuse_ratio"] = 0.0
+    return hosts
@@ -0,0 +1,38 @@
+import os
+import json
+import hashlib
+
+# How long a parsed submission is remembered for content-based deduplication,
+# i.e. how far apart two identical double-submits can be and still collapse.
+SUBMISSION_DEDUP_WINDOW = int(os.environ.get("SUBMISSION_DEDUP_WINDOW", 24 * 3600))
+# How long any key is kept in the index before it is pruned.
+SUBMISSION_INDEX_TTL = int(os.environ.get("SUBMISSION_INDEX_TTL", 7 * 24 * 3600))
+
+
+def _digest(text):
+    """Keys are stored as 16-byte digests to keep the index compact."""
+    return hashlib.sha256(text.encode("utf-8")).digest()[:16]
+
+
+def submission_keys(tally_json, form_data):
+    """
+    Returns the idempotency keys for a Tally webhook as a list of
+    (kind, digest) pairs.
+
+    - "id": the Tally response/submission ID. Tally reuses it when it retries
+      a webhook delivery, so a retry always maps to the original job.
+    - "content": a hash of the parsed form_data, which also catches a user
+      submitting the same form twice (each submit gets a new response ID).
+    """
+    data = tally_json.get("data", {}) or {}
+    keys = []
+    submission_id = data.get("responseId") or data.get("submissionId") or tally_json.get("eventId")
+    if submission_id:
+        keys.append(("id", _digest(f"{data.get('formId', '')}:{submission_id}")))
+    canonical = json.dumps(
+        {k: " ".join(str(v).split()).casefold() for k, v in form_data.items() if v},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    keys.append(("content", _digest(canonical)))
+    return keys
@@ -0,0 +1,839 @@
+import os
+import json
+import uuid
+import time
+import socket
+import sqlite3
+import asyncio
+import threading
+import contextvars
+from queue import SimpleQueue, Empty
+
+import scheduling
+from observability import registry, span, log
+from job_status import broker
+from coordination import get_coordinator
+from pipeline import Cancelled
+from rate_limiter import limiter
+
+# Location of the SQLite file backing the job queue. Keep it on a disk that
+# survives gunicorn worker recycling (the default /tmp does on Render).
+JOB_QUEUE_DB = os.environ.get("JOB_QUEUE_DB", "/tmp/video_jobs.db")
+# Number of background workers pulling jobs in each process.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+# Maximum number of queued (not yet running) jobs before we push back on Tally.
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", 100))
+# Seconds advertised in the Retry-After header when the queue is full.
+JOB_RETRY_AFTER = int(os.environ.get("JOB_RETRY_AFTER", 30))
+# How long an idle worker sleeps before polling the queue again.
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1.0))
+# Attempts per job when it fails with a transient error (see WorkerPool's
+# should_retry), and the delay before the first retry, doubled every time.
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", 60))
+# A claimed job is leased to its worker process for JOB_LEASE_TTL seconds and
+# the lease renewed every JOB_HEARTBEAT_INTERVAL. The job of a worker that
+# stops heartbeating (crashed, frozen, or its host gone) is queued again once
+# the lease expires.
+JOB_LEASE_TTL = float(os.environ.get("JOB_LEASE_TTL", 60))
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", 15))
+# Days the event history of a done or failed job is kept; 0 keeps it forever.
+# The worker holding the "job-reaper" lease prunes it every JOB_EVENTS_PRUNE_INTERVAL seconds.
+JOB_EVENTS_RETENTION_DAYS = float(os.environ.get("JOB_EVENTS_RETENTION_DAYS", 7))
+JOB_EVENTS_PRUNE_INTERVAL = float(os.environ.get("JOB_EVENTS_PRUNE_INTERVAL", 3600))
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+JOB_SECONDS = registry.histogram(
+    "job_seconds", "Time from claiming a job to its completion or failure.", ["kind", "outcome"]
+)
+QUEUE_WAIT_SECONDS = registry.histogram(
+    "job_queue_wait_seconds", "Time from a job being ready to run to a worker claiming it.", ["priority"]
+)
+TURNAROUND_SECONDS = registry.histogram(
+    "job_turnaround_seconds", "Time from submission to the end of a job, retries included.", ["priority", "outcome"]
+)
+DEADLINE_MISSED = registry.counter(
+    "job_deadline_missed_total", "Jobs that finished after the deadline of their priority class.", ["priority"]
+)
+
+# The ID of the job a worker is running, for code that keeps per-job state
+# (e.g. pipeline checkpoints) without it being passed through the handler.
+_current_job_id = contextvars.ContextVar("current_job_id", default=None)
+
+
+def current_job_id():
+    return _current_job_id.get()
+
+
+class QueueFull(Exception):
+    """Raised when a job cannot be accepted because the queue is at capacity."""
+
+    def __init__(self, retry_after=JOB_RETRY_AFTER):
+        super().__init__("Job queue is full.")
+        self.retry_after = retry_after
+
+
+class LeaseLost(Cancelled):
+    """Raised between the stages of a job whose lease this process lost, so the job runs only once."""
+
+    def __init__(self, job_id):
+        super().__init__(f"Job {job_id} is leased to another worker.")
+        self.job_id = job_id
+
+
+def _worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def notify_workers(kind="video"):
+    """Wakes the idle workers of a kind ("video" or "bulk") in every process, see WorkerPool."""
+    get_coordinator().notify(f"jobs:{kind}")
+
+
+def worker_processes(members):
+    """Number of distinct processes among the coordinator's members (one per worker pool)."""
+    return len({(info.get("host"), info.get("pid")) for info in members.values()})
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    A small persistent job queue backed by SQLite.
+
+    Jobs move through queued -> running -> done/failed. Claiming a job is done
+    inside an IMMEDIATE transaction so several gunicorn workers can share the
+    same database file without handing out the same job twice. Each job has
+    a priority class and a deadline (see scheduling), and belongs to a
+    customer (the email of its brief) for fair sharing.
+
+    Every transition, and every pipeline stage reported through progress(),
+    is appended to the job's event history and pushed to `broker`, which
+    serves the job status stream (see job_status).
+    """
+
+    def __init__(self, db_path=JOB_QUEUE_DB, max_queued=JOB_QUEUE_MAX, broker=broker):
+        self.db_path = db_path
+        self.max_queued = max_queued
+        self.broker = broker
+        self._local = threading.local()
+        # Keeps event IDs in the order watchers receive them
+        self._event_lock = threading.Lock()
+        # Jobs still running here whose lease ran out (see renew_leases)
+        self._lost = set()
+        self._lost_lock = threading.Lock()
+        self._init_schema()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+        self._ensure_column(conn, "jobs", "batch_id", "TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id)")
+        self._ensure_column(conn, "jobs", "run_after", "REAL")
+        self._ensure_column(conn, "jobs", "stage", "TEXT")
+        self._ensure_column(conn, "jobs", "lease_expires_at", "REAL")
+        for column, definition in (("priority", "TEXT"), ("rank", "INTEGER"), ("deadline", "REAL"),
+                                   ("customer", "TEXT")):
+            self._ensure_column(conn, "jobs", column, definition)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_schedule ON jobs (status, rank, deadline)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_customer ON jobs (customer, status)")
+        self._schedule_legacy_jobs(conn)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS submissions (
+                key BLOB PRIMARY KEY,
+                kind TEXT NOT NULL,
+                job_id TEXT NOT NULL,
+                created_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                job_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                result TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (job_id, stage)
+            ) WITHOUT ROWID
+            """
+        )
+        # AUTOINCREMENT never reuses an ID, so clients can resume a stream
+        # from the last ID they saw
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS job_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events (job_id, id)")
+
+    def _schedule_legacy_jobs(self, conn):
+        """Gives unfinished jobs queued by an older version the default class of their kind."""
+        rows = conn.execute(
+            "SELECT id, payload, batch_id, created_at FROM jobs WHERE rank IS NULL AND status IN (?, ?)",
+            (STATUS_QUEUED, STATUS_RUNNING),
+        ).fetchall()
+        for row in rows:
+            priority = scheduling.BULK_PRIORITY if row["batch_id"] else scheduling.DEFAULT_PRIORITY
+            conn.execute(
+                "UPDATE jobs SET priority = ?, rank = ?, deadline = ?, customer = ? WHERE id = ?",
+                (priority, scheduling.rank(priority), scheduling.deadline(priority, row["created_at"]),
+                 json.loads(row["payload"]).get("email"), row["id"]),
+            )
+
+    def _ensure_column(self, conn, table, column, definition):
+        """Adds a column to a table created by an older version of this module."""
+        columns = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def enqueue(self, payload, priority=None):
+        """
+        Adds a job of the given priority class to the queue and returns its ID.
+        Raises QueueFull if the number of waiting jobs has reached the limit.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job_id = self._insert(conn, payload, priority=priority)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def enqueue_once(self, payload, keys, dedup_window, index_ttl, priority=None):
+        """
+        Adds a job unless one of `keys` (see idempotency.submission_keys) was
+        already seen. Content keys only match within `dedup_window` seconds, and
+        a previous job that failed does not block a new attempt.
+
+        Returns (job_id, created): the existing job's ID and False for a
+        duplicate, or the new job's ID and True.
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM submissions WHERE created_at < ?", (now - index_ttl,))
+            for kind, key in keys:
+                row = conn.execute(
+                    "SELECT s.job_id, s.created_at, j.status FROM submissions s "
+                    "JOIN jobs j ON j.id = s.job_id WHERE s.key = ?",
+                    (key,),
+                ).fetchone()
+                if row is None or row["status"] == STATUS_FAILED:
+                    continue
+                if kind == "content" and row["created_at"] < now - dedup_window:
+                    continue
+                conn.execute("COMMIT")
+                return row["job_id"], False
+
+            job_id = self._insert(conn, payload, priority=priority)
+            conn.executemany(
+                "INSERT OR REPLACE INTO submissions (key, kind, job_id, created_at) VALUES (?, ?, ?, ?)",
+                [(key, kind, job_id, now) for kind, key in keys],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id, True
+
+    def _insert(self, conn, payload, batch_id=None, priority=None):
+        if batch_id is None:
+            # Bulk batches are sized up front and do not count against the
+            # webhook backpressure limit
+            queued = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND batch_id IS NULL", (STATUS_QUEUED,)
+            ).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        priority = scheduling.resolve(priority, scheduling.BULK_PRIORITY if batch_id else scheduling.DEFAULT_PRIORITY)
+        conn.execute(
+            "INSERT INTO jobs (id, payload, status, batch_id, priority, rank, deadline, customer, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(payload), STATUS_QUEUED, batch_id, priority, scheduling.rank(priority),
+             scheduling.deadline(priority, now), payload.get("email"), now, now),
+        )
+        # Nobody can be watching a job that does not exist yet
+        self._insert_event(conn, job_id, STATUS_QUEUED, {}, now)
+        return job_id
+
+    def enqueue_batch(self, payloads, batch_id, priority=None):
+        """Adds all jobs of a bulk batch in one transaction. Returns their IDs, in order."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job_ids = [self._insert(conn, payload, batch_id, priority) for payload in payloads]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_ids
+
+    def batch_jobs(self, batch_id):
+        """Returns the jobs of a bulk batch as dicts, oldest first."""
+        rows = self._connect().execute(
+            "SELECT id, status, attempts, error, created_at, updated_at FROM jobs "
+            "WHERE batch_id = ? ORDER BY created_at, rowid",
+            (batch_id,),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim(self, batch=False, lease_ttl=JOB_LEASE_TTL):
+        """
+        Atomically takes the most urgent queued job that is not waiting for a
+        retry, and marks it as running: the highest priority class first, then
+        the customer with the fewest jobs running, then the earliest deadline.
+        batch selects bulk batch jobs instead of single submissions, so each
+        kind has its own workers and a campaign cannot starve the webhook.
+        The job is leased to this process for lease_ttl seconds (see
+        renew_leases). Returns the job as a dict (id, payload, priority, deadline), or None
+        if nothing is waiting.
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload, attempts, priority, deadline, created_at, run_after FROM jobs "
+                "WHERE status = ? AND batch_id IS " + ("NOT NULL" if batch else "NULL")
+                + " AND (run_after IS NULL OR run_after <= ?) ORDER BY rank, "
+                "(SELECT COUNT(*) FROM jobs AS running WHERE running.customer = jobs.customer "
+                "AND running.status = ?), deadline, created_at LIMIT 1",
+                (STATUS_QUEUED, now, STATUS_RUNNING),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, lease_expires_at = ?, "
+                "updated_at = ? WHERE id = ?",
+                (STATUS_RUNNING, _worker_id(), now + lease_ttl, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        # A retried job waited for its backoff on purpose; only count the rest
+        QUEUE_WAIT_SECONDS.observe(now - max(row["created_at"], row["run_after"] or 0), priority=row["priority"])
+        self.add_event(row["id"], STATUS_RUNNING, attempt=row["attempts"] + 1, priority=row["priority"])
+        return {"id": row["id"], "payload": json.loads(row["payload"]),
+                "priority": row["priority"], "deadline": row["deadline"]}
+
+    def complete(self, job_id):
+        self._finish(job_id, STATUS_DONE, None)
+
+    def fail(self, job_id, error):
+        self._finish(job_id, STATUS_FAILED, str(error))
+
+    def retry_or_fail(self, job_id, error, max_attempts=JOB_MAX_ATTEMPTS, base_delay=JOB_RETRY_DELAY):
+        """
+        Puts a failed job back on the queue, to be claimed again after an
+        exponential backoff, unless it has used up its attempts. Its
+        checkpoints are kept so the next attempt resumes where this one failed.
+        Returns the delay in seconds, or None if the job failed for good.
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row["attempts"] >= max_attempts:
+            self.fail(job_id, error)
+            return None
+        delay = base_delay * 2 ** (row["attempts"] - 1)
+        now = time.time()
+        cursor = conn.execute(
+            "UPDATE jobs SET status = ?, worker = NULL, error = ?, run_after = ?, lease_expires_at = NULL, "
+            "updated_at = ? WHERE id = ? AND status = ? AND worker = ?",
+            (STATUS_QUEUED, str(error), now + delay, now, job_id, STATUS_RUNNING, _worker_id()),
+        )
+        if not cursor.rowcount:
+            self._lease_lost(job_id)
+            return None
+        self.add_event(job_id, "retrying", error=str(error), delay=delay)
+        return delay
+
+    def _finish(self, job_id, status, error):
+        conn = self._connect()
+        now = time.time()
+        # A worker whose lease expired may finish after the job was handed
+        # to another one; only the current holder records the outcome
+        cursor = conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_expires_at = NULL, updated_at = ? "
+            "WHERE id = ? AND status = ? AND worker = ?",
+            (status, error, now, job_id, STATUS_RUNNING, _worker_id()),
+        )
+        if not cursor.rowcount:
+            self._lease_lost(job_id)
+            return
+        row = conn.execute("SELECT priority, deadline, created_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        TURNAROUND_SECONDS.observe(now - row["created_at"], priority=row["priority"], outcome=status)
+        if row["deadline"] is not None and now > row["deadline"]:
+            DEADLINE_MISSED.inc(priority=row["priority"])
+        conn.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+        self.add_event(job_id, status, **({"error": error} if error else {}))
+
+    def _lease_lost(self, job_id):
+        log("warning", f"Job {job_id} is no longer leased to this worker, its outcome is dropped.", job_id=job_id)
+
+    def renew_leases(self, job_ids, lease_ttl=JOB_LEASE_TTL):
+        """
+        Extends the leases this process holds on running jobs. Returns the IDs
+        it no longer holds; those jobs are cancelled here before their next
+        stage (see check_lease), since another worker may be running them.
+        """
+        if not job_ids:
+            return []
+        conn = self._connect()
+        lost = []
+        for job_id in job_ids:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ? AND worker = ?",
+                (time.time() + lease_ttl, job_id, STATUS_RUNNING, _worker_id()),
+            )
+            if not cursor.rowcount:
+                lost.append(job_id)
+        with self._lost_lock:
+            self._lost.update(lost)
+        return lost
+
+    def check_lease(self, job_id):
+        """Raises LeaseLost if this process lost the lease of a job it is running."""
+        with self._lost_lock:
+            if job_id in self._lost:
+                raise LeaseLost(job_id)
+
+    def released(self, job_id):
+        """Forgets a job this process stopped running."""
+        with self._lost_lock:
+            self._lost.discard(job_id)
+
+    def requeue_expired(self, max_attempts=JOB_MAX_ATTEMPTS):
+        """
+        Puts back on the queue every running job whose lease has expired, on
+        any host: its worker crashed, froze or was recycled. A job that has
+        used up its attempts fails instead, so a job that keeps killing its
+        worker does not loop forever. Returns the number of jobs requeued.
+        """
+        conn = self._connect()
+        now = time.time()
+        requeued, records = 0, []
+        with self._event_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # A running job without a lease was claimed by a version without leases
+                rows = conn.execute(
+                    "SELECT id, worker, attempts FROM jobs WHERE status = ? "
+                    "AND (lease_expires_at IS NULL OR lease_expires_at < ?)",
+                    (STATUS_RUNNING, now),
+                ).fetchall()
+                for row in rows:
+                    if row["attempts"] >= max_attempts:
+                        error = f"Worker {row['worker']} stopped while running attempt {row['attempts']}."
+                        conn.execute(
+                            "UPDATE jobs SET status = ?, error = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                            (STATUS_FAILED, error, now, row["id"]),
+                        )
+                        conn.execute("DELETE FROM checkpoints WHERE job_id = ?", (row["id"],))
+                        records.append((row["id"], self._insert_event(conn, row["id"], STATUS_FAILED,
+                                                                      {"error": error}, now)))
+                        log("error", f"Job {row['id']} failed, its worker stopped on every attempt.",
+                            job_id=row["id"], worker=row["worker"])
+                        continue
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ?",
+                        (STATUS_QUEUED, now, row["id"]),
+                    )
+                    records.append((row["id"], self._insert_event(conn, row["id"], STATUS_QUEUED,
+                                                                  {"lease_expired": True, "worker": row["worker"]}, now)))
+                    requeued += 1
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            for job_id, record in records:
+                self.broker.publish(job_id, record)
+        return requeued
+
+    def prune_events(self, retention_days=JOB_EVENTS_RETENTION_DAYS, batch=5000):
+        """
+        Deletes the events of jobs that finished more than retention_days ago,
+        in batches so writers are not locked out for long. Returns the number
+        of events deleted.
+        """
+        if retention_days <= 0:
+            return 0
+        conn = self._connect()
+        cutoff = time.time() - retention_days * 86400
+        deleted = 0
+        while True:
+            with self._event_lock:
+                cursor = conn.execute(
+                    "DELETE FROM job_events WHERE id IN (SELECT e.id FROM job_events e JOIN jobs j ON j.id = e.job_id "
+                    "WHERE j.status IN (?, ?) AND j.updated_at < ? LIMIT ?)",
+                    (STATUS_DONE, STATUS_FAILED, cutoff, batch),
+                )
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch:
+                return deleted
+
+    def checkpoints(self, job_id):
+        """The checkpoint store of one job, for Pipeline.run."""
+        return Checkpoints(self, job_id)
+
+    def progress(self, job_id):
+        """
+        The progress callback of one job, for Pipeline.run. It stops the run
+        before its next stage once the job's lease is lost.
+        """
+        def report(event, **data):
+            self.check_lease(job_id)
+            self.add_event(job_id, event, **data)
+        return report
+
+    def _insert_event(self, conn, job_id, event, data, now):
+        cursor = conn.execute(
+            "INSERT INTO job_events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, event, json.dumps(data), now),
+        )
+        return dict(data, id=cursor.lastrowid, event=event, time=round(now, 3))
+
+    def add_event(self, job_id, event, **data):
+        """
+        Appends an event (a status change, or a stage transition reported by
+        the pipeline) to the job's history and pushes it to its watchers.
+        A started stage also becomes the job's current stage.
+        """
+        now = time.time()
+        with self._event_lock:
+            conn = self._connect()
+            record = self._insert_event(conn, job_id, event, data, now)
+            if event == "stage_started":
+                conn.execute("UPDATE jobs SET stage = ? WHERE id = ?", (data.get("stage"), job_id))
+            self.broker.publish(job_id, record)
+
+    def events(self, job_id, after=0):
+        """The job's events with an ID greater than `after`, oldest first."""
+        rows = self._connect().execute(
+            "SELECT id, event, data, created_at FROM job_events WHERE job_id = ? AND id > ? ORDER BY id",
+            (job_id, after),
+        ).fetchall()
+        return [dict(json.loads(row["data"]), id=row["id"], event=row["event"], time=round(row["created_at"], 3))
+                for row in rows]
+
+    def events_since(self, job_ids, after):
+        """
+        [(job_id, event)] of the given jobs with an event ID greater than
+        `after`, oldest first, and the highest event ID of any job (or
+        `after` if there is none), for job_status.EventBroker's poller.
+        """
+        conn = self._connect()
+        newest = conn.execute("SELECT MAX(id) FROM job_events").fetchone()[0] or after
+        if not job_ids or newest <= after:
+            return [], max(newest, after)
+        job_ids, rows = list(job_ids), []
+        for start in range(0, len(job_ids), 500): # Stay below SQLite's limit on bound parameters
+            batch = job_ids[start:start + 500]
+            rows += conn.execute(
+                "SELECT id, job_id, event, data, created_at FROM job_events WHERE id > ? AND id <= ? "
+                "AND job_id IN (%s)" % ", ".join("?" * len(batch)),
+                (after, newest, *batch),
+            ).fetchall()
+        rows.sort(key=lambda row: row["id"])
+        return [(row["job_id"], dict(json.loads(row["data"]), id=row["id"], event=row["event"],
+                                     time=round(row["created_at"], 3))) for row in rows], newest
+
+    def depth(self):
+        """Number of jobs per (status, kind), kind being "video" or "bulk"."""
+        rows = self._connect().execute(
+            "SELECT status, batch_id IS NOT NULL AS bulk, COUNT(*) AS jobs FROM jobs "
+            "WHERE status IN (?, ?) GROUP BY status, bulk",
+            (STATUS_QUEUED, STATUS_RUNNING),
+        ).fetchall()
+        return {(row["status"], "bulk" if row["bulk"] else "video"): row["jobs"] for row in rows}
+
+    def get(self, job_id):
+        """Returns the job row as a dict, or None if the ID is unknown."""
+        row = self._connect().execute(
+            "SELECT id, status, stage, priority, deadline, attempts, error, created_at, updated_at "
+            "FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        return dict(row) if row else None
+
+
+class Checkpoints:
+    """
+    Saved stage results of one job. They survive a failed attempt and a
+    process restart, and are deleted when the job finishes for good.
+    """
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+
+    def load(self):
+        """Returns {stage: result} for the checkpoints that have not expired."""
+        rows = self.queue._connect().execute(
+            "SELECT stage, result FROM checkpoints WHERE job_id = ? AND expires_at > ?",
+            (self.job_id, time.time()),
+        ).fetchall()
+        return {row["stage"]: json.loads(row["result"]) for row in rows}
+
+    def save(self, stage, result, ttl):
+        self.queue.check_lease(self.job_id)
+        self.queue._connect().execute(
+            "INSERT OR REPLACE INTO checkpoints (job_id, stage, result, expires_at) VALUES (?, ?, ?, ?)",
+            (self.job_id, stage, json.dumps(result), time.time() + ttl),
+        )
+
+
+class WorkerPool:
+    """
+    A fixed-size pool of daemon threads that pull jobs from a JobQueue and run
+    them through `handler(payload)`. A handler that raises marks the job failed.
+
+    If `handler` is a coroutine function, a single dispatcher thread feeds the
+    shared event loop instead, and `size` caps the number of jobs in flight.
+    With batch=True the pool runs bulk batch jobs (see JobQueue.claim).
+    A job whose error passes `should_retry(error)` is queued again with
+    backoff (see JobQueue.retry_or_fail) instead of failing right away.
+    Handlers run in the scheduling scope of their job (see scheduling), so
+    provider calls can be served by priority.
+
+    Pools in any number of processes can share one queue. Each pool renews
+    the leases of its running jobs and announces itself to the coordinator
+    (see coordination) every JOB_HEARTBEAT_INTERVAL; whichever pool holds the
+    "job-reaper" lease requeues the jobs of workers that stopped doing so.
+    A job whose lease this pool lost anyway (e.g. the process stalled for
+    longer than JOB_LEASE_TTL) is stopped before its next pipeline stage.
+    notify_workers() wakes idle pools in every process.
+    """
+
+    def __init__(self, queue, handler, size=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL, batch=False,
+                 should_retry=None, coordinator=None):
+        self.queue = queue
+        self.handler = handler
+        self.size = size
+        self.batch = batch
+        self.should_retry = should_retry
+        self.poll_interval = poll_interval
+        self.coordinator = coordinator
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._running = set() # IDs of the jobs leased by this pool
+        self._running_lock = threading.Lock()
+        self._pruned_at = float("-inf") # When this pool last pruned old job events
+        self._name = "bulk" if batch else "video"
+        self.member = f"{_worker_id()}:{self._name}"
+
+    def start(self):
+        self.coordinator = self.coordinator or get_coordinator()
+        self.coordinator.subscribe(f"jobs:{self._name}", self._wakeup.set)
+        thread = threading.Thread(target=self._heartbeat, name=f"{self._name}-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        if asyncio.iscoroutinefunction(self.handler):
+            thread = threading.Thread(target=self._dispatch_async, name=f"{self._name}-dispatcher", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+            log("info", f"Started async {self._name} dispatcher ({self.size} jobs in flight max).")
+            return
+        for i in range(self.size):
+            thread = threading.Thread(target=self._run, name=f"{self._name}-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        log("info", f"Started {self.size} {self._name} worker(s).")
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self.coordinator is not None:
+            self.coordinator.leave(self.member)
+
+    def notify(self):
+        """Wakes this pool's idle workers up right away instead of waiting for the next poll."""
+        self._wakeup.set()
+
+    def running(self):
+        with self._running_lock:
+            return list(self._running)
+
+    def _claim(self):
+        job = self.queue.claim(self.batch)
+        if job is not None:
+            with self._running_lock:
+                self._running.add(job["id"])
+        return job
+
+    def _released(self, job_id):
+        with self._running_lock:
+            self._running.discard(job_id)
+        self.queue.released(job_id)
+
+    def _heartbeat(self):
+        while not self._stopping.is_set():
+            try:
+                lost = self.queue.renew_leases(self.running())
+                for job_id in lost:
+                    log("warning", f"Lost the lease of job {job_id}; stopping it before its next stage.",
+                        job_id=job_id)
+                self.coordinator.heartbeat(self.member, {
+                    "kind": self._name, "pid": os.getpid(), "host": socket.gethostname(),
+                    "size": self.size, "running": len(self.running()),
+                }, ttl=3 * JOB_HEARTBEAT_INTERVAL)
+                # Provider budgets are split between the live worker processes
+                limiter.share(worker_processes(self.coordinator.members()))
+                if self.coordinator.acquire("job-reaper", self.member, ttl=3 * JOB_HEARTBEAT_INTERVAL):
+                    requeued = self.queue.requeue_expired()
+                    if requeued:
+                        log("warning", f"Requeued {requeued} job(s) whose worker stopped heartbeating.")
+                        notify_workers("video")
+                        notify_workers("bulk")
+                    if time.monotonic() - self._pruned_at >= JOB_EVENTS_PRUNE_INTERVAL:
+                        self._pruned_at = time.monotonic()
+                        pruned = self.queue.prune_events()
+                        if pruned:
+                            log("info", f"Deleted {pruned} event(s) of jobs finished over "
+                                        f"{JOB_EVENTS_RETENTION_DAYS:g} day(s) ago.")
+            except Exception as e:
+                # A missed heartbeat is retried on the next one, well before the lease runs out
+                log("error", "Worker heartbeat failed.", error=str(e))
+            self._stopping.wait(JOB_HEARTBEAT_INTERVAL)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            job = self._claim()
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            job_id = job["id"]
+            token = _current_job_id.set(job_id)
+            try:
+                # The job ID doubles as the trace ID of its spans and log lines
+                with span("job", JOB_SECONDS, trace_id=job_id, kind=self._name), \
+                        scheduling.schedule_scope(job["priority"], job["deadline"]):
+                    self.handler(job["payload"])
+            except Exception as e:
+                self._failed(job_id, e)
+            else:
+                self.queue.complete(job_id)
+            finally:
+                _current_job_id.reset(token)
+                self._released(job_id)
+
+    def _failed(self, job_id, error):
+        if isinstance(error, LeaseLost):
+            # Another worker owns the job now and records its outcome
+            log("warning", f"Job {job_id} stopped, it was handed to another worker.", job_id=job_id)
+            return
+        if self.should_retry is not None and self.should_retry(error):
+            delay = self.queue.retry_or_fail(job_id, error)
+        else:
+            delay = None
+            self.queue.fail(job_id, error)
+        if delay is None:
+            log("error", f"Job {job_id} failed.", job_id=job_id, error=str(error))
+        else:
+            log("warning", f"Job {job_id} failed, retrying.", job_id=job_id, error=str(error), delay=delay)
+
+    def _dispatch_async(self):
+        import async_io # Only needed in async mode; pulls in httpx and openai
+
+        # Jobs run on the shared event loop, but their outcome is written to
+        # the queue from this thread, so SQLite never blocks the loop
+        finished = SimpleQueue()
+        running = 0
+        while running or not self._stopping.is_set():
+            while True:
+                try:
+                    job_id, future = finished.get_nowait()
+                except Empty:
+                    break
+                try:
+                    self._finish_async(job_id, future)
+                except Exception as e:
+                    # One job's outcome failing to save must not stop the dispatcher
+                    log("error", "Could not record the outcome of a job.", job_id=job_id, error=str(e))
+                running -= 1
+            job = None
+            if running < self.size and not self._stopping.is_set():
+                job = self._claim()
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            def done(future, job_id=job["id"]):
+                finished.put((job_id, future))
+                self._wakeup.set()
+
+            future = async_io.submit(self._run_async(job))
+            running += 1
+            future.add_done_callback(done)
+
+    async def _run_async(self, job):
+        _current_job_id.set(job["id"]) # The task runs in its own context
+        with span("job", JOB_SECONDS, trace_id=job["id"], kind=self._name), \
+                scheduling.schedule_scope(job["priority"], job["deadline"]):
+            await self.handler(job["payload"])
+
+    def _finish_async(self, job_id, future):
+        try:
+            error = future.exception()
+            if error is not None:
+                self._failed(job_id, error)
+            else:
+                self.queue.complete(job_id)
+        finally:
+            self._released(job_id)
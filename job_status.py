@@ -0,0 +1,374 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import parse_qs
+
+from observability import log
+
+# Events of the jobs run by this process are pushed to their watchers right
+# away. Those written by other processes (e.g. a job claimed by another
+# gunicorn worker) are picked up this often, by one poller for every job
+# watched in the process (see EventBroker.start_polling).
+JOB_EVENTS_POLL_INTERVAL = float(os.environ.get("JOB_EVENTS_POLL_INTERVAL", 2.0))
+# An idle stream sends a comment line this often so proxies keep it open.
+JOB_EVENTS_KEEPALIVE = float(os.environ.get("JOB_EVENTS_KEEPALIVE", 15))
+# Recent events kept in memory per watched job. A watcher that falls further
+# behind reads the missing ones from the database.
+JOB_EVENTS_BUFFER = int(os.environ.get("JOB_EVENTS_BUFFER", 256))
+# Streams served from web request threads at once, per process. Each holds
+# a thread, so keep this well below the server's thread count: the rest is
+# left for the webhook. Further streams get a 503 with Retry-After.
+JOB_EVENTS_MAX_STREAMS = int(os.environ.get("JOB_EVENTS_MAX_STREAMS", 50))
+# Port of the stream server run on the shared event loop (see serve_streams),
+# where a watcher costs a coroutine instead of a thread; 0 disables it.
+# JOB_EVENTS_URL is its public base URL: when set, events_url points there.
+JOB_EVENTS_PORT = int(os.environ.get("JOB_EVENTS_PORT", 0))
+JOB_EVENTS_URL = os.environ.get("JOB_EVENTS_URL", "").rstrip("/")
+# Streams served by that server at once, per process.
+JOB_EVENTS_SERVER_MAX_STREAMS = int(os.environ.get("JOB_EVENTS_SERVER_MAX_STREAMS", 5000))
+
+# Final job statuses, which are also the events after which a job has
+# nothing more to report. "retrying" is not one: the job is queued again.
+FINISHED = ("done", "failed")
+
+# Stage events (see Pipeline.run) and the stage status they stand for.
+STAGE_EVENTS = {
+    "stage_started": "running",
+    "stage_done": "done",
+    "stage_failed": "failed",
+    "stage_resumed": "resumed",
+}
+
+
+class _Topic:
+    """The recent events of one job, and what its watchers wait on."""
+
+    def __init__(self, size):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=size)
+        self.evicted = 0 # ID of the newest event pushed out of the buffer
+        self.watchers = 0
+        self.listeners = set() # wake-up callbacks of the watchers on the event loop
+
+    def publish(self, event):
+        with self.cond:
+            # The poller and the process that wrote an event may both publish it
+            if self.events and event["id"] <= self.events[-1]["id"]:
+                return
+            if len(self.events) == self.events.maxlen:
+                self.evicted = self.events[0]["id"]
+            self.events.append(event)
+            self.cond.notify_all()
+            listeners = list(self.listeners)
+        for wake in listeners:
+            wake()
+
+    def _has_news(self, after_id):
+        return bool(self.events) and self.events[-1]["id"] > after_id
+
+    def wait(self, after_id, timeout):
+        """Waits until an event newer than after_id arrives. Returns False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: self._has_news(after_id), timeout)
+
+    async def wait_async(self, after_id, timeout):
+        """Same as wait(), without holding a thread."""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(ready.set)
+
+        with self.cond:
+            if self._has_news(after_id):
+                return True
+            self.listeners.add(wake)
+        try:
+            await asyncio.wait_for(ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.cond:
+                self.listeners.discard(wake)
+
+    def since(self, after_id):
+        """Buffered events newer than after_id, or None if some of them were evicted."""
+        with self.cond:
+            if self.evicted > after_id:
+                return None
+            return [event for event in self.events if event["id"] > after_id]
+
+
+class StreamsExhausted(Exception):
+    """Raised when a process already serves as many event streams as it may."""
+
+
+class EventBroker:
+    """
+    Pushes job events to the streams watching them. Each job being watched
+    has its own topic, so an event only wakes the watchers of its job;
+    publishing an event of a job nobody watches is a dictionary lookup.
+    Events written by other processes are read by a single poller for all
+    watched jobs, so the database load does not grow with the watchers.
+    """
+
+    def __init__(self, buffer=JOB_EVENTS_BUFFER):
+        self.buffer = buffer
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._streams = {} # kind -> streams open
+        self._rejected = 0
+        self._poller = None
+
+    def publish(self, job_id, event):
+        with self._lock:
+            topic = self._topics.get(job_id)
+        if topic is not None:
+            topic.publish(event)
+
+    @contextmanager
+    def watch(self, job_id):
+        """Subscribes to a job's events for the duration of the block; yields its topic."""
+        with self._lock:
+            topic = self._topics.get(job_id)
+            if topic is None:
+                topic = self._topics[job_id] = _Topic(self.buffer)
+            topic.watchers += 1
+        try:
+            yield topic
+        finally:
+            with self._lock:
+                topic.watchers -= 1
+                if not topic.watchers:
+                    del self._topics[job_id]
+
+    def open_stream(self, kind, limit):
+        """Counts an open stream of a kind ("thread" or "async"); raises StreamsExhausted past limit."""
+        with self._lock:
+            if self._streams.get(kind, 0) >= limit:
+                self._rejected += 1
+                raise StreamsExhausted()
+            self._streams[kind] = self._streams.get(kind, 0) + 1
+
+    def close_stream(self, kind):
+        with self._lock:
+            self._streams[kind] -= 1
+
+    def start_polling(self, queue, interval=JOB_EVENTS_POLL_INTERVAL):
+        """Starts the thread that reads the watched jobs' events written by other processes."""
+        with self._lock:
+            if self._poller is not None:
+                return
+            self._poller = threading.Thread(target=self._poll, args=(queue, interval),
+                                            name="job-events-poller", daemon=True)
+        self._poller.start()
+
+    def _poll(self, queue, interval):
+        cursor = None
+        while True:
+            try:
+                with self._lock:
+                    job_ids = list(self._topics)
+                if cursor is None:
+                    _, cursor = queue.events_since([], 0)
+                events, cursor = queue.events_since(job_ids, cursor)
+                for job_id, event in events:
+                    self.publish(job_id, event)
+            except Exception as e:
+                log("warning", "Could not poll job events.", error=str(e))
+            time.sleep(interval)
+
+    def metrics(self):
+        with self._lock:
+            return {"jobs_watched": len(self._topics),
+                    "watchers": sum(topic.watchers for topic in self._topics.values()),
+                    "streams": dict(self._streams), "streams_rejected": self._rejected}
+
+
+broker = EventBroker()
+
+
+def format_event(event):
+    """One event in the Server-Sent Events wire format."""
+    data = {key: value for key, value in event.items() if key != "id"}
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(queue, job_id, last_event_id=0, keepalive=JOB_EVENTS_KEEPALIVE):
+    """
+    Yields the events of a job as Server-Sent Events, starting after
+    last_event_id (the Last-Event-ID header of a reconnecting client), and
+    ends once the job is done or failed. Events arrive through the broker;
+    the database is only read for the history and after falling behind.
+    """
+    # Subscribe before reading the history, so no event falls in between
+    with broker.watch(job_id) as topic:
+        last = last_event_id
+        events = queue.events(job_id, after=last)
+        if not events and _finished(queue, job_id):
+            return # Finished before last_event_id, or deleted
+        while True:
+            for event in events:
+                last = event["id"]
+                yield format_event(event)
+                if event["event"] in FINISHED:
+                    return
+            if topic.wait(last, keepalive):
+                events = topic.since(last)
+                if events is None:
+                    events = queue.events(job_id, after=last)
+            else:
+                events = []
+                yield ": keepalive\n\n"
+
+
+class EventStream:
+    """
+    The response body of an event stream served from a web request thread:
+    stream_events() counted against JOB_EVENTS_MAX_STREAMS from creation
+    until the server closes it. Raises StreamsExhausted when at the cap.
+    """
+
+    def __init__(self, queue, job_id, last_event_id=0, limit=JOB_EVENTS_MAX_STREAMS):
+        broker.open_stream("thread", limit)
+        self._events = stream_events(queue, job_id, last_event_id)
+        self._open = True
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self._events.close()
+            broker.close_stream("thread")
+
+
+async def stream_events_async(queue, job_id, last_event_id=0, keepalive=JOB_EVENTS_KEEPALIVE):
+    """Same as stream_events(), as an async generator that waits without holding a thread."""
+    with broker.watch(job_id) as topic:
+        last = last_event_id
+        events = await asyncio.to_thread(queue.events, job_id, last)
+        if not events and await asyncio.to_thread(_finished, queue, job_id):
+            return
+        while True:
+            for event in events:
+                last = event["id"]
+                yield format_event(event)
+                if event["event"] in FINISHED:
+                    return
+            if await topic.wait_async(last, keepalive):
+                events = topic.since(last)
+                if events is None:
+                    events = await asyncio.to_thread(queue.events, job_id, last)
+            else:
+                events = []
+                yield ": keepalive\n\n"
+
+
+def _finished(queue, job_id):
+    job = queue.get(job_id)
+    return job is None or job["status"] in FINISHED
+
+
+class StreamServer:
+    """
+    A minimal HTTP server for GET /jobs/<job_id>/events (with Last-Event-ID
+    or ?after=), run on the shared event loop, so thousands of watchers cost
+    a coroutine each instead of a web request thread.
+    """
+
+    def __init__(self, queue, max_streams=JOB_EVENTS_SERVER_MAX_STREAMS):
+        self.queue = queue
+        self.max_streams = max_streams
+
+    async def handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            lines = head.decode("latin-1").split("\r\n")
+            method, target = (lines[0].split(" ") + ["", ""])[:2]
+            headers = {name.strip().lower(): value.strip()
+                       for name, _, value in (line.partition(":") for line in lines[1:] if line)}
+            path, _, query = target.partition("?")
+            parts = path.strip("/").split("/")
+            if method != "GET" or len(parts) != 3 or parts[0] != "jobs" or parts[2] != "events":
+                return await self._reply(writer, "404 Not Found", "Not found.")
+            if await asyncio.to_thread(self.queue.get, parts[1]) is None:
+                return await self._reply(writer, "404 Not Found", "Unknown job.")
+            try:
+                after = int(headers.get("last-event-id") or parse_qs(query).get("after", ["0"])[0])
+            except ValueError:
+                after = 0
+            try:
+                broker.open_stream("async", self.max_streams)
+            except StreamsExhausted:
+                return await self._reply(writer, "503 Service Unavailable", "Too many event streams.",
+                                         f"Retry-After: {int(JOB_EVENTS_KEEPALIVE)}\r\n")
+            try:
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                             b"Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\n"
+                             b"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n")
+                async for chunk in stream_events_async(self.queue, parts[1], after):
+                    writer.write(chunk.encode("utf-8"))
+                    await writer.drain()
+            finally:
+                broker.close_stream("async")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass # The client went away
+        finally:
+            writer.close()
+
+    async def _reply(self, writer, status, message, extra_headers=""):
+        body = json.dumps({"status": "error", "message": message}).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                     f"{extra_headers}Connection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+
+def serve_streams(queue, port=JOB_EVENTS_PORT):
+    """
+    Starts the stream server on the shared event loop (see async_io). Every
+    web process binds the same port, and the kernel spreads connections
+    between them.
+    """
+    import async_io # Pulls in httpx and openai; only needed when the server is on
+
+    server = StreamServer(queue)
+    async_io.run(asyncio.start_server(server.handle, "0.0.0.0", port, reuse_port=True))
+    log("info", f"Serving job event streams on port {port}.")
+
+
+def events_url(base_url, job_id):
+    """Where a job's event stream is served: the stream server when it is public, else the web app."""
+    return f"{JOB_EVENTS_URL or base_url}/jobs/{job_id}/events"
+
+
+def job_summary(queue, job_id):
+    """
+    The job's status and the state of each stage of its current attempt,
+    with the timings reported by the pipeline. None if the job is unknown.
+    """
+    job = queue.get(job_id)
+    if job is None:
+        return None
+    stages = {}
+    events = queue.events(job_id)
+    for event in events:
+        if event["event"] == "running":
+            stages = {} # A new attempt
+        status = STAGE_EVENTS.get(event["event"])
+        if status is None:
+            continue
+        stage = stages.setdefault(event["stage"], {})
+        stage["status"] = status
+        for key in ("start", "duration", "error"):
+            if key in event:
+                stage[key] = event[key]
+    job["stages"] = stages
+    job["last_event_id"] = events[-1]["id"] if events else 0
+    return job
@@ -0,0 +1,147 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import Future
+
+import resilience
+from http_session import get_session
+from observability import log
+
+# How long the dispatcher waits for more emails before sending a batch. A job
+# finishing alone waits at most this long; jobs finishing together share calls.
+MAIL_BATCH_WINDOW = float(os.environ.get("MAIL_BATCH_WINDOW", 1.0))
+# Mailjet v3.1 accepts up to 50 messages per Send API call.
+MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE", 50))
+# Retries of a batch after a 429 that outlasted the rate limiter's own
+# retries. Other failures are only retried (by the resilience layer) when
+# Mailjet cannot have received the batch: nobody gets the same email twice.
+MAIL_MAX_RETRIES = int(os.environ.get("MAIL_MAX_RETRIES", 4))
+MAIL_RETRY_BASE_DELAY = float(os.environ.get("MAIL_RETRY_BASE_DELAY", 1.0))
+
+
+class MailError(Exception):
+    """Raised for a message Mailjet rejected, or a batch that could not be sent."""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+class MailDispatcher:
+    """
+    Coalesces emails into Mailjet v3.1 bulk sends.
+
+    submit() queues one message and returns a Future. A background thread
+    collects messages for MAIL_BATCH_WINDOW seconds (or until MAIL_BATCH_SIZE
+    are waiting) and posts them in one call over the shared session. Mailjet
+    answers with one result per message, in order, so each Future gets its
+    own outcome. Calls go through resilience.call("mailjet"), with its
+    deadline, breaker and rate limiter, as a call that must not be repeated:
+    when Mailjet may have received a batch that failed, every message of it
+    fails with resilience.OutcomeUnknown instead of being sent again.
+    """
+
+    def __init__(self, url, auth, window=MAIL_BATCH_WINDOW, batch_size=MAIL_BATCH_SIZE,
+                 max_retries=MAIL_MAX_RETRIES, base_delay=MAIL_RETRY_BASE_DELAY):
+        self.url = url
+        self.auth = auth
+        self.window = window
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._calls = 0
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+
+    def submit(self, message):
+        """Queues a Mailjet message dict. The Future resolves to its Mailjet result."""
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mail-dispatcher", daemon=True)
+                self._thread.start()
+            self._pending.append((message, future))
+            self._cond.notify()
+        return future
+
+    def send(self, message, timeout=None):
+        """Queues a message and waits for its result."""
+        return self.submit(message).result(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.batch_size]
+                del self._pending[:len(batch)]
+            try:
+                self._send_batch(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _send_batch(self, batch):
+        payload = {"Messages": [message for message, _ in batch]}
+        for attempt in range(self.max_retries + 1):
+            delay = self.base_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            self._calls += 1
+            try:
+                response = resilience.call(
+                    "mailjet", lambda: get_session().post(self.url, json=payload, auth=self.auth), idempotent=False
+                )
+            except Exception:
+                self._failed += len(batch)
+                raise
+            if response.status_code != 429:
+                self._resolve(batch, response)
+                return
+            # Throttled requests are not processed, so the batch can go again
+            if attempt < self.max_retries:
+                self._retries += 1
+                log("warning", "Mailjet rate limit exceeded, retrying the batch.", emails=len(batch),
+                    attempt=attempt + 2)
+                time.sleep(delay)
+        self._failed += len(batch)
+        raise MailError("Mailjet rate limit exceeded.")
+
+    def _resolve(self, batch, response):
+        """Hands each message its own result; a 400 can still carry successes."""
+        try:
+            results = response.json().get("Messages") or []
+        except ValueError:
+            results = []
+        log("info", "Mailjet batch sent.", emails=len(batch), status=response.status_code)
+        for index, (message, future) in enumerate(batch):
+            result = results[index] if index < len(results) else None
+            if result is not None and result.get("Status") == "success":
+                self._sent += 1
+                future.set_result(result)
+            else:
+                self._failed += 1
+                errors = (result or {}).get("Errors") or []
+                future.set_exception(MailError(
+                    f"Mailjet rejected the email to {message['To'][0]['Email']} (HTTP {response.status_code}).", errors
+                ))
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "api_calls": self._calls,
+                "sent": self._sent,
+                "failed": self._failed,
+                "retries": self._retries,
+            }
@@ -1,95 +1,347 @@
 import os
-import requests
+import json
+import uuid
 import base64
-from mailjet_rest import Client
+import shutil
+import asyncio
+import subprocess
+import requests
+import httpx
+
+import async_io
+import resilience
+from http_session import get_session
+from mail_dispatcher import MailDispatcher
+from scratch import scratch
+from voice_generator import local_temp_path
+from video_processor import local_artifact
+from observability import log
 
 # Get Mailjet credentials from environment variables
 MAILJET_API_KEY = os.environ.get('MAILJET_API_KEY')
 MAILJET_API_SECRET = os.environ.get('MAILJET_API_SECRET')
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL') # The email you verified with Mailjet
+# Mailjet Send API endpoint. Emails without attachments are batched by the
+# mail dispatcher; attachment emails are streamed to it one by one.
+# Overridable so the benchmarks can point it at a local stand-in.
+MAILJET_SEND_URL = os.environ.get("MAILJET_SEND_URL", "https://api.mailjet.com/v3.1/send")
+# Largest video sent as an attachment. Mailjet caps a message at 15 MB and
+# base64 makes the attachment a third bigger, so stay well below 11 MB.
+EMAIL_ATTACHMENT_MAX_BYTES = int(os.environ.get("EMAIL_ATTACHMENT_MAX_BYTES", 10 * 1024 * 1024))
+# Larger videos get a low-resolution preview attachment (when ffmpeg is
+# available) next to the download link; set to 0 to send the link only.
+EMAIL_PREVIEW_ENABLED = os.environ.get("EMAIL_PREVIEW_ENABLED", "1") != "0"
+EMAIL_PREVIEW_HEIGHT = int(os.environ.get("EMAIL_PREVIEW_HEIGHT", 360))
+# Raw bytes read per step while base64-encoding; a multiple of 3 so the
+# encoded pieces can be concatenated.
+ENCODE_BLOCK_SIZE = 3 * 64 * 1024
+
+ATTACHMENT = "attachment"
+PREVIEW = "preview"
+LINK = "link"
+_mail_dispatcher = None
+
+def get_mail_dispatcher():
+    """ Returns the process-wide dispatcher that batches emails into bulk Mailjet calls. """
+    global _mail_dispatcher
+    if _mail_dispatcher is None:
+        _mail_dispatcher = MailDispatcher(MAILJET_SEND_URL, (MAILJET_API_KEY, MAILJET_API_SECRET))
+    return _mail_dispatcher
+
+def choose_delivery(size):
+    """
+    Picks how the video reaches the client from its size in bytes: attached
+    as is, as a compressed preview next to the link, or as a link only.
+    """
+    if size is None:
+        return LINK
+    if size <= EMAIL_ATTACHMENT_MAX_BYTES:
+        return ATTACHMENT
+    if EMAIL_PREVIEW_ENABLED and shutil.which("ffmpeg"):
+        return PREVIEW
+    return LINK
+
+
+class Base64JsonBody:
+    """
+    A file-like Mailjet request body whose attachment is base64-encoded from
+    a file on disk while the request is being sent. Only one block is held in
+    memory at a time, and the length is known up front, so the request goes
+    out with a Content-Length instead of chunked encoding.
+    """
+
+    def __init__(self, messages, placeholder, path):
+        text = json.dumps({"Messages": messages})
+        prefix, suffix = text.split(placeholder)
+        self._prefix = prefix.encode("utf-8")
+        self._suffix = suffix.encode("utf-8")
+        self._path = path
+        size = os.path.getsize(path)
+        self._length = len(self._prefix) + (size + 2) // 3 * 4 + len(self._suffix)
+        self._chunks = None
+        self._buffer = b""
+        self._offset = 0
+
+    def __len__(self):
+        return self._length
+
+    def chunks(self):
+        yield self._prefix
+        with open(self._path, "rb") as f:
+            for block in iter(lambda: f.read(ENCODE_BLOCK_SIZE), b""):
+                yield base64.b64encode(block)
+        yield self._suffix
+
+    async def achunks(self):
+        for chunk in self.chunks():
+            yield chunk
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = self.chunks()
+        parts, wanted = [], size
+        while size < 0 or wanted > 0:
+            if self._offset >= len(self._buffer):
+                self._buffer, self._offset = next(self._chunks, b""), 0
+                if not self._buffer:
+                    break
+            end = len(self._buffer) if size < 0 else self._offset + wanted
+            part = self._buffer[self._offset:end]
+            self._offset += len(part)
+            wanted -= len(part)
+            parts.append(part)
+        return b"".join(parts)
+
+
+def _local_video(video_url):
+    """ Returns (path, size) when the video is stored on this host, else (None, None). """
+    path, metadata = local_artifact(video_url)
+    if path is None:
+        path = local_temp_path(video_url)
+    if path is None:
+        return None, None
+    return path, os.path.getsize(path)
+
+def _content_length(response):
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+def make_preview(video_path):
+    """
+    Encodes a small, low-bitrate copy of the video for attaching. Returns its
+    path, or None if FFmpeg fails or the preview is still too big to attach.
+    """
+    preview_path = os.path.join(os.path.dirname(video_path), f"preview_{uuid.uuid4().hex}.mp4")
+    command = [
+        "ffmpeg", "-y", "-i", video_path,
+        "-vf", f"scale=-2:{EMAIL_PREVIEW_HEIGHT}", "-r", "15",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "32",
+        "-c:a", "aac", "-b:a", "64k", "-movflags", "+faststart",
+        preview_path
+    ]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0 or not os.path.exists(preview_path):
+        log("warning", "Preview encoding failed.", stderr=result.stderr[-500:])
+        return None
+    if os.path.getsize(preview_path) > EMAIL_ATTACHMENT_MAX_BYTES:
+        log("warning", "Preview is still too big to attach.", bytes=os.path.getsize(preview_path))
+        os.remove(preview_path)
+        return None
+    return preview_path
+
+def _attachment_body(recipient_email, video_url, project_name, path, preview):
+    placeholder = uuid.uuid4().hex
+    message = _video_message(recipient_email, video_url, project_name, placeholder, preview=preview)
+    return Base64JsonBody([message], placeholder, path)
+
+def _remove(paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
 
 def send_video_to_client(recipient_email, video_url, project_name):
     """
     Sends the generated video to the client via email using Mailjet.
-    The video is downloaded and attached directly to the email.
+    The delivery is chosen from the video size (see choose_delivery). Videos
+    are never loaded into memory: a remote video is streamed to the scratch
+    space, and the attachment is base64-encoded while the request is sent.
     """
     if not all([MAILJET_API_KEY, MAILJET_API_SECRET, SENDER_EMAIL]):
         raise ValueError("Mailjet API credentials and sender email must be set in environment variables.")
 
-    # 1. Download the video content
+    temporary = []
     try:
-        print(f"[*] Downloading video from {video_url} to attach to email...")
-        response = requests.get(video_url)
-        response.raise_for_status()
-        video_content = response.content
-        print("[*] Video downloaded successfully.")
+        # 1. Find out how big the video is
+        video_path, size = _local_video(video_url)
+        if video_path is None:
+            response = get_session().head(video_url, allow_redirects=True)
+            size = _content_length(response) if response.ok else None
+        delivery = choose_delivery(size)
+        log("info", "Chose email delivery.", bytes=size, delivery=delivery)
+        if delivery == LINK:
+            send_video_link_to_client(recipient_email, video_url, project_name)
+            return
+
+        # 2. Get the video onto local disk
+        if video_path is None:
+            video_path = scratch.path(f"email_{uuid.uuid4().hex}.mp4")
+            temporary.append(video_path)
+            log("info", "Downloading the video to attach it.", url=video_url)
+            with get_session().get(video_url, stream=True) as response:
+                response.raise_for_status()
+                with open(video_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=256 * 1024):
+                        f.write(chunk)
+            log("info", "Video downloaded.")
     except requests.exceptions.RequestException as e:
-        print(f"[!] Failed to download video for emailing: {e}. Sending link only.")
+        _remove(temporary)
+        log("warning", "Could not download the video to attach it, sending the link only.", error=str(e))
         send_video_link_to_client(recipient_email, video_url, project_name)
         return
 
-    # 2. Initialize Mailjet client
-    mailjet = Client(auth=(MAILJET_API_KEY, MAILJET_API_SECRET), version='v3.1')
+    try:
+        # 3. Shrink it if it is too big to attach
+        if delivery == PREVIEW:
+            preview_path = make_preview(video_path)
+            if preview_path is None:
+                send_video_link_to_client(recipient_email, video_url, project_name)
+                return
+            temporary.append(preview_path)
+            video_path = preview_path
 
-    # 3. Encode attachment
-    encoded_content = base64.b64encode(video_content).decode('utf-8')
+        # 4. Send the email, encoding the attachment on the fly (with a fresh
+        # body for each attempt, since a body can only be read once). It is
+        # only sent again if Mailjet cannot have received it, so the customer
+        # never gets the video twice
+        result = resilience.call("mailjet", lambda: get_session().post(
+            MAILJET_SEND_URL, auth=(MAILJET_API_KEY, MAILJET_API_SECRET), headers={"Content-Type": "application/json"},
+            data=_attachment_body(recipient_email, video_url, project_name, video_path, delivery == PREVIEW)
+        ), idempotent=False)
+        log("info", "Email sent.", recipient=recipient_email, status=result.status_code)
+        if result.status_code != 200:
+            log("error", "Mailjet rejected the email.", recipient=recipient_email, response=result.json())
+    except Exception as e:
+        log("error", "Sending the email with Mailjet failed.", recipient=recipient_email, error=str(e))
+        raise
+    finally:
+        _remove(temporary)
 
-    # 4. Prepare email data
-    data = {
-        'Messages': [
-            {
-                "From": {
-                    "Email": SENDER_EMAIL,
-                    "Name": "Automated Video Team"
-                },
-                "To": [
-                    {
-                        "Email": recipient_email,
-                        "Name": "Valued Client"
-                    }
-                ],
-                "Subject": f"Your Video for '{project_name}' is Ready!",
-                "HTMLPart": f"""
-                    <h3>Hello,</h3>
-                    <p>Thank you for your order! Your custom video for the project '<strong>{project_name}</strong>' is complete and attached to this email.</p>
-                    <p>You can also download it directly from this link: <a href='{video_url}'>Download Video</a></p>
-                    <p>We hope you love it!</p>
-                """,
-                "Attachments": [
-                    {
-                        "ContentType": "video/mp4",
-                        "Filename": f"{project_name.replace(' ', '_')}_video.mp4",
-                        "Base64Content": encoded_content
-                    }
-                ]
-            }
-        ]
-    }
+def send_video_link_to_client(recipient_email, video_url, project_name):
+    """
+    Sends only the video link, for videos too big to attach or when the
+    attachment fails. The email joins the next Mailjet bulk send.
+    """
+    result = get_mail_dispatcher().send(_link_message(recipient_email, video_url, project_name))
+    log("info", "Email (link only) sent.", recipient=recipient_email, status=result.get('Status'))
+
+async def send_video_to_client_async(recipient_email, video_url, project_name):
+    """
+    Async variant of send_video_to_client. It uses the shared httpx client for
+    the size probe, the download and the Mailjet v3.1 REST API, and encodes
+    the preview on a thread.
+    """
+    if not all([MAILJET_API_KEY, MAILJET_API_SECRET, SENDER_EMAIL]):
+        raise ValueError("Mailjet API credentials and sender email must be set in environment variables.")
 
-    # 5. Send the email
+    client = async_io.get_http_client()
+    auth = (MAILJET_API_KEY, MAILJET_API_SECRET)
+    temporary = []
     try:
-        result = mailjet.send.create(data=data)
-        print(f"[*] Email sent to {recipient_email}. Status: {result.status_code}")
+        video_path, size = _local_video(video_url)
+        if video_path is None:
+            response = await client.head(video_url, follow_redirects=True)
+            size = _content_length(response) if response.is_success else None
+        delivery = choose_delivery(size)
+        log("info", "Chose email delivery.", bytes=size, delivery=delivery)
+
+        if delivery != LINK and video_path is None:
+            video_path = scratch.path(f"email_{uuid.uuid4().hex}.mp4")
+            temporary.append(video_path)
+            log("info", "Downloading the video to attach it.", url=video_url)
+            async with client.stream("GET", video_url, follow_redirects=True) as response:
+                response.raise_for_status()
+                with open(video_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(256 * 1024):
+                        f.write(chunk)
+            log("info", "Video downloaded.")
+        if delivery == PREVIEW:
+            preview_path = await asyncio.to_thread(make_preview, video_path)
+            if preview_path is None:
+                delivery = LINK
+            else:
+                temporary.append(preview_path)
+                video_path = preview_path
+    except httpx.HTTPError as e:
+        log("warning", "Could not download the video to attach it, sending the link only.", error=str(e))
+        delivery = LINK
+
+    try:
+        if delivery == LINK:
+            result = await asyncio.wrap_future(
+                get_mail_dispatcher().submit(_link_message(recipient_email, video_url, project_name))
+            )
+            log("info", "Email (link only) sent.", recipient=recipient_email, status=result.get('Status'))
+            return
+        async def post():
+            body = _attachment_body(recipient_email, video_url, project_name, video_path, delivery == PREVIEW)
+            return await client.post(MAILJET_SEND_URL, content=body.achunks(), auth=auth,
+                                     headers={"Content-Type": "application/json", "Content-Length": str(len(body))})
+        result = await resilience.call_async("mailjet", post, idempotent=False)
+        log("info", "Email sent.", recipient=recipient_email, status=result.status_code)
         if result.status_code != 200:
-            print(f"[!] Mailjet Error: {result.json()}")
+            log("error", "Mailjet rejected the email.", recipient=recipient_email, response=result.json())
     except Exception as e:
-        print(f"[!] An error occurred while sending email with Mailjet: {e}")
+        log("error", "Sending the email with Mailjet failed.", recipient=recipient_email, error=str(e))
         raise
+    finally:
+        _remove(temporary)
 
-def send_video_link_to_client(recipient_email, video_url, project_name):
-    """ A fallback method to send only the video link if the attachment fails. """
-    mailjet = Client(auth=(MAILJET_API_KEY, MAILJET_API_SECRET), version='v3.1')
-    data = {
-        'Messages': [{
-            "From": {"Email": SENDER_EMAIL, "Name": "Automated Video Team"},
-            "To": [{"Email": recipient_email}],
-            "Subject": f"Your Video for '{project_name}' is Ready!",
-            "HTMLPart": f"""
-                <h3>Hello,</h3>
-                <p>Thank you for your order! Your custom video for '<strong>{project_name}</strong>' is ready.</p>
-                <p>Please download it here: <a href='{video_url}'>Download Video</a></p>
-            """
-        }]
+def _video_message(recipient_email, video_url, project_name, encoded_content, preview=False):
+    """
+    Builds the Mailjet message carrying the video as an attachment. With
+    preview=True the attachment is a reduced copy and the link is the way to
+    the full-quality video.
+    """
+    if preview:
+        attached = "A preview is attached to this email; the full-quality video is available from the link below."
+    else:
+        attached = "It is attached to this email."
+    return {
+        "From": {
+            "Email": SENDER_EMAIL,
+            "Name": "Automated Video Team"
+        },
+        "To": [
+            {
+                "Email": recipient_email,
+                "Name": "Valued Client"
+            }
+        ],
+        "Subject": f"Your Video for '{project_name}' is Ready!",
+        "HTMLPart": f"""
+            <h3>Hello,</h3>
+            <p>Thank you for your order! Your custom video for the project '<strong>{project_name}</strong>' is complete. {attached}</p>
+            <p>You can also download it directly from this link: <a href='{video_url}'>Download Video</a></p>
+            <p>We hope you love it!</p>
+        """,
+        "Attachments": [
+            {
+                "ContentType": "video/mp4",
+                "Filename": f"{project_name.replace(' ', '_')}_{'preview' if preview else 'video'}.mp4",
+                "Base64Content": encoded_content
+            }
+        ]
+    }
+
+def _link_message(recipient_email, video_url, project_name):
+    """ Builds the Mailjet message carrying only a download link. """
+    return {
+        "From": {"Email": SENDER_EMAIL, "Name": "Automated Video Team"},
+        "To": [{"Email": recipient_email}],
+        "Subject": f"Your Video for '{project_name}' is Ready!",
+        "HTMLPart": f"""
+            <h3>Hello,</h3>
+            <p>Thank you for your order! Your custom video for '<strong>{project_name}</strong>' is ready.</p>
+            <p>Please download it here: <a href='{video_url}'>Download Video</a></p>
+        """
     }
-    result = mailjet.send.create(data=data)
-    print(f"[*] Fallback email (link only) sent. Status: {result.status_code}")
\ No newline at end of file
@@ -0,0 +1,369 @@
+# Metrics, spans and structured logging, shared by the agent and the merger
+# service. Gemini/video-merger/observability/ holds a copy, so the merger
+# builds from its own directory; edit this one and copy it over
+# (tests/test_observability.py fails while the two differ). Both services
+# import it as "observability", so the agent's local merges log and count
+# through the same registry as the rest of the agent.
+import os
+import sys
+import json
+import time
+import uuid
+import atexit
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# "json" writes one JSON object per log line; "text" writes the classic
+# "[*] message key=value" lines for reading in a terminal.
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# Lines below this level (debug, info, warning, error) are dropped.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "info")
+# Log lines are written by a background thread every LOG_FLUSH_INTERVAL
+# seconds, or as soon as LOG_BUFFER_LINES are waiting, instead of one write
+# and flush per line.
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 0.5))
+LOG_BUFFER_LINES = int(os.environ.get("LOG_BUFFER_LINES", 1000))
+
+# Upper bounds (seconds) of the latency histogram buckets, from fast cache
+# hits to long FFmpeg encodes.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+# Upper bounds (bytes) of the size histogram buckets, 1 KiB to 1 GiB.
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+_PREFIXES = {"debug": "[.]", "info": "[*]", "warning": "[!]", "error": "[!]"}
+
+# The span in progress. Work started from a span inherits it through the
+# context (e.g. pipeline stages, see pipeline.Pipeline), so the spans and log
+# lines of one job share its trace ID.
+_current_span = contextvars.ContextVar("telemetry_span", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. requests sent or bytes received."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, e.g. jobs in flight."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Observations counted into fixed buckets, as Prometheus expects them.
+    quantile() estimates p50/p95/p99 from the buckets, so memory stays
+    constant however many observations are made.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _quantile(self, counts, q):
+        """Linear interpolation inside the bucket holding the q-th observation."""
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-2]
+
+    def quantile(self, q, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels)) or ([], 0.0)
+            counts = list(counts)
+        return self._quantile(counts, q)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", dict(labels, le=_format_value(float(bucket))), cumulative))
+            samples.append((f"{self.name}_sum", labels, round(total, 6)))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+    def summary(self):
+        """[{labels, count, sum, p50, p95, p99}] per label set."""
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        summary = []
+        for key, counts, total in values:
+            entry = {"labels": self._labels(key), "count": sum(counts), "sum": round(total, 3)}
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                value = self._quantile(counts, q)
+                entry[name] = round(value, 3) if value is not None else None
+            summary.append(entry)
+        return summary
+
+
+class Registry:
+    """
+    The metrics of the process. Metrics are created once at import time by
+    the modules that update them; collectors are callbacks that read state
+    owned elsewhere (queue depth, cache counters) when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def register_collector(self, collect):
+        """
+        collect() returns an iterable of (name, type, help, labels, value);
+        it is called on every scrape.
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        families = {}
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            families[metric.name] = (metric.type, metric.help, metric.samples())
+        for collect in collectors:
+            try:
+                for name, type, help, labels, value in collect():
+                    families.setdefault(name, (type, help, []))[2].append((name, labels, value))
+            except Exception as e:
+                log("warning", "Metrics collector failed", error=str(e))
+
+        lines = []
+        for name, (type, help, samples) in families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def latency_summary(self):
+        """p50/p95/p99 of every histogram, for humans."""
+        with self._lock:
+            histograms = [m for m in self._metrics.values() if isinstance(m, Histogram)]
+        return {metric.name: metric.summary() for metric in histograms}
+
+
+registry = Registry()
+
+
+# Structured logging
+
+class _LogBuffer:
+    """Collects formatted lines and writes them to stdout in batches from a daemon thread."""
+
+    def __init__(self, stream=None, interval=LOG_FLUSH_INTERVAL, max_lines=LOG_BUFFER_LINES):
+        self.stream = stream
+        self.interval = interval
+        self.max_lines = max_lines
+        self._lines = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._dropped = 0
+
+    def write(self, line):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+            if len(self._lines) >= self.max_lines * 10:
+                self._dropped += 1 # stdout is stuck; never let logging eat the memory
+                return
+            self._lines.append(line)
+            if len(self._lines) >= self.max_lines:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            lines, self._lines = self._lines, []
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            lines.append(_format("warning", f"Dropped {dropped} log line(s).", {}))
+        if lines:
+            stream = self.stream or sys.stdout
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+
+
+_buffer = _LogBuffer()
+atexit.register(_buffer.flush)
+
+
+def _format(level, message, fields):
+    if LOG_FORMAT == "text":
+        extra = " ".join(f"{key}={value}" for key, value in fields.items())
+        return f"{_PREFIXES.get(level, '[*]')} {message}" + (f" ({extra})" if extra else "")
+    record = {"ts": round(time.time(), 3), "level": level, "msg": message}
+    record.update(fields)
+    return json.dumps(record, default=str, ensure_ascii=False)
+
+
+def log(level, message, **fields):
+    """
+    Writes a structured log line. The trace and span of the current context
+    are added, so every line of a job can be found by its trace_id.
+    """
+    if LEVELS.get(level, 20) < LEVELS.get(LOG_LEVEL, 20):
+        return
+    span = _current_span.get()
+    if span is not None:
+        fields = dict({"trace_id": span.trace_id, "span": span.name}, **fields)
+    _buffer.write(_format(level, message, fields))
+
+
+def flush_logs():
+    _buffer.flush()
+
+
+# Tracing
+
+class Span:
+    def __init__(self, name, trace_id, parent_id):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+
+
+@contextmanager
+def span(name, histogram=None, trace_id=None, **labels):
+    """
+    Times a block as a span of the current trace (a new trace if there is
+    none, or the given trace_id), logs it when it ends, and observes its
+    duration in `histogram` with the labels and outcome="ok"/"error".
+    """
+    parent = _current_span.get()
+    current = Span(name, trace_id or (parent.trace_id if parent else uuid.uuid4().hex),
+                   parent.span_id if parent else None)
+    token = _current_span.set(current)
+    start = time.monotonic()
+    outcome = "ok"
+    try:
+        yield current
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        duration = time.monotonic() - start
+        _current_span.reset(token)
+        if histogram is not None:
+            histogram.observe(duration, outcome=outcome, **labels)
+        log("debug", "span",
+            trace_id=current.trace_id, span=name, span_id=current.span_id, parent_id=current.parent_id,
+            duration=round(duration, 3), outcome=outcome, **labels)
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
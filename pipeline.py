@@ -0,0 +1,257 @@
+import time
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from observability import registry, span, log
+
+STAGE_SECONDS = registry.histogram(
+    "pipeline_stage_seconds", "Duration of pipeline stages.", ["stage", "outcome"]
+)
+STAGES_RESUMED = registry.counter(
+    "pipeline_stages_resumed_total", "Stages restored from a checkpoint instead of run.", ["stage"]
+)
+
+
+class Stage:
+    """
+    One step of the video pipeline.
+
+    `func` is called with the results of its dependencies as keyword
+    arguments, e.g. Stage("voice", generate_voice_over, deps=["script"])
+    calls generate_voice_over(script=<result of the script stage>).
+
+    With a `checkpoint_ttl` (seconds), the stage's result is saved when it
+    succeeds, and a later run of the same job reuses it for that long instead
+    of calling the stage again. The result must be JSON serializable.
+    `checkpoint_ttl` can also be a function of the result, for results that
+    expire on their own (e.g. a signed URL); the result is not saved when it
+    returns 0 or less.
+    """
+
+    def __init__(self, name, func, deps=(), checkpoint_ttl=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.checkpoint_ttl = checkpoint_ttl
+
+
+class Cancelled(Exception):
+    """
+    Raised by a progress or checkpoint hook to stop a run between stages,
+    e.g. because its job was handed to another worker. It is not wrapped in
+    a PipelineError and the stages that have not started never run.
+    """
+
+
+class PipelineError(Exception):
+    """Raised when a stage fails; carries the stage name and the timings so far."""
+
+    def __init__(self, stage, error, timings):
+        super().__init__(f"Stage '{stage}' failed: {error}")
+        self.stage = stage
+        self.error = error
+        self.timings = timings
+
+
+class Pipeline:
+    """
+    Runs a set of stages as a dependency graph. Every stage starts as soon as
+    all of its dependencies have finished, so independent stages (e.g. script
+    and image generation) overlap and the total latency follows the longest
+    path through the graph instead of the sum of all stages.
+    """
+
+    def __init__(self, stages):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dep}'.")
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Pipeline has a dependency cycle through '{name}'.")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _resume(self, checkpoints):
+        """
+        Returns (results, timings, pending) for a run that picks up saved
+        stage results. Stages are only pending if something still needs
+        them: a stage whose dependants were all restored is skipped.
+        """
+        saved = checkpoints.load() if checkpoints is not None else {}
+        results = {name: saved[name] for name, stage in self.stages.items()
+                   if stage.checkpoint_ttl and name in saved}
+        timings = {name: {"start": 0.0, "duration": 0.0, "resumed": True} for name in results}
+        for name in results:
+            STAGES_RESUMED.inc(stage=name)
+
+        needed = set()
+
+        def need(name):
+            if name in results or name in needed:
+                return
+            needed.add(name)
+            for dep in self.stages[name].deps:
+                need(dep)
+
+        dependants = {dep for stage in self.stages.values() for dep in stage.deps}
+        for name in self.stages:
+            if name not in dependants:
+                need(name)
+        return results, timings, {name: self.stages[name] for name in self.stages if name in needed}
+
+    def _report(self, progress, event, stage, **data):
+        """Tells `progress` about a stage; a failing status update never fails the job."""
+        if progress is None:
+            return
+        try:
+            progress(event, stage=stage, **data)
+        except Cancelled:
+            raise
+        except Exception as e:
+            log("warning", "Could not report stage progress.", stage=stage, progress_event=event, error=str(e))
+
+    def _save(self, checkpoints, name, result):
+        stage = self.stages[name]
+        if checkpoints is None or not stage.checkpoint_ttl:
+            return
+        ttl = stage.checkpoint_ttl(result) if callable(stage.checkpoint_ttl) else stage.checkpoint_ttl
+        if ttl > 0:
+            checkpoints.save(name, result, ttl)
+
+    def run(self, checkpoints=None, progress=None):
+        """
+        Executes the graph and returns (results, timings).
+
+        results maps each stage name to its return value. timings maps each
+        stage name to {"start": offset, "duration": seconds}, both relative to
+        the start of the run.
+
+        checkpoints (see job_queue.Checkpoints) stores the results of
+        checkpointed stages, so that a retried job resumes at the stage that
+        failed. Restored stages are marked "resumed" in the timings.
+
+        progress(event, stage=..., **data), e.g. JobQueue.progress, is told
+        about every stage_started, stage_done, stage_failed and stage_resumed,
+        with the stage's timing once it has one. Either hook may raise
+        Cancelled to stop the run before its next stage starts.
+        """
+        results, timings, pending = self._resume(checkpoints)
+        running = {}
+        t0 = time.monotonic()
+        for name in results:
+            self._report(progress, "stage_resumed", name)
+
+        def timed(stage):
+            start = time.monotonic()
+            try:
+                with span(stage.name, STAGE_SECONDS, stage=stage.name):
+                    return stage.func(**{dep: results[dep] for dep in stage.deps})
+            finally:
+                timings[stage.name] = {
+                    "start": round(start - t0, 3),
+                    "duration": round(time.monotonic() - start, 3),
+                }
+
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+            try:
+                while pending or running:
+                    for name in [n for n, s in pending.items() if all(d in results for d in s.deps)]:
+                        # Reported first, so a cancelled run never starts the stage
+                        self._report(progress, "stage_started", name)
+                        # Each stage runs in a copy of the caller's context, so
+                        # context variables (e.g. the scratch job) follow it
+                        ctx = contextvars.copy_context()
+                        running[executor.submit(ctx.run, timed, pending.pop(name))] = name
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        try:
+                            results[name] = future.result()
+                        except Exception as e:
+                            for other in running:
+                                other.cancel()
+                            self._report(progress, "stage_failed", name, error=str(e), **timings.get(name, {}))
+                            raise PipelineError(name, e, timings) from e
+                        self._save(checkpoints, name, results[name])
+                        self._report(progress, "stage_done", name, **timings[name])
+            except Cancelled:
+                for other in running:
+                    other.cancel()
+                raise
+
+        timings["total"] = {"start": 0.0, "duration": round(time.monotonic() - t0, 3)}
+        return results, timings
+
+    async def run_async(self, checkpoints=None, progress=None):
+        """
+        Same as run(), for stages whose functions are coroutines. Stages run as
+        tasks on the current event loop instead of on threads.
+        """
+        results, timings, pending = self._resume(checkpoints)
+        running = {}
+        t0 = time.monotonic()
+        for name in results:
+            self._report(progress, "stage_resumed", name)
+
+        async def timed(stage):
+            start = time.monotonic()
+            try:
+                with span(stage.name, STAGE_SECONDS, stage=stage.name):
+                    return await stage.func(**{dep: results[dep] for dep in stage.deps})
+            finally:
+                timings[stage.name] = {
+                    "start": round(start - t0, 3),
+                    "duration": round(time.monotonic() - start, 3),
+                }
+
+        try:
+            while pending or running:
+                for name in [n for n, s in pending.items() if all(d in results for d in s.deps)]:
+                    self._report(progress, "stage_started", name)
+                    running[asyncio.ensure_future(timed(pending.pop(name)))] = name
+
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    name = running.pop(task)
+                    try:
+                        results[name] = task.result()
+                    except Exception as e:
+                        for other in running:
+                            other.cancel()
+                        self._report(progress, "stage_failed", name, error=str(e), **timings.get(name, {}))
+                        raise PipelineError(name, e, timings) from e
+                    self._save(checkpoints, name, results[name])
+                    self._report(progress, "stage_done", name, **timings[name])
+        except Cancelled:
+            for other in running:
+                other.cancel()
+            raise
+
+        timings["total"] = {"start": 0.0, "duration": round(time.monotonic() - t0, 3)}
+        return results, timings
+
+
+def format_timings(timings):
+    """Renders stage timings as a single human-readable line for the logs."""
+    ordered = sorted(timings.items(), key=lambda item: (item[0] == "total", item[1]["start"]))
+    return ", ".join(
+        f"{name}=resumed" if timing.get("resumed") else f"{name}={timing['duration']:.2f}s"
+        for name, timing in ordered
+    )
@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from scheduling import current_priority, is_reserved, rank
+from observability import log
+
+# Per-provider budgets, as JSON merged over DEFAULT_LIMITS, e.g.
+#   {"openai-image": {"rpm": 7}, "elevenlabs": {"concurrency": 10}}
+# rpm/tpm are requests and tokens per minute (null for no budget) and
+# concurrency the most calls in flight at once; the adaptive limit moves
+# between reserved + 1 and that ceiling. reserved slots of that limit are only
+# handed to the high tier (scheduling.RESERVED_PRIORITIES), so a rush order
+# never waits behind a campaign for one of the few DALL·E or merger slots.
+# The budgets are for the whole deployment: each worker process takes an
+# equal share of them (see RateLimiter.share), but always keeps its reserved
+# slots plus one for everybody else.
+RATE_LIMITS = os.environ.get("RATE_LIMITS", "")
+# Retries of a call answered with 429, after waiting for Retry-After.
+RATE_LIMIT_RETRIES = int(os.environ.get("RATE_LIMIT_RETRIES", 3))
+# Pause applied after a 429 that carries no Retry-After header.
+RATE_LIMIT_DEFAULT_BACKOFF = float(os.environ.get("RATE_LIMIT_DEFAULT_BACKOFF", 2.0))
+# Seconds of budget a bucket can accumulate and spend in a burst.
+RATE_LIMIT_BURST_SECONDS = float(os.environ.get("RATE_LIMIT_BURST_SECONDS", 10))
+
+DEFAULT_LIMITS = {
+    "openai-chat": {"rpm": 500, "tpm": 30000, "concurrency": 16},
+    "openai-image": {"rpm": 5, "tpm": None, "concurrency": 5, "reserved": 1},
+    "elevenlabs": {"rpm": None, "tpm": None, "concurrency": 4},
+    "merger": {"rpm": None, "tpm": None, "concurrency": 4, "reserved": 1},
+    "mailjet": {"rpm": 300, "tpm": None, "concurrency": 4},
+}
+
+# The customer a call is made for. Slots of a busy provider go to the waiting
+# tenant with the fewest calls in flight, so one large campaign cannot crowd
+# out everybody else.
+_tenant = contextvars.ContextVar("rate_limit_tenant", default=None)
+
+
+@contextmanager
+def tenant_scope(tenant):
+    """Attributes every call made from this block (and its pipeline stages) to tenant."""
+    token = _tenant.set(tenant)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+def estimate_chat_tokens(request):
+    """Rough token cost of a chat completion: ~4 characters per prompt token, plus the completion budget."""
+    characters = sum(len(m.get("content") or "") for m in request.get("messages", []))
+    return characters // 4 + request.get("max_tokens", 0)
+
+
+def status_and_retry_after(outcome):
+    """Finds an HTTP status and Retry-After in a response or an exception raised for one."""
+    response = getattr(outcome, "response", None)
+    if response is None and hasattr(outcome, "status_code"):
+        response = outcome
+    status = getattr(response, "status_code", None) or getattr(outcome, "status_code", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        retry_after = float(headers.get("Retry-After") or headers.get("retry-after") or "")
+    except (TypeError, ValueError):
+        retry_after = None
+    return status, retry_after
+
+
+class TokenBucket:
+    """
+    A budget of `per_minute` units refilled continuously. take() always
+    succeeds and returns how long the caller must wait before using what it
+    took, so a request bigger than the bucket waits instead of starving.
+    """
+
+    def __init__(self, per_minute, burst_seconds=RATE_LIMIT_BURST_SECONDS):
+        self.burst_seconds = burst_seconds
+        self.resize(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def resize(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * self.burst_seconds)
+        self.level = min(getattr(self, "level", self.capacity), self.capacity)
+
+    def take(self, amount):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+
+class _Waiter:
+    def __init__(self, tenant, loop=None):
+        self.tenant = tenant
+        self.priority = current_priority()
+        self.rank = rank(self.priority)
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class Provider:
+    """
+    Rate limiting for one external service: request and token buckets, a
+    concurrency limit adapted with AIMD (+1/limit per success, halved on a
+    429, at most once per second) and a pause for the duration of Retry-After.
+    Waiting calls are served by priority class first, then fairly per tenant;
+    `reserved` slots are kept free for the high tier: neither the budget
+    share nor a 429 brings the limit below reserved + 1, so the other classes
+    keep at least one slot and the high tier its reserved ones.
+    """
+
+    def __init__(self, name, rpm=None, tpm=None, concurrency=8, reserved=0):
+        self.name = name
+        self.budget = {"rpm": rpm, "tpm": tpm, "concurrency": concurrency}
+        self.processes = 1
+        self.reserved = reserved
+        self.max_concurrency = max(concurrency, reserved + 1)
+        self.limit = float(self.max_concurrency)
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._shared_in_flight = 0 # calls in flight outside the high tier
+        self._tenants = {} # tenant -> calls in flight
+        self._grants = 0
+        self._last_grant = {} # tenant -> grant number of its latest slot, for round-robin
+        self._waiters = []
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._stats = {"calls": 0, "throttled": 0, "errors": 0, "waited_seconds": 0.0}
+
+    def share(self, processes):
+        """
+        Limits this process to 1/processes of the provider's budget. The
+        concurrency share is rounded down but never below reserved + 1
+        slots, so with many processes the deployment may run more calls at
+        once than the budget says; the provider's 429s then cut the limit.
+        """
+        with self._lock:
+            self.processes = processes
+            if self._requests is not None:
+                self._requests.resize(self.budget["rpm"] / processes)
+            if self._tokens is not None:
+                self._tokens.resize(self.budget["tpm"] / processes)
+            self.max_concurrency = max(self.reserved + 1, self.budget["concurrency"] // processes)
+            self.limit = min(self.limit, float(self.max_concurrency))
+            self._dispatch()
+
+    # Concurrency slots
+
+    def _has_slot(self, priority):
+        """
+        Whether a call of this class may start now. The high tier may use any
+        slot; the other classes share all but the reserved ones, of which the
+        limit always leaves at least one.
+        """
+        limit = int(self.limit)
+        if self._in_flight >= limit:
+            return False
+        return is_reserved(priority) or self._shared_in_flight < limit - self.reserved
+
+    def _try_grant(self, tenant):
+        priority = current_priority()
+        if not self._has_slot(priority):
+            return False
+        # Do not overtake a waiting call of the same or a higher class
+        if any(w.rank <= rank(priority) for w in self._waiters):
+            return False
+        self._grant(tenant, priority)
+        return True
+
+    def _grant(self, tenant, priority):
+        self._in_flight += 1
+        if not is_reserved(priority):
+            self._shared_in_flight += 1
+        self._tenants[tenant] = self._tenants.get(tenant, 0) + 1
+        self._grants += 1
+        self._last_grant[tenant] = self._grants
+
+    def _dispatch(self):
+        """
+        Hands free slots to waiters: the highest priority class first, then
+        the tenant with the fewest calls in flight, then the one served least
+        recently (FIFO within a tenant).
+        """
+        while True:
+            eligible = [w for w in self._waiters if self._has_slot(w.priority)]
+            if not eligible:
+                break
+            waiter = min(eligible, key=lambda w: (w.rank, self._tenants.get(w.tenant, 0),
+                                                  self._last_grant.get(w.tenant, 0)))
+            self._waiters.remove(waiter)
+            self._grant(waiter.tenant, waiter.priority)
+            waiter.wake()
+        waiting = {w.tenant for w in self._waiters}
+        for tenant in [t for t in self._last_grant if t not in self._tenants and t not in waiting]:
+            del self._last_grant[tenant]
+
+    def _acquire_slot(self, tenant):
+        with self._lock:
+            if self._try_grant(tenant):
+                return
+            waiter = _Waiter(tenant)
+            self._waiters.append(waiter)
+        waiter.event.wait()
+
+    async def _acquire_slot_async(self, tenant):
+        with self._lock:
+            if self._try_grant(tenant):
+                return
+            waiter = _Waiter(tenant, asyncio.get_running_loop())
+            self._waiters.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            self._release(tenant, None)
+            raise
+
+    def _budget_delay(self, tokens):
+        with self._lock:
+            delay = max(self._blocked_until - time.time(), 0.0)
+            if self._requests is not None:
+                delay = max(delay, self._requests.take(1))
+            if self._tokens is not None and tokens:
+                delay = max(delay, self._tokens.take(tokens))
+            if delay:
+                self._stats["waited_seconds"] += delay
+            return delay
+
+    def _release(self, tenant, status, retry_after=None):
+        """Returns a slot and adapts the limit to the outcome of the call."""
+        with self._lock:
+            self._in_flight -= 1
+            if not is_reserved(current_priority()):
+                self._shared_in_flight -= 1
+            count = self._tenants.get(tenant, 1) - 1
+            if count:
+                self._tenants[tenant] = count
+            else:
+                self._tenants.pop(tenant, None)
+            now = time.time()
+            if status == 429:
+                self._stats["throttled"] += 1
+                self._blocked_until = max(self._blocked_until, now + (retry_after or RATE_LIMIT_DEFAULT_BACKOFF))
+                if now - self._last_decrease >= 1.0:
+                    self.limit = max(float(self.reserved + 1), self.limit / 2)
+                    self._last_decrease = now
+                    log("warning", "Provider rate limited.", provider=self.name, concurrency_limit=int(self.limit))
+            elif status is not None and status < 400:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._dispatch()
+
+    # Calls
+
+    def run(self, func, tokens=0):
+        """
+        Calls func() within this provider's limits and returns its result. A
+        429 (raised, or returned as a response) is retried up to
+        RATE_LIMIT_RETRIES times once the provider's pause is over.
+        """
+        tenant = _tenant.get()
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            self._acquire_slot(tenant)
+            delay = self._budget_delay(tokens)
+            if delay:
+                time.sleep(delay)
+            self._stats["calls"] += 1
+            try:
+                result = func()
+            except Exception as e:
+                status, retry_after = status_and_retry_after(e)
+                self._release(tenant, status or 0, retry_after)
+                if status == 429 and attempt < RATE_LIMIT_RETRIES:
+                    continue
+                self._stats["errors"] += 1
+                raise
+            status, retry_after = status_and_retry_after(result)
+            self._release(tenant, status or 200, retry_after)
+            if status == 429 and attempt < RATE_LIMIT_RETRIES:
+                continue
+            return result
+
+    async def run_async(self, func, tokens=0):
+        """ Same as run(), for a coroutine function. Waiting never blocks the event loop. """
+        tenant = _tenant.get()
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            await self._acquire_slot_async(tenant)
+            try:
+                delay = self._budget_delay(tokens)
+                if delay:
+                    await asyncio.sleep(delay)
+                self._stats["calls"] += 1
+                result = await func()
+            except asyncio.CancelledError:
+                self._release(tenant, None)
+                raise
+            except Exception as e:
+                status, retry_after = status_and_retry_after(e)
+                self._release(tenant, status or 0, retry_after)
+                if status == 429 and attempt < RATE_LIMIT_RETRIES:
+                    continue
+                self._stats["errors"] += 1
+                raise
+            status, retry_after = status_and_retry_after(result)
+            self._release(tenant, status or 200, retry_after)
+            if status == 429 and attempt < RATE_LIMIT_RETRIES:
+                continue
+            return result
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "concurrency_limit": round(self.limit, 2),
+                "max_concurrency": self.max_concurrency,
+                "processes": self.processes,
+                "reserved": self.reserved,
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiters),
+                "tenants_in_flight": len(self._tenants),
+                "paused_for_seconds": round(max(self._blocked_until - time.time(), 0.0), 1),
+            })
+        stats["waited_seconds"] = round(stats["waited_seconds"], 1)
+        return stats
+
+
+class RateLimiter:
+    """The providers of the process, built from DEFAULT_LIMITS and RATE_LIMITS."""
+
+    def __init__(self, limits=None):
+        self.providers = {}
+        for name, settings in (limits or {}).items():
+            self.providers[name] = Provider(name, settings.get("rpm"), settings.get("tpm"),
+                                            settings.get("concurrency") or 8, settings.get("reserved") or 0)
+
+    def run(self, provider, func, tokens=0):
+        return self.providers[provider].run(func, tokens)
+
+    async def run_async(self, provider, func, tokens=0):
+        return await self.providers[provider].run_async(func, tokens)
+
+    def share(self, processes):
+        """Splits every provider's budget between `processes` worker processes."""
+        processes = max(1, processes)
+        for provider in self.providers.values():
+            if provider.processes != processes:
+                provider.share(processes)
+
+    def metrics(self):
+        return {name: provider.metrics() for name, provider in self.providers.items()}
+
+
+def _load_limits():
+    limits = {name: dict(settings) for name, settings in DEFAULT_LIMITS.items()}
+    for name, settings in (json.loads(RATE_LIMITS) if RATE_LIMITS else {}).items():
+        limits.setdefault(name, {}).update(settings)
+    return limits
+
+
+limiter = RateLimiter(_load_limits())
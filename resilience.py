@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import contextvars
+
+import httpx
+import requests
+from urllib3.exceptions import NewConnectionError
+from openai import APIConnectionError
+
+from pipeline import PipelineError
+from rate_limiter import limiter, status_and_retry_after
+from observability import registry, span, log
+
+# Total time allowed per dependency for one logical call, retries included,
+# as JSON merged over DEFAULT_DEADLINES, e.g. {"elevenlabs": 600}.
+CALL_DEADLINES = os.environ.get("CALL_DEADLINES", "")
+# Attempts per call for transient failures (timeouts, connection errors, 5xx).
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 1.0))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 30.0))
+# A dependency that fails this many times in a row is cut off for
+# BREAKER_RESET_TIMEOUT seconds, then probed with a single call.
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", 60))
+
+DEFAULT_DEADLINES = {
+    "openai-chat": 120,
+    "openai-image": 180,
+    "elevenlabs": 300,
+    "merger": 1200,
+    "mailjet": 120,
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# Monotonic time by which the call in progress must be finished. The shared
+# HTTP session clamps its socket timeouts to it (see http_session).
+_deadline = contextvars.ContextVar("call_deadline", default=None)
+
+CALL_SECONDS = registry.histogram(
+    "outbound_call_seconds", "Duration of calls to external dependencies, retries and waits included.",
+    ["dependency", "outcome"]
+)
+
+
+class CircuitOpen(Exception):
+    """Raised without calling a dependency whose circuit breaker is open."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a call runs out of its time budget."""
+
+
+class OutcomeUnknown(Exception):
+    """
+    Raised when a call that must not be repeated (an email sent, a merge
+    submitted) failed after the dependency may have received it. It is never
+    retried, by the call or by the job, so the customer gets at most one.
+    """
+
+
+def remaining_time():
+    """Seconds left before the current call's deadline, or None outside of a call."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def request_timeout(default):
+    """A per-request timeout that never outlives the current call's deadline."""
+    remaining = remaining_time()
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise DeadlineExceeded("Call deadline exceeded.")
+    return min(default, remaining)
+
+
+def check_deadline():
+    """Raises DeadlineExceeded once the current call is out of time, e.g. between chunks of a download."""
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded("Call deadline exceeded.")
+
+
+def is_retryable(error):
+    """
+    True for failures worth trying again later: timeouts, connection errors,
+    408/5xx responses and open circuits. A PipelineError is judged by the
+    error of the stage that failed. A 429 is not: the rate limiter has
+    already waited out and retried it (see RATE_LIMIT_RETRIES).
+    """
+    if isinstance(error, PipelineError):
+        error = error.error
+    if isinstance(error, (CircuitOpen, DeadlineExceeded)):
+        return True
+    status, _ = status_and_retry_after(error)
+    if status:
+        return status == 408 or status >= 500
+    return isinstance(error, (
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError, httpx.TransportError, APIConnectionError,
+        ConnectionError, TimeoutError,
+    ))
+
+
+def never_sent(error):
+    """
+    True for failures that happened before the request could reach the
+    dependency. An error response is not one: the dependency received it.
+    """
+    if not isinstance(error, BaseException):
+        return False
+    if isinstance(error, CircuitOpen):
+        return True
+    if isinstance(error, (requests.exceptions.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout,
+                          httpx.PoolTimeout)):
+        return True
+    # Connection refused or a name that does not resolve, as reported by requests
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+class CircuitBreaker:
+    """Closed -> open after `threshold` consecutive failures -> half-open after `reset_timeout`."""
+
+    def __init__(self, name, threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._stats = {"rejected": 0, "opened": 0}
+
+    def allow(self):
+        """
+        Raises CircuitOpen unless a call may go through now. Returns True
+        when the call is the half-open probe, which the caller must settle
+        with record_success(), record_failure() or release().
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == CLOSED:
+                return False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True # let a single call test the dependency
+                return True
+            self._stats["rejected"] += 1
+        raise CircuitOpen(f"{self.name} is unavailable (circuit open).")
+
+    def release(self):
+        """Ends a probe that proved nothing (e.g. it was cancelled), so the next call probes instead."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    self._stats["opened"] += 1
+                    log("warning", f"Circuit for {self.name} opened.", dependency=self.name, failures=self.failures)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._stats, state=self.state, consecutive_failures=self.failures)
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class Resilience:
+    """Deadlines, retries and a circuit breaker per dependency, around the rate limiter."""
+
+    def __init__(self, deadlines=None, attempts=RETRY_MAX_ATTEMPTS):
+        self.deadlines = deadlines or {}
+        self.attempts = attempts
+        self.breakers = {name: CircuitBreaker(name) for name in self.deadlines}
+        self._retries = {name: 0 for name in self.deadlines}
+
+    def _failed(self, dependency, error, attempt, deadline, idempotent=True):
+        """
+        Records a failed attempt (an exception or an error response); returns
+        the delay before the next attempt, or None to give up. A call that is
+        not idempotent is only repeated if the request was never sent, and
+        raises OutcomeUnknown otherwise.
+        """
+        if not is_retryable(error) or isinstance(error, CircuitOpen):
+            status, _ = status_and_retry_after(error)
+            if status:
+                # A 4xx is the dependency answering, which shows it is up
+                self._succeeded(dependency, error)
+            return None
+        self.breakers[dependency].record_failure()
+        if not idempotent and not never_sent(error):
+            raise OutcomeUnknown(f"{dependency} may have received the request before it failed: {error}")
+        delay = _backoff(attempt)
+        if attempt + 1 >= self.attempts or time.monotonic() + delay >= deadline:
+            return None
+        self._retries[dependency] += 1
+        log("warning", f"{dependency} call failed, retrying.", dependency=dependency, error=str(error),
+            attempt=attempt + 1, delay=round(delay, 2))
+        return delay
+
+    def _succeeded(self, dependency, result):
+        """
+        Closes the breaker after an answer that is not a failure. A 429 that
+        outlasted the limiter's retries proves neither way: throttling says
+        nothing about the dependency's health, so it never opens the circuit.
+        """
+        status, _ = status_and_retry_after(result)
+        if status != 429:
+            self.breakers[dependency].record_success()
+
+    def call(self, dependency, func, tokens=0, idempotent=True):
+        """
+        Calls func() through the rate limiter with the dependency's deadline,
+        retrying transient failures (raised, or returned as a 5xx response)
+        with jittered exponential backoff. Pass idempotent=False for a call
+        with side effects: it is then only retried when the request cannot
+        have reached the dependency (see _failed).
+        """
+        deadline = time.monotonic() + self.deadlines[dependency]
+        token = _deadline.set(deadline)
+        try:
+            with span(f"call:{dependency}", CALL_SECONDS, dependency=dependency):
+                for attempt in range(self.attempts):
+                    probe = self.breakers[dependency].allow()
+                    try:
+                        try:
+                            result = limiter.run(dependency, func, tokens)
+                        except Exception as e:
+                            delay = self._failed(dependency, e, attempt, deadline, idempotent)
+                            if delay is None:
+                                raise
+                        else:
+                            # A 5xx returned as a response counts as a failure too
+                            if not is_retryable(result):
+                                self._succeeded(dependency, result)
+                                return result
+                            delay = self._failed(dependency, result, attempt, deadline, idempotent)
+                            if delay is None:
+                                return result
+                    finally:
+                        if probe:
+                            # However the probe ended, it must not hold the breaker half-open
+                            self.breakers[dependency].release()
+                    time.sleep(delay)
+        finally:
+            _deadline.reset(token)
+
+    async def call_async(self, dependency, func, tokens=0, idempotent=True):
+        """ Same as call(), for a coroutine function; each attempt is cancelled at the deadline. """
+        deadline = time.monotonic() + self.deadlines[dependency]
+        token = _deadline.set(deadline)
+        try:
+            with span(f"call:{dependency}", CALL_SECONDS, dependency=dependency):
+                for attempt in range(self.attempts):
+                    probe = self.breakers[dependency].allow()
+                    try:
+                        try:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                raise DeadlineExceeded(f"{dependency} call deadline exceeded.")
+                            result = await asyncio.wait_for(limiter.run_async(dependency, func, tokens), remaining)
+                        except asyncio.TimeoutError:
+                            self.breakers[dependency].record_failure()
+                            if not idempotent:
+                                raise OutcomeUnknown(
+                                    f"{dependency} call deadline exceeded, the request may have been received.")
+                            raise DeadlineExceeded(f"{dependency} call deadline exceeded.")
+                        except Exception as e:
+                            delay = self._failed(dependency, e, attempt, deadline, idempotent)
+                            if delay is None:
+                                raise
+                        else:
+                            if not is_retryable(result):
+                                self._succeeded(dependency, result)
+                                return result
+                            delay = self._failed(dependency, result, attempt, deadline, idempotent)
+                            if delay is None:
+                                return result
+                    finally:
+                        if probe:
+                            # Also when the probe is cancelled, e.g. with its sibling pipeline stages
+                            self.breakers[dependency].release()
+                    await asyncio.sleep(delay)
+        finally:
+            _deadline.reset(token)
+
+    def metrics(self):
+        return {
+            name: dict(breaker.metrics(), retries=self._retries[name], deadline_seconds=self.deadlines[name])
+            for name, breaker in self.breakers.items()
+        }
+
+
+def _load_deadlines():
+    deadlines = dict(DEFAULT_DEADLINES)
+    deadlines.update(json.loads(CALL_DEADLINES) if CALL_DEADLINES else {})
+    return deadlines
+
+
+resilience = Resilience(_load_deadlines())
+call = resilience.call
+call_async = resilience.call_async
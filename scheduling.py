@@ -0,0 +1,96 @@
+import os
+import hmac
+import json
+import contextvars
+from contextlib import contextmanager
+
+# Priority classes, as JSON merged over DEFAULT_CLASSES, e.g.
+#   {"rush": {"sla": 600}, "vip": {"rank": 0, "sla": 1800}}
+# Jobs of a lower rank are always claimed first; within a rank, the customer
+# with the fewest jobs running goes first, then the earliest deadline. The
+# deadline of a job is its submission time plus the SLA (seconds) of its class.
+PRIORITY_CLASSES = os.environ.get("PRIORITY_CLASSES", "")
+# Class of webhook submissions from forms not listed in FORM_PRIORITIES, and
+# of bulk batches.
+DEFAULT_PRIORITY = os.environ.get("DEFAULT_PRIORITY", "standard")
+BULK_PRIORITY = os.environ.get("BULK_PRIORITY", "bulk")
+# Classes allowed to use the capacity held back on scarce providers (see
+# "reserved" in rate_limiter.DEFAULT_LIMITS) and on the merger's FFmpeg slots.
+RESERVED_PRIORITIES = set(os.environ.get("RESERVED_PRIORITIES", "rush").split(","))
+# The class of each Tally form's submissions, as JSON keyed by form ID, e.g.
+#   {"mVxkPd": "rush"}
+# Submitters cannot pick a class themselves: a request only gets the class it
+# asks for (?priority=) along with PRIORITY_KEY in the X-Priority-Key header.
+FORM_PRIORITIES = json.loads(os.environ.get("FORM_PRIORITIES", "") or "{}")
+PRIORITY_KEY = os.environ.get("PRIORITY_KEY", "")
+
+DEFAULT_CLASSES = {
+    "rush": {"rank": 0, "sla": 15 * 60},
+    "standard": {"rank": 1, "sla": 2 * 3600},
+    "bulk": {"rank": 2, "sla": 24 * 3600},
+}
+
+# The class and deadline of the job being run. Set by the worker pool and
+# inherited by pipeline stages, so provider calls can be served by priority.
+_schedule = contextvars.ContextVar("job_schedule", default=(None, None))
+
+
+def _load_classes():
+    classes = {name: dict(settings) for name, settings in DEFAULT_CLASSES.items()}
+    for name, settings in (json.loads(PRIORITY_CLASSES) if PRIORITY_CLASSES else {}).items():
+        classes.setdefault(name, {"rank": max(c["rank"] for c in classes.values()) + 1}).update(settings)
+    return classes
+
+
+classes = _load_classes()
+
+
+def resolve(priority, default=DEFAULT_PRIORITY):
+    """The class name for a requested priority; unknown or missing names get `default`."""
+    priority = (priority or "").strip().lower()
+    return priority if priority in classes else default
+
+
+def form_priority(form_id):
+    """The class configured for a Tally form, None if it has none."""
+    return FORM_PRIORITIES.get(form_id)
+
+
+def requested_priority(priority, key):
+    """The class a request asks for, if it carries PRIORITY_KEY; None otherwise."""
+    if not priority or not PRIORITY_KEY or not key:
+        return None
+    return priority if hmac.compare_digest(key.encode("utf-8"), PRIORITY_KEY.encode("utf-8")) else None
+
+
+def rank(priority):
+    """Lower ranks are served first. Unknown classes go last."""
+    settings = classes.get(priority)
+    return settings["rank"] if settings else max(c["rank"] for c in classes.values()) + 1
+
+
+def deadline(priority, submitted_at):
+    return submitted_at + classes[resolve(priority)]["sla"]
+
+
+def is_reserved(priority):
+    """Whether a class may use capacity held back for the high tier."""
+    return priority in RESERVED_PRIORITIES
+
+
+@contextmanager
+def schedule_scope(priority, deadline=None):
+    """Runs the block (and the pipeline stages it starts) as a job of this class and deadline."""
+    token = _schedule.set((priority, deadline))
+    try:
+        yield
+    finally:
+        _schedule.reset(token)
+
+
+def current_priority():
+    return _schedule.get()[0]
+
+
+def current_deadline():
+    return _schedule.get()[1]
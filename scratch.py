@@ -0,0 +1,233 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from job_queue import _pid_alive
+from observability import log
+
+# Root of the scratch space. Every job gets its own directory below it, and
+# the /temp_files route serves from here (and nowhere else in /tmp).
+SCRATCH_ROOT = os.environ.get("SCRATCH_ROOT", "/tmp/video-agent-scratch")
+# Disk budget of the scratch space; the oldest unused job directories are
+# deleted first when it is exceeded.
+SCRATCH_MAX_BYTES = int(os.environ.get("SCRATCH_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+# Job directories nobody holds anymore are deleted after this many seconds.
+SCRATCH_MAX_AGE = int(os.environ.get("SCRATCH_MAX_AGE", 6 * 3600))
+SCRATCH_GC_INTERVAL = int(os.environ.get("SCRATCH_GC_INTERVAL", 600))
+
+_OWNER_FILE = ".owner"
+
+# The job directory of the pipeline run in progress. Pipeline stages run on
+# threads or tasks that inherit it, so generators just ask for current_dir().
+_current_job = contextvars.ContextVar("scratch_job", default=None)
+
+
+class ScratchSpace:
+    """
+    Per-job scratch directories with reference counting.
+
+    A directory stays alive while at least one holder has acquired it: the
+    job itself for the duration of its pipeline, plus any stage that needs a
+    file to outlive that (e.g. while a remote service still downloads it).
+    The last release deletes it. A background GC removes what crashed
+    processes left behind, enforcing a maximum age and a byte quota.
+    """
+
+    def __init__(self, root=SCRATCH_ROOT, max_bytes=SCRATCH_MAX_BYTES, max_age=SCRATCH_MAX_AGE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._refs = {}
+        self._lock = threading.Lock()
+        self._gc_thread = None
+        self._gc_runs = 0
+        self._gc_removed_dirs = 0
+        self._gc_removed_bytes = 0
+        self._last_gc_seconds = None
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, name):
+        return os.path.join(self.root, name)
+
+    def acquire(self, name):
+        """Takes a reference on a job directory, creating it if needed. Returns its path."""
+        path = self._dir(name)
+        with self._lock:
+            if name not in self._refs:
+                os.makedirs(path, exist_ok=True)
+                with open(os.path.join(path, _OWNER_FILE), "w") as f:
+                    f.write(str(os.getpid()))
+            self._refs[name] = self._refs.get(name, 0) + 1
+        return path
+
+    def release(self, name):
+        """Drops a reference; the last one deletes the directory."""
+        with self._lock:
+            count = self._refs.get(name, 0) - 1
+            if count > 0:
+                self._refs[name] = count
+                return
+            self._refs.pop(name, None)
+        shutil.rmtree(self._dir(name), ignore_errors=True)
+
+    @contextmanager
+    def job(self, name=None):
+        """
+        Holds a fresh job directory for the duration of the block and makes it
+        the current directory for everything run from it.
+        """
+        name = name or uuid.uuid4().hex
+        path = self.acquire(name)
+        token = _current_job.set(name)
+        try:
+            yield path
+        finally:
+            _current_job.reset(token)
+            self.release(name)
+
+    def current_job(self):
+        return _current_job.get()
+
+    def current_dir(self):
+        """
+        The directory of the running job. Outside of a job (scripts, manual
+        tests) every call gets a new unowned directory that the GC reclaims.
+        """
+        name = _current_job.get()
+        if name is None:
+            path = self._dir(f"adhoc-{uuid.uuid4().hex}")
+            os.makedirs(path, exist_ok=True)
+            return path
+        return self._dir(name)
+
+    def path(self, filename):
+        """Full path for a new file in the current job directory."""
+        return os.path.join(self.current_dir(), filename)
+
+    def relative(self, path):
+        """The path of a scratch file relative to the root, as served under /temp_files."""
+        return os.path.relpath(path, self.root)
+
+    def resolve(self, relative_path):
+        """Maps a relative path back to an existing scratch file, or None."""
+        path = os.path.realpath(os.path.join(self.root, relative_path))
+        if not path.startswith(os.path.realpath(self.root) + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def _held(self, name, path):
+        """True if this process, or another live one, still uses a directory."""
+        with self._lock:
+            if name in self._refs:
+                return True
+        try:
+            with open(os.path.join(path, _OWNER_FILE)) as f:
+                pid = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return False
+        return pid != os.getpid() and _pid_alive(pid)
+
+    def _scan(self):
+        """Returns [(mtime, size, name, held)] for every job directory."""
+        entries = []
+        for name in os.listdir(self.root):
+            path = self._dir(name)
+            if not os.path.isdir(path):
+                continue
+            size, newest = 0, 0
+            for dirpath, _, files in os.walk(path):
+                for filename in files:
+                    try:
+                        st = os.stat(os.path.join(dirpath, filename))
+                    except OSError:
+                        continue
+                    size += st.st_size
+                    newest = max(newest, st.st_mtime)
+            if not newest:
+                try:
+                    newest = os.stat(path).st_mtime
+                except OSError:
+                    continue
+            entries.append((newest, size, name, self._held(name, path)))
+        return entries
+
+    def gc(self):
+        """
+        Deletes unheld job directories older than max_age, then the oldest
+        unheld ones until the scratch space fits in max_bytes. Directories of
+        other live processes are only removed once they exceed max_age.
+        Returns (directories removed, bytes freed).
+        """
+        start = time.monotonic()
+        now = time.time()
+        entries = self._scan()
+        total = sum(size for _, size, _, _ in entries)
+        removed, freed = 0, 0
+
+        survivors = []
+        for mtime, size, name, held in entries:
+            with self._lock:
+                mine = name in self._refs
+            if not mine and now - mtime > self.max_age:
+                shutil.rmtree(self._dir(name), ignore_errors=True)
+                removed, freed, total = removed + 1, freed + size, total - size
+            elif not held:
+                survivors.append((mtime, size, name))
+        for mtime, size, name in sorted(survivors):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._dir(name), ignore_errors=True)
+            removed, freed, total = removed + 1, freed + size, total - size
+
+        with self._lock:
+            self._gc_runs += 1
+            self._gc_removed_dirs += removed
+            self._gc_removed_bytes += freed
+            self._last_gc_seconds = round(time.monotonic() - start, 3)
+        return removed, freed
+
+    def start_gc(self, interval=SCRATCH_GC_INTERVAL):
+        """Runs gc() every `interval` seconds in a daemon thread."""
+        if self._gc_thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed, freed = self.gc()
+                    if removed:
+                        log("info", f"Scratch GC removed {removed} director(ies).", bytes=freed)
+                except Exception as e:
+                    log("error", "Scratch GC failed.", error=str(e))
+
+        self._gc_thread = threading.Thread(target=loop, name="scratch-gc", daemon=True)
+        self._gc_thread.start()
+
+    def stats(self):
+        """Disk usage of the scratch space and GC counters."""
+        entries = self._scan()
+        disk = shutil.disk_usage(self.root)
+        with self._lock:
+            return {
+                "root": self.root,
+                "bytes": sum(size for _, size, _, _ in entries),
+                "quota_bytes": self.max_bytes,
+                "max_age_seconds": self.max_age,
+                "directories": len(entries),
+                "held_directories": sum(1 for e in entries if e[3]),
+                "oldest_age_seconds": round(time.time() - min(e[0] for e in entries), 1) if entries else None,
+                "disk_free_bytes": disk.free,
+                "disk_total_bytes": disk.total,
+                "gc_runs": self._gc_runs,
+                "gc_removed_directories": self._gc_removed_dirs,
+                "gc_removed_bytes": self._gc_removed_bytes,
+                "last_gc_seconds": self._last_gc_seconds,
+            }
+
+
+scratch = ScratchSpace()
@@ -0,0 +1,126 @@
+import os
+import json
+import threading
+
+# Extra field mappings, as JSON keyed by Tally form ID ("*" applies to every
+# form). Each entry maps a stable field key (e.g. "question_3ErD8Y") or a
+# question label, in any language, to one of our form_data keys:
+#   {"*": {"Quel est le nom de votre projet ?": "projectName"},
+#    "mVxkPd": {"question_3ErD8Y": "tone"}}
+# TALLY_FIELD_MAP_FILE points to a file holding the same JSON.
+TALLY_FIELD_MAP = os.environ.get("TALLY_FIELD_MAP", "")
+TALLY_FIELD_MAP_FILE = os.environ.get("TALLY_FIELD_MAP_FILE", "")
+
+# The labels of our original (English) Tally form.
+DEFAULT_LABELS = {
+    "What’s the name of your project or brand?": "projectName",
+    "What’s the goal of your video?": "videoGoal",
+    "What is the core message you want to convey?": "centralMessage",
+    "What tone do you want for the video?": "tone",
+    "Who is your target audience?": "targetAudience",
+    "What should the final call-to-action be?": "callToAction",
+    "What’s your email address to receive the final video?": "email"
+}
+
+_QUOTES = str.maketrans({"’": "'", "‘": "'", "“": '"', "”": '"', " ": " "})
+
+
+def normalize_label(label):
+    """Makes label matching insensitive to curly quotes, spacing and case."""
+    return " ".join((label or "").translate(_QUOTES).split()).casefold()
+
+
+def _load_overrides():
+    raw = TALLY_FIELD_MAP
+    if TALLY_FIELD_MAP_FILE:
+        with open(TALLY_FIELD_MAP_FILE, encoding="utf-8") as f:
+            raw = f.read()
+    return json.loads(raw) if raw else {}
+
+
+def _field_id(field):
+    """Tally's stable field key, falling back to the label for payloads without one."""
+    return field.get("key") or field.get("label")
+
+
+class CompiledSchema:
+    """
+    The field mapping of one Tally form, compiled into plain dict lookups:
+    field key -> form_data key, and field key -> {option ID: option text}.
+    """
+
+    def __init__(self, form_id, labels, keys):
+        self.form_id = form_id
+        self._labels = labels # normalized label -> form_data key
+        self._keys = keys # field key -> form_data key (from configuration)
+        self.targets = {} # field key -> form_data key, or None for unmapped fields
+        self.options = {} # field key -> {option ID: option text}
+
+    def _compile_field(self, field):
+        field_key = _field_id(field)
+        target = self._keys.get(field_key) or self._labels.get(normalize_label(field.get("label")))
+        self.targets[field_key] = target
+        if target and field.get("options"):
+            self.options[field_key] = {o.get("id"): o.get("text") for o in field["options"]}
+        return target
+
+    def parse(self, fields):
+        """Turns the Tally fields array into form_data in a single pass."""
+        form_data = {}
+        for field in fields:
+            field_key = _field_id(field)
+            if field_key in self.targets:
+                target = self.targets[field_key]
+            else:
+                target = self._compile_field(field) # new field since the form was compiled
+            if not target:
+                continue
+
+            value = field.get("value")
+            options = self.options.get(field_key)
+            if options is None:
+                form_data[target] = value
+                continue
+
+            selected = value if isinstance(value, list) else [value] if value else []
+            if any(option_id not in options for option_id in selected):
+                self._compile_field(field) # options were edited; refresh them
+                options = self.options.get(field_key, {})
+            texts = [options[option_id] for option_id in selected if option_id in options]
+            if texts:
+                form_data[target] = ", ".join(texts)
+        return form_data
+
+
+class SchemaRegistry:
+    """Compiles and caches one CompiledSchema per Tally form ID."""
+
+    def __init__(self, overrides=None):
+        overrides = _load_overrides() if overrides is None else overrides
+        self._global = dict(overrides.get("*", {}))
+        self._per_form = {form_id: m for form_id, m in overrides.items() if form_id != "*"}
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def _compile(self, form_id):
+        mapping = dict(DEFAULT_LABELS)
+        mapping.update(self._global)
+        mapping.update(self._per_form.get(form_id, {}))
+        labels = {normalize_label(k): v for k, v in mapping.items()}
+        return CompiledSchema(form_id, labels, mapping)
+
+    def get(self, form_id):
+        schema = self._schemas.get(form_id)
+        if schema is None:
+            with self._lock:
+                schema = self._schemas.get(form_id)
+                if schema is None:
+                    schema = self._schemas[form_id] = self._compile(form_id)
+        return schema
+
+    def parse(self, data):
+        """Maps the `data` object of a Tally webhook to our form_data dict."""
+        return self.get(data.get("formId")).parse(data.get("fields", []))
+
+
+registry = SchemaRegistry()
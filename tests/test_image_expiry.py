@@ -0,0 +1,75 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import content_generator
+from content_cache import ContentCache, TTL_IMAGE, IMAGE_URL_MIN_LIFE
+from content_generator import generate_image, image_url_life
+from pipeline import Pipeline, Stage
+
+
+class Images:
+    """Stands in for client.images, issuing a new URL on every call."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate(self, **params):
+        self.calls += 1
+        return SimpleNamespace(data=[SimpleNamespace(url=f"https://images.test/{self.calls}.png")])
+
+
+@pytest.fixture
+def images(monkeypatch, tmp_path):
+    images = Images()
+    monkeypatch.setattr(content_generator, "client", SimpleNamespace(images=images))
+    monkeypatch.setattr(content_generator, "cache", ContentCache(str(tmp_path)))
+    monkeypatch.setattr(content_generator.resilience, "call", lambda dependency, func, *args, **kwargs: func())
+    return images
+
+
+def test_cached_image_keeps_its_issue_time(images, monkeypatch):
+    issued = time.time()
+    first = generate_image("Acme", "Fast", "Bold")
+    monkeypatch.setattr(time, "time", lambda: issued + 60)
+    second = generate_image("Acme", "Fast", "Bold")
+    assert images.calls == 1
+    assert second == first
+    assert first["expires_at"] == pytest.approx(issued + TTL_IMAGE, abs=5)
+
+
+def test_image_near_expiry_is_generated_again(images, monkeypatch):
+    issued = time.time()
+    first = generate_image("Acme", "Fast", "Bold")
+    monkeypatch.setattr(time, "time", lambda: issued + TTL_IMAGE - IMAGE_URL_MIN_LIFE + 1)
+    second = generate_image("Acme", "Fast", "Bold")
+    assert images.calls == 2
+    assert second["url"] != first["url"]
+
+
+class Checkpoints:
+    def __init__(self):
+        self.saved = {}
+
+    def load(self):
+        return {}
+
+    def save(self, stage, result, ttl):
+        self.saved[stage] = ttl
+
+
+def test_image_checkpoint_expires_with_its_url():
+    now = time.time()
+    fresh = {"url": "https://images.test/1.png", "expires_at": now + IMAGE_URL_MIN_LIFE + 600}
+    stale = {"url": "https://images.test/2.png", "expires_at": now + IMAGE_URL_MIN_LIFE - 1}
+    checkpoints = Checkpoints()
+    Pipeline([
+        Stage("fresh", lambda: fresh, checkpoint_ttl=image_url_life),
+        Stage("stale", lambda: stale, checkpoint_ttl=image_url_life),
+    ]).run(checkpoints)
+    assert checkpoints.saved["fresh"] == pytest.approx(600, abs=5)
+    assert "stale" not in checkpoints.saved
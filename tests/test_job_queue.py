@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from job_queue import JobQueue, LeaseLost
+
+
+class Broker:
+    """Records what the queue publishes to event stream watchers."""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, job_id, event):
+        self.published.append((job_id, event["event"]))
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"), max_queued=10, broker=Broker())
+
+
+def expire_lease(queue, job_id):
+    queue._connect().execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ?", (time.time() - 1, job_id))
+
+
+def test_job_with_an_expired_lease_is_requeued(queue):
+    job_id = queue.enqueue({"projectName": "Acme"})
+    assert queue.claim()["id"] == job_id
+    assert queue.requeue_expired() == 0
+    expire_lease(queue, job_id)
+    assert queue.requeue_expired() == 1
+    assert queue.get(job_id)["status"] == "queued"
+    assert (job_id, "queued") in queue.broker.published
+    assert queue.claim()["id"] == job_id
+    assert queue.get(job_id)["attempts"] == 2
+
+
+def test_job_fails_once_its_worker_stopped_on_every_attempt(queue):
+    job_id = queue.enqueue({"projectName": "Acme"})
+    for _ in range(2):
+        queue.claim()
+        expire_lease(queue, job_id)
+        queue.requeue_expired(max_attempts=2)
+    job = queue.get(job_id)
+    assert job["status"] == "failed"
+    assert "stopped while running attempt 2" in job["error"]
+    assert queue.claim() is None
+
+
+def test_worker_that_lost_its_lease_cannot_record_the_outcome(queue):
+    job_id = queue.enqueue({"projectName": "Acme"})
+    queue.claim()
+    queue._connect().execute("UPDATE jobs SET worker = ? WHERE id = ?", ("other-host:1", job_id))
+    assert queue.renew_leases([job_id]) == [job_id]
+    with pytest.raises(LeaseLost):
+        queue.progress(job_id)("stage_started", stage="script")
+    queue.complete(job_id)
+    assert queue.get(job_id)["status"] == "running"
+
+
+def test_events_are_kept_in_order_and_pruned_after_retention(queue):
+    job_id = queue.enqueue({"projectName": "Acme"})
+    queue.claim()
+    queue.add_event(job_id, "stage_started", stage="script")
+    queue.complete(job_id)
+    events = queue.events(job_id)
+    assert [event["event"] for event in events][-3:] == ["running", "stage_started", "done"]
+    assert queue.get(job_id)["stage"] == "script"
+    assert queue.events(job_id, after=events[-2]["id"]) == events[-1:]
+    newer, newest = queue.events_since([job_id], events[0]["id"])
+    assert [event for _, event in newer] == events[1:] and newest == events[-1]["id"]
+
+    assert queue.prune_events(retention_days=1) == 0
+    queue._connect().execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time() - 2 * 86400, job_id))
+    assert queue.prune_events(retention_days=1, batch=2) == len(events)
+    assert queue.events(job_id) == []
@@ -0,0 +1,70 @@
+import pytest
+import requests
+
+import resilience
+import mail_dispatcher
+from mail_dispatcher import MailDispatcher
+from resilience import OutcomeUnknown
+
+
+def message(email):
+    return {"To": [{"Email": email}], "Subject": "Your video", "TextPart": "Here it is."}
+
+
+class Session:
+    """Answers each post with the next outcome, recording the payloads."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.posts = []
+
+    def post(self, url, json=None, auth=None):
+        self.posts.append(json)
+        outcome = self.outcomes[min(len(self.posts), len(self.outcomes)) - 1]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+def response(status, body=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = requests.compat.json.dumps(body or {}).encode("utf-8")
+    return r
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, "_backoff", lambda attempt: 0)
+    monkeypatch.setitem(resilience.resilience.breakers, "mailjet", resilience.CircuitBreaker("mailjet"))
+
+
+def send(monkeypatch, session, emails):
+    monkeypatch.setattr(mail_dispatcher, "get_session", lambda: session)
+    dispatcher = MailDispatcher("https://mailjet.test/send", ("key", "secret"), window=0.01, base_delay=0)
+    futures = [dispatcher.submit(message(email)) for email in emails]
+    for future in futures:
+        future.exception(timeout=5)
+    return futures
+
+
+def test_batch_is_not_sent_again_after_a_read_timeout(monkeypatch):
+    session = Session(requests.exceptions.ReadTimeout(), response(200))
+    futures = send(monkeypatch, session, ["a@example.com", "b@example.com"])
+    assert len(session.posts) == 1
+    assert all(isinstance(future.exception(), OutcomeUnknown) for future in futures)
+
+
+def test_batch_is_not_sent_again_after_a_5xx(monkeypatch):
+    session = Session(response(503), response(200))
+    futures = send(monkeypatch, session, ["a@example.com"])
+    assert len(session.posts) == 1
+    assert isinstance(futures[0].exception(), OutcomeUnknown)
+
+
+def test_batch_is_sent_again_when_it_never_left(monkeypatch):
+    ok = response(200, {"Messages": [{"Status": "success"}]})
+    session = Session(requests.exceptions.ConnectTimeout(), ok)
+    futures = send(monkeypatch, session, ["a@example.com"])
+    assert len(session.posts) == 2
+    assert futures[0].result()["Status"] == "success"
@@ -0,0 +1,14 @@
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read(*parts):
+    with open(os.path.join(ROOT, *parts), "rb") as f:
+        return f.read()
+
+
+def test_merger_copy_matches_the_shared_package():
+    # The merger builds from its own directory, so it ships a copy of the package
+    assert read("Gemini", "video-merger", "observability", "__init__.py") == read("observability", "__init__.py"), \
+        "Copy observability/__init__.py to Gemini/video-merger/observability/."
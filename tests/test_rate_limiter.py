@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+import requests
+
+import rate_limiter
+from rate_limiter import Provider, tenant_scope
+from scheduling import schedule_scope
+
+
+def response(status, retry_after=None):
+    r = requests.Response()
+    r.status_code = status
+    if retry_after is not None:
+        r.headers["Retry-After"] = retry_after
+    return r
+
+
+class Held:
+    """Runs provider.run() on a thread and keeps its slot until release()."""
+
+    def __init__(self, provider, priority="standard", tenant=None, result=None):
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.result = result or response(200)
+
+        def call():
+            self.started.set()
+            self.done.wait(5)
+            return self.result
+
+        def run():
+            with schedule_scope(priority), tenant_scope(tenant):
+                provider.run(call)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def release(self):
+        self.done.set()
+        self.thread.join(5)
+
+
+@pytest.fixture
+def calls():
+    held = []
+    yield lambda *args, **kwargs: held.append(Held(*args, **kwargs)) or held[-1]
+    for call in held:
+        call.done.set()
+    for call in held:
+        call.thread.join(5)
+
+
+def test_slots_are_counted_and_returned(calls):
+    provider = Provider("test", concurrency=2)
+    first, second = calls(provider), calls(provider)
+    assert first.started.wait(1) and second.started.wait(1)
+    third = calls(provider)
+    assert not third.started.wait(0.1)
+    assert provider.metrics()["in_flight"] == 2 and provider.metrics()["waiting"] == 1
+    first.release()
+    assert third.started.wait(1)
+    second.release()
+    third.release()
+    assert provider.metrics()["in_flight"] == 0
+
+
+def test_reserved_slot_is_kept_for_the_high_tier(calls):
+    provider = Provider("test", concurrency=2, reserved=1)
+    standard = calls(provider)
+    assert standard.started.wait(1)
+    blocked = calls(provider)
+    assert not blocked.started.wait(0.1)
+    rush = calls(provider, priority="rush")
+    assert rush.started.wait(1)
+
+
+def test_share_keeps_the_reserved_slots():
+    provider = Provider("test", concurrency=4, reserved=1)
+    provider.share(4)
+    assert provider.max_concurrency == 2
+    assert provider._has_slot("standard") and provider._has_slot("rush")
+    provider._in_flight = provider._shared_in_flight = 1
+    assert not provider._has_slot("standard")
+    assert provider._has_slot("rush")
+
+
+def test_429_does_not_cut_into_the_reserved_slots(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RATE_LIMIT_RETRIES", 0)
+    monkeypatch.setattr(rate_limiter, "RATE_LIMIT_DEFAULT_BACKOFF", 0)
+    provider = Provider("test", concurrency=8, reserved=1)
+    with schedule_scope("standard"):
+        for _ in range(4):
+            provider._last_decrease = 0.0
+            provider.run(lambda: response(429))
+    assert provider.limit == 2.0
+    assert provider.metrics()["in_flight"] == 0
+    assert provider._has_slot("standard")
+    provider._in_flight = provider._shared_in_flight = 1
+    assert not provider._has_slot("standard")
+    assert provider._has_slot("rush")
+
+
+def test_waiting_high_tier_is_served_first(calls):
+    provider = Provider("test", concurrency=1)
+    holder = calls(provider)
+    assert holder.started.wait(1)
+    bulk = calls(provider, priority="bulk")
+    assert not bulk.started.wait(0.1)
+    rush = calls(provider, priority="rush")
+    assert not rush.started.wait(0.1)
+    holder.release()
+    assert rush.started.wait(1)
+    assert not bulk.started.wait(0.1)
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+import requests
+
+import resilience
+from resilience import (Resilience, CircuitBreaker, CircuitOpen, OutcomeUnknown, never_sent,
+                        CLOSED, OPEN, HALF_OPEN)
+
+
+def response(status):
+    r = requests.Response()
+    r.status_code = status
+    return r
+
+
+class Calls:
+    """A dependency call that returns or raises each outcome in turn, counting calls."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.count = 0
+
+    def __call__(self):
+        outcome = self.outcomes[min(self.count, len(self.outcomes) - 1)]
+        self.count += 1
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, "_backoff", lambda attempt: 0)
+
+
+@pytest.fixture
+def layer():
+    # "mailjet" is a dependency the shared rate limiter knows
+    return Resilience({"mailjet": 60}, attempts=3)
+
+
+def test_never_sent_is_false_for_responses_and_sent_requests():
+    assert not never_sent(response(503))
+    assert not never_sent(requests.exceptions.ReadTimeout())
+    assert never_sent(requests.exceptions.ConnectTimeout())
+    assert never_sent(CircuitOpen())
+
+
+def test_non_idempotent_call_returning_5xx_raises_outcome_unknown(layer):
+    calls = Calls(response(503))
+    with pytest.raises(OutcomeUnknown):
+        layer.call("mailjet", calls, idempotent=False)
+    assert calls.count == 1
+    assert layer.breakers["mailjet"].failures == 1
+
+
+def test_non_idempotent_call_is_not_repeated_after_a_read_timeout(layer):
+    calls = Calls(requests.exceptions.ReadTimeout(), response(200))
+    with pytest.raises(OutcomeUnknown):
+        layer.call("mailjet", calls, idempotent=False)
+    assert calls.count == 1
+
+
+def test_non_idempotent_call_is_repeated_when_never_sent(layer):
+    calls = Calls(requests.exceptions.ConnectTimeout(), requests.exceptions.ConnectTimeout(), response(200))
+    assert layer.call("mailjet", calls, idempotent=False).status_code == 200
+    assert calls.count == 3
+    assert layer.breakers["mailjet"].failures == 0
+
+
+def test_idempotent_call_retries_5xx_and_returns_the_last_response(layer):
+    calls = Calls(response(502))
+    assert layer.call("mailjet", calls).status_code == 502
+    assert calls.count == 3
+
+
+def test_returned_429_leaves_the_breaker_alone(layer):
+    breaker = layer.breakers["mailjet"]
+    breaker.failures = 2
+    throttled = response(429)
+    throttled.headers["Retry-After"] = "0.01" # Keeps the limiter's own retries short
+    assert layer.call("mailjet", Calls(throttled)).status_code == 429
+    assert breaker.failures == 2
+    assert breaker.state == CLOSED
+
+
+def test_breaker_opens_after_threshold_and_rejects():
+    breaker = CircuitBreaker("test", threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.allow() is False
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+
+
+def test_breaker_lets_one_probe_through_when_half_open():
+    breaker = CircuitBreaker("test", threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow() is True
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow() is False
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = CircuitBreaker("test", threshold=5, reset_timeout=0)
+    for _ in range(5):
+        breaker.record_failure()
+    assert breaker.allow() is True
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def half_open(layer):
+    breaker = layer.breakers["mailjet"] = CircuitBreaker("mailjet", threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    return breaker
+
+
+def test_probe_failing_with_a_non_retryable_error_releases_the_breaker(layer):
+    breaker = half_open(layer)
+    with pytest.raises(ValueError):
+        layer.call("mailjet", Calls(ValueError("bad input")))
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() is True # The next call probes again
+
+
+def test_probe_answered_with_a_client_error_closes_the_breaker(layer):
+    breaker = half_open(layer)
+    rejected = requests.exceptions.HTTPError(response=response(400))
+    with pytest.raises(requests.exceptions.HTTPError):
+        layer.call("mailjet", Calls(rejected))
+    assert breaker.state == CLOSED
+
+
+def test_cancelled_async_probe_releases_the_breaker(layer):
+    breaker = half_open(layer)
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    async def main():
+        task = asyncio.ensure_future(layer.call_async("mailjet", hang))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert breaker.allow() is True
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+
+# Merger modules import each other by name, as the agent's local backend does
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Gemini", "video-merger"))
+
+import ffmpeg_pipeline
+from ffmpeg_pipeline import evict_segments, segment_stats
+
+
+def track(directory, name, size, age):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    used = time.time() - age
+    os.utime(path, (used, used))
+    return path
+
+
+def test_evicts_least_recently_used_tracks_over_budget(tmp_path):
+    old = track(tmp_path, "a.mp4", 100, age=3000)
+    newer = track(tmp_path, "b.mp4", 100, age=2000)
+    newest = track(tmp_path, "c.mp4", 100, age=1000)
+    assert evict_segments(str(tmp_path), max_bytes=250, max_age=10_000) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(newer) and os.path.exists(newest)
+    stats = segment_stats()
+    assert (stats["files"], stats["bytes"]) == (2, 200)
+
+
+def test_deletes_tracks_unused_for_max_age(tmp_path):
+    stale = track(tmp_path, "a.mp4", 10, age=5000)
+    fresh = track(tmp_path, "b.mp4", 10, age=1000)
+    evict_segments(str(tmp_path), max_bytes=10_000, max_age=4000)
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+
+
+def test_spares_tracks_in_use_and_partials_being_written(tmp_path):
+    in_use = track(tmp_path, "a.mp4", 100, age=1)
+    partial = track(tmp_path, "b.mp4.1.2.partial.mp4", 100, age=1)
+    leftover = track(tmp_path, "c.mp4.3.4.partial.mp4", 100, age=ffmpeg_pipeline._STALE_PARTIAL_SECONDS + 1)
+    evict_segments(str(tmp_path), max_bytes=0, max_age=10_000)
+    assert os.path.exists(in_use) and os.path.exists(partial)
+    assert not os.path.exists(leftover)
@@ -0,0 +1,104 @@
+import pytest
+
+import tts_engine
+from tts_engine import split_sentences, split_script, mp3_frames, join_mp3
+
+# One MPEG-1 layer III frame header: 128 kbps, 44.1 kHz, no padding, joint stereo
+HEADER = b"\xff\xfb\x90\x64"
+FRAME_LENGTH = 144 * 128000 // 44100
+
+
+def frame(fill=b"\x00"):
+    return HEADER + fill * (FRAME_LENGTH - len(HEADER))
+
+
+def info_frame():
+    body = bytearray(frame())
+    body[4 + 32:8 + 32] = b"Info" # after the side info of a stereo MPEG-1 frame
+    return bytes(body)
+
+
+def id3v2(size=20):
+    synchsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b"ID3\x04\x00\x00" + synchsafe + b"\x00" * size
+
+
+def id3v1():
+    return b"TAG" + b"\x00" * 125
+
+
+def script(sentences):
+    return " ".join(f"Sentence number {i} says something about {word}." for i, word in enumerate(sentences))
+
+
+WORDS = ["data", "growth", "teams", "customers", "launch", "pricing",
+         "support", "design", "speed", "trust", "scale", "results"]
+
+
+def test_split_sentences_keeps_punctuation_and_decimals():
+    text = 'He said "Hi!" Then 3.5 units.\nNew line here? Yes'
+    assert split_sentences(text) == ['He said "Hi!"', "Then 3.5 units.", "New line here?", "Yes"]
+
+
+def test_short_script_is_one_chunk():
+    assert split_script("Short one. Two.") == ["Short one. Two."]
+
+
+def test_chunks_cover_the_script_in_order():
+    text = script(WORDS)
+    chunks = split_script(text)
+    assert len(chunks) > 1
+    assert " ".join(chunks) == text
+    assert all(len(chunk) <= tts_engine.TTS_CHUNK_MAX_CHARS for chunk in chunks)
+
+
+def test_long_sentence_is_split_below_max_chars():
+    text = "word, " * 300
+    chunks = split_script(text.strip(), max_chars=200)
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+@pytest.mark.parametrize("edited", [0, 5, 11])
+def test_editing_one_sentence_keeps_the_other_chunks(edited):
+    original = split_script(script(WORDS))
+    words = list(WORDS)
+    words[edited] = "a completely different and much longer topic than before"
+    changed = split_script(script(words))
+    unchanged = set(original) & set(changed)
+    # Only the chunk holding the edit, and the one after it if a boundary moved
+    assert len(unchanged) >= len(original) - 2
+
+
+def test_mp3_frames_skips_tags_and_info_frame():
+    data = id3v2() + info_frame() + frame(b"\x01") * 3 + id3v1()
+    frames = mp3_frames(data)
+    assert len(frames) == 3
+    assert frames[0][0] == len(id3v2()) + FRAME_LENGTH
+    assert frames[-1][1] == len(data) - 128
+
+
+def test_mp3_frames_rejects_other_data():
+    with pytest.raises(ValueError):
+        mp3_frames(b"not an mp3 file" * 100)
+
+
+def test_join_mp3_concatenates_audio_frames_only(tmp_path):
+    paths = []
+    for i, fill in enumerate((b"\x01", b"\x02")):
+        path = tmp_path / f"chunk{i}.mp3"
+        path.write_bytes(id3v2() + info_frame() + frame(fill) * (i + 2) + id3v1())
+        paths.append(str(path))
+    output = tmp_path / "joined.mp3"
+    join_mp3(paths, str(output))
+    assert output.read_bytes() == frame(b"\x01") * 2 + frame(b"\x02") * 3
+
+
+def test_join_mp3_rejects_mismatched_formats(tmp_path):
+    first, second = tmp_path / "a.mp3", tmp_path / "b.mp3"
+    first.write_bytes(frame() * 2)
+    # 48 kHz instead of 44.1 kHz
+    other = b"\xff\xfb\x94\x64" + b"\x00" * (144 * 128000 // 48000 - 4)
+    second.write_bytes(other * 2)
+    with pytest.raises(ValueError):
+        join_mp3([str(first), str(second)], str(tmp_path / "out.mp3"))
@@ -0,0 +1,273 @@
+import os
+import re
+import hashlib
+import asyncio
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from observability import log
+
+# Scripts up to this many characters are synthesized in a single request:
+# splitting them saves little time and costs the voice some continuity.
+TTS_CHUNKING_MIN_CHARS = int(os.environ.get("TTS_CHUNKING_MIN_CHARS", 400))
+# Longer scripts are split at sentence boundaries, into chunks of about
+# TTS_CHUNK_SENTENCES sentences and at least TTS_CHUNK_MIN_CHARS characters.
+# Sentences longer than TTS_CHUNK_MAX_CHARS are split at a clause or word
+# boundary, and no chunk grows past it.
+TTS_CHUNK_SENTENCES = int(os.environ.get("TTS_CHUNK_SENTENCES", 3))
+TTS_CHUNK_MIN_CHARS = int(os.environ.get("TTS_CHUNK_MIN_CHARS", 80))
+TTS_CHUNK_MAX_CHARS = int(os.environ.get("TTS_CHUNK_MAX_CHARS", 800))
+# Chunks of one script synthesized at once. Calls still go through the
+# "elevenlabs" limits of rate_limiter, shared by every job in the process.
+TTS_PARALLELISM = int(os.environ.get("TTS_PARALLELISM", 4))
+# How the chunks are joined, without re-encoding either way: "frames" copies
+# the MP3 frames of each chunk in Python, "ffmpeg" runs the concat demuxer.
+TTS_CONCAT = os.environ.get("TTS_CONCAT", "frames")
+
+# The end of a sentence: terminal punctuation and closing quotes or brackets
+# followed by whitespace (so "3.5" is not split), or a line break.
+_SENTENCE_END = re.compile(r"[.!?…]+[\"'”’»)\]]*(?=\s)|\n")
+_CLAUSE_END = re.compile(r"[,;:–—]\s")
+
+# MPEG audio layer III: bitrates (kbps) by bitrate index, sample rates (Hz)
+# by sample rate index, for MPEG-1 and for MPEG-2/2.5.
+_BITRATES = {
+    "1": (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    "2": (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def split_sentences(text):
+    """The sentences of a text, stripped, in order."""
+    sentences, start = [], 0
+    for match in _SENTENCE_END.finditer(text):
+        sentences.append(text[start:match.end()].strip())
+        start = match.end()
+    sentences.append(text[start:].strip())
+    return [sentence for sentence in sentences if sentence]
+
+
+def _split_long(sentence, max_chars):
+    """Splits a sentence longer than max_chars at clause boundaries, or else at spaces."""
+    pieces = []
+    while len(sentence) > max_chars:
+        window = sentence[:max_chars]
+        clauses = list(_CLAUSE_END.finditer(window))
+        cut = clauses[-1].end() if clauses else window.rfind(" ") + 1
+        if cut <= 0:
+            cut = max_chars
+        pieces.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence:
+        pieces.append(sentence)
+    return pieces
+
+
+def _ends_chunk(sentence, every):
+    """Whether a chunk may end after this sentence: true for about one sentence in `every`, by its hash."""
+    digest = hashlib.blake2b(sentence.encode("utf-8"), digest_size=4).digest()
+    return int.from_bytes(digest, "big") % max(1, every) == 0
+
+
+def split_script(text, min_script=TTS_CHUNKING_MIN_CHARS, min_chars=TTS_CHUNK_MIN_CHARS,
+                 max_chars=TTS_CHUNK_MAX_CHARS, every=TTS_CHUNK_SENTENCES):
+    """
+    The chunks a script is synthesized in: the whole script if it is short,
+    otherwise groups of sentences. A chunk ends after a sentence its hash
+    picks as a boundary, once the chunk holds min_chars, or before it would
+    outgrow max_chars. Boundaries follow the sentences themselves, not their
+    position, so an edit changes the chunk it falls in (and the next one if
+    it moves a boundary) and every other chunk keeps its cached audio.
+    """
+    if len(text) <= min_script:
+        return [text]
+    chunks, current = [], ""
+    for sentence in split_sentences(text):
+        for piece in _split_long(sentence, max_chars):
+            if current and len(current) + 1 + len(piece) > max_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current} {piece}" if current else piece
+            if len(current) >= min_chars and _ends_chunk(piece, every):
+                chunks.append(current)
+                current = ""
+    if current:
+        chunks.append(current)
+    return chunks or [text]
+
+
+def _id3v2_size(data):
+    """Length of the ID3v2 tag at the start of data, 0 if there is none."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    return 10 + size + (10 if data[5] & 0x10 else 0) # A footer follows the tag when flagged
+
+
+def _audio_end(data):
+    """Where the audio frames end, before any trailing APEv2 and ID3v1 tags."""
+    end = len(data)
+    while True:
+        if end >= 128 and data[end - 128:end - 125] == b"TAG":
+            end -= 128
+        elif end >= 32 and data[end - 32:end - 24] == b"APETAGEX":
+            size = int.from_bytes(data[end - 20:end - 16], "little")
+            flags = int.from_bytes(data[end - 12:end - 8], "little")
+            end -= size + (32 if flags & 0x80000000 else 0) # Size counts the footer, not the header
+        else:
+            return end
+
+
+def _frame(data, offset):
+    """(length, (version, sample rate, channel mode)) of the MP3 frame at offset, or None."""
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = data[offset + 1] >> 3 & 3
+    layer = data[offset + 1] >> 1 & 3
+    bitrate_index = data[offset + 2] >> 4
+    rate_index = data[offset + 2] >> 2 & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None # Reserved values, free format, or not layer III
+    bitrate = _BITRATES["1" if version == 3 else "2"][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    padding = data[offset + 2] >> 1 & 1
+    length = (144 if version == 3 else 72) * bitrate // sample_rate + padding
+    return length, (version, sample_rate, data[offset + 3] >> 6)
+
+
+def _is_info_frame(data, offset, version, channel_mode):
+    """Whether a frame is the Xing/Info (or VBRI) header an encoder writes first, which holds no audio."""
+    side_info = (32 if channel_mode != 3 else 17) if version == 3 else (17 if channel_mode != 3 else 9)
+    tag = data[offset + 4 + side_info:offset + 8 + side_info]
+    return tag in (b"Xing", b"Info") or data[offset + 36:offset + 40] == b"VBRI"
+
+
+def mp3_frames(data):
+    """
+    The audio frames of an MP3 file as (start, end, format) spans, leaving
+    out tags and the Xing/Info header frame. Raises ValueError if the data
+    is not an MPEG layer III stream.
+    """
+    offset, end = _id3v2_size(data), _audio_end(data)
+    frames = []
+    while offset < end:
+        frame = _frame(data, offset)
+        if frame is None:
+            if frames:
+                break # Trailing garbage after the last frame
+            offset += 1 # Resynchronize on the first frame header
+            if offset >= min(end, 64 * 1024):
+                break
+            continue
+        length, fmt = frame
+        if offset + length > end:
+            break # A truncated last frame
+        if frames or not _is_info_frame(data, offset, fmt[0], fmt[2]):
+            frames.append((offset, offset + length, fmt))
+        offset += length
+    if not frames:
+        raise ValueError("No MPEG layer III frames found.")
+    return frames
+
+
+def join_mp3(paths, output_path):
+    """
+    Concatenates MP3 files into one by copying their audio frames, without
+    tags or per-file Xing/Info headers, so players see one continuous stream
+    and nothing is re-encoded. The encoder delay and padding of each chunk,
+    a few tens of milliseconds, fall where the voice pauses between sentences.
+    """
+    fmt = None
+    with open(output_path, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                data = f.read()
+            frames = mp3_frames(data)
+            if fmt is None:
+                fmt = frames[0][2]
+            elif frames[0][2] != fmt:
+                raise ValueError(f"{path} differs in MPEG version, sample rate or channel mode from the first chunk.")
+            out.write(data[frames[0][0]:frames[-1][1]])
+
+
+def concat_ffmpeg(paths, output_path):
+    """Concatenates MP3 files with FFmpeg's concat demuxer, copying the stream."""
+    list_path = f"{output_path}.txt"
+    with open(list_path, "w") as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_path, "-c", "copy", "-map_metadata", "-1", output_path],
+            capture_output=True, text=True,
+        )
+    finally:
+        os.remove(list_path)
+    if result.returncode != 0:
+        raise Exception(f"FFmpeg concat failed with exit code {result.returncode}. Stderr: {result.stderr}")
+
+
+def concatenate(paths, output_path, method=TTS_CONCAT):
+    if method == "ffmpeg":
+        concat_ffmpeg(paths, output_path)
+    else:
+        join_mp3(paths, output_path)
+
+
+def synthesize_chunks(chunks, synthesize, new_path, output_path, parallelism=TTS_PARALLELISM):
+    """
+    Synthesizes the chunks of a script in parallel with synthesize(text, path),
+    into files named by new_path(), and joins them into output_path in order.
+    Each chunk is retried on its own by the resilience layer; a chunk that
+    still fails fails the whole voice-over, once the others have stopped.
+    """
+    paths = [new_path() for _ in chunks]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(chunks)))) as executor:
+            # Each chunk runs in a copy of the caller's context, so its
+            # deadline, tenant and priority follow it
+            futures = [executor.submit(contextvars.copy_context().run, synthesize, chunk, path)
+                       for chunk, path in zip(chunks, paths)]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+        concatenate(paths, output_path)
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    log("info", "Voice-over synthesized in chunks.", chunks=len(chunks), characters=sum(map(len, chunks)))
+
+
+async def synthesize_chunks_async(chunks, synthesize, new_path, output_path, parallelism=TTS_PARALLELISM):
+    """Same as synthesize_chunks(), for a coroutine synthesize(text, path)."""
+    paths = [new_path() for _ in chunks]
+    slots = asyncio.Semaphore(max(1, parallelism))
+
+    async def limited(chunk, path):
+        async with slots:
+            await synthesize(chunk, path)
+
+    try:
+        tasks = [asyncio.ensure_future(limited(chunk, path)) for chunk, path in zip(chunks, paths)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        await asyncio.to_thread(concatenate, paths, output_path)
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    log("info", "Voice-over synthesized in chunks.", chunks=len(chunks), characters=sum(map(len, chunks)))
@@ -1,10 +1,144 @@
 import os
+import sys
+import time
+import uuid
+import asyncio
+import importlib.util
 import requests
+import httpx
+
+import async_io
+import resilience
+from http_session import get_session
+from voice_generator import public_base_url, local_temp_path
+from scratch import scratch
+from scheduling import current_priority, current_deadline
+from observability import log
 
 # Get the Video Merger service URL from environment variables
 VIDEO_MERGER_URL = os.environ.get("VIDEO_MERGER_URL")
+# "remote" posts URLs to VIDEO_MERGER_URL and waits for the answer; "jobs"
+# submits to the merger's /jobs API and polls until the video is ready;
+# "local" runs the merger's FFmpeg pipeline in this process, for deployments
+# where both share a host.
+MERGE_BACKEND = os.environ.get("MERGE_BACKEND", "remote")
+# The merger's job API, derived from VIDEO_MERGER_URL (".../merge" -> ".../jobs")
+VIDEO_MERGER_JOBS_URL = os.environ.get("VIDEO_MERGER_JOBS_URL") or (
+    VIDEO_MERGER_URL.rsplit("/merge", 1)[0] + "/jobs" if VIDEO_MERGER_URL else None
+)
+# Seconds between status polls, and the longest we wait for one merge job.
+MERGER_POLL_INTERVAL = float(os.environ.get("MERGER_POLL_INTERVAL", 2))
+MERGER_JOB_TIMEOUT = float(os.environ.get("MERGER_JOB_TIMEOUT", 900))
+# Directory holding the merger service code, used by the local backend.
+VIDEO_MERGER_DIR = os.environ.get(
+    "VIDEO_MERGER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "Gemini", "video-merger")
+)
+
+_merger_modules = {}
+_artifact_store = None
+
+def load_merger_module(name):
+    """
+    Imports a module from the merger service directory, so the local backend
+    runs exactly the same code as the merger service.
+    """
+    if name not in _merger_modules:
+        # Merger modules import each other by name; append (not prepend) the
+        # directory so the agent's own modules keep precedence.
+        if VIDEO_MERGER_DIR not in sys.path:
+            sys.path.append(VIDEO_MERGER_DIR)
+        path = os.path.join(VIDEO_MERGER_DIR, f"{name}.py")
+        spec = importlib.util.spec_from_file_location(f"video_merger_{name}", path)
+        if spec is None:
+            raise ImportError(f"Merger module '{name}' not found in {VIDEO_MERGER_DIR}.")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _merger_modules[name] = module
+    return _merger_modules[name]
+
+def merge_audio_and_image(image_url, audio_url, backend=None):
+    """
+    Merges an image and an audio URL into a video, either through the
+    video-merger service or locally, depending on MERGE_BACKEND.
 
-def merge_audio_and_image(image_url, audio_url): # Changed audio_file_path to audio_url
+    Returns:
+        str: The URL of the generated MP4 video.
+    """
+    backend = backend or MERGE_BACKEND
+    if backend == "local":
+        return merge_locally(image_url, audio_url)
+    # A merger slot is held for the whole merge, polling included. A merge is
+    # only submitted again if the merger cannot have received it: one that
+    # times out may still be encoding
+    if backend == "jobs":
+        return resilience.call("merger", lambda: merge_via_jobs(image_url, audio_url), idempotent=False)
+    return resilience.call("merger", lambda: merge_remotely(image_url, audio_url), idempotent=False)
+
+def merge_locally(image_url, audio_url):
+    """
+    Runs the merger's FFmpeg pipeline in this process. An audio URL served by
+    this app is read straight from disk, so only the image is downloaded, and
+    the video is published as a signed /artifacts URL without any HTTP hop.
+    """
+    pipeline = load_merger_module("ffmpeg_pipeline")
+    uid = uuid.uuid4().hex
+    image_path = scratch.path(f"image_{uid}.jpg")
+    output_path = scratch.path(f"video_{uid}.mp4")
+    downloaded = []
+
+    try:
+        audio_path = local_temp_path(audio_url)
+        if audio_path is None:
+            audio_path = scratch.path(f"audio_{uid}.mp3")
+            _download(audio_url, audio_path)
+            downloaded.append(audio_path)
+        image_local = local_temp_path(image_url)
+        if image_local is None:
+            _download(image_url, image_path)
+            downloaded.append(image_path)
+            image_local = image_path
+
+        log("info", "Merging locally.", image=image_local, audio=audio_path)
+        pipeline.merge_files(image_local, audio_path, output_path)
+    finally:
+        for path in downloaded:
+            if os.path.exists(path):
+                os.remove(path)
+
+    artifact_id = get_artifact_store().put_file(output_path, "video/mp4")
+    return get_artifact_store().signed_url(public_base_url(), artifact_id)
+
+def get_artifact_store():
+    """ The merger's artifact store, shared with this app's /artifacts route. """
+    global _artifact_store
+    if _artifact_store is None:
+        _artifact_store = load_merger_module("artifact_store").ArtifactStore()
+        _artifact_store.start_gc()
+    return _artifact_store
+
+def local_artifact(url):
+    """
+    Returns (path, metadata) when url is a signed /artifacts link served by
+    this app, or (None, None) for any other URL.
+    """
+    prefix = f"{public_base_url()}/artifacts/"
+    if not url.startswith(prefix):
+        return None, None
+    artifact_id, _, query = url[len(prefix):].partition("?")
+    args = dict(part.partition("=")[::2] for part in query.split("&") if part)
+    store = get_artifact_store()
+    if not store.verify(artifact_id, args.get("expires"), args.get("sig")):
+        return None, None
+    return store.open_object(artifact_id)
+
+def _download(url, path):
+    with get_session().get(url, stream=True) as r:
+        r.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=256 * 1024):
+                f.write(chunk)
+
+def merge_remotely(image_url, audio_url): # Changed audio_file_path to audio_url
     """
     Merges an image and an audio URL into a video using the video-merger service.
 
@@ -19,17 +153,14 @@ def merge_audio_and_image(image_url, audio_url): # Changed audio_file_path to au
         raise ValueError("VIDEO_MERGER_URL environment variable not set.")
 
     # The video-merger service now expects a JSON payload with URLs
-    payload = {
-        'audio_url': audio_url, # Changed to audio_url
-        'image_url': image_url
-    }
+    payload = _merge_request(image_url, audio_url)
     headers = {
         "Content-Type": "application/json" # New: Specify JSON content type
     }
 
     try:
-        print(f"[*] Sending request to Video Merger at {VIDEO_MERGER_URL} with JSON payload...")
-        response = requests.post(VIDEO_MERGER_URL, json=payload, headers=headers)
+        log("info", "Sending the merge to the video merger.", url=VIDEO_MERGER_URL)
+        response = get_session().post(VIDEO_MERGER_URL, json=payload, headers=headers)
         response.raise_for_status()  # Raise an exception for bad status codes
 
         # The merger service returns a JSON payload with the video URL
@@ -42,8 +173,119 @@ def merge_audio_and_image(image_url, audio_url): # Changed audio_file_path to au
         return video_url
 
     except requests.exceptions.RequestException as e:
-            print(f"[!] Error calling Video Merger service: {e}")
-            if e.response is not None:
-                print(f"[!] Response status: {e.response.status_code}")
-                print(f" - Response body: {e.response.text}") # Added hyphen for clarity
+            log("error", "Video merger call failed.", error=str(e),
+                status=e.response.status_code if e.response is not None else None,
+                body=e.response.text if e.response is not None else None)
             raise
+
+def _merge_request(image_url, audio_url):
+    """ The merger request body. The job's class and deadline let the merger schedule its FFmpeg slots. """
+    payload = {'audio_url': audio_url, 'image_url': image_url}
+    if current_priority():
+        payload.update(priority=current_priority(), deadline=current_deadline())
+    return payload
+
+def _merge_job_outcome(job):
+    """ Returns the video URL of a finished merge job, None while it is still running. """
+    if job["status"] == "done":
+        return job.get("video_url") or job["result_url"]
+    if job["status"] in ("failed", "cancelled"):
+        raise RuntimeError(f"Merge job {job['job_id']} {job['status']}: {job.get('error')}")
+    return None
+
+def merge_via_jobs(image_url, audio_url):
+    """
+    Submits the merge to the merger's /jobs API and polls until it finishes,
+    so no HTTP request stays open for the length of the FFmpeg encode.
+    """
+    if not VIDEO_MERGER_JOBS_URL:
+        raise ValueError("VIDEO_MERGER_URL environment variable not set.")
+
+    session = get_session()
+    log("info", "Submitting a merge job.", url=VIDEO_MERGER_JOBS_URL)
+    response = session.post(VIDEO_MERGER_JOBS_URL, json=_merge_request(image_url, audio_url))
+    response.raise_for_status()
+    job = response.json()
+    status_url = job["status_url"]
+
+    deadline = time.monotonic() + resilience.request_timeout(MERGER_JOB_TIMEOUT)
+    while time.monotonic() < deadline:
+        video_url = _merge_job_outcome(job)
+        if video_url:
+            return video_url
+        time.sleep(MERGER_POLL_INTERVAL)
+        try:
+            response = session.get(status_url)
+            response.raise_for_status()
+            job = response.json()
+        except requests.exceptions.RequestException as e:
+            # The job is submitted: a failed poll is tried again, never the merge
+            if not resilience.is_retryable(e):
+                raise
+            log("warning", f"Polling merge job {job['job_id']} failed, polling again.", error=str(e))
+
+    session.delete(status_url)
+    raise TimeoutError(f"Merge job {job['job_id']} did not finish in time.")
+
+async def merge_via_jobs_async(image_url, audio_url):
+    """ Async variant of merge_via_jobs; polling sleeps without holding a thread. """
+    if not VIDEO_MERGER_JOBS_URL:
+        raise ValueError("VIDEO_MERGER_URL environment variable not set.")
+
+    client = async_io.get_http_client()
+    log("info", "Submitting a merge job.", url=VIDEO_MERGER_JOBS_URL)
+    response = await client.post(VIDEO_MERGER_JOBS_URL, json=_merge_request(image_url, audio_url))
+    response.raise_for_status()
+    job = response.json()
+    status_url = job["status_url"]
+
+    deadline = time.monotonic() + resilience.request_timeout(MERGER_JOB_TIMEOUT)
+    while time.monotonic() < deadline:
+        video_url = _merge_job_outcome(job)
+        if video_url:
+            return video_url
+        await asyncio.sleep(MERGER_POLL_INTERVAL)
+        try:
+            response = await client.get(status_url)
+            response.raise_for_status()
+            job = response.json()
+        except httpx.HTTPError as e:
+            if not resilience.is_retryable(e):
+                raise
+            log("warning", f"Polling merge job {job['job_id']} failed, polling again.", error=str(e))
+
+    await client.delete(status_url)
+    raise TimeoutError(f"Merge job {job['job_id']} did not finish in time.")
+
+async def merge_audio_and_image_async(image_url, audio_url, backend=None):
+    """
+    Async variant of merge_audio_and_image using the shared httpx client.
+    The local backend runs FFmpeg in a worker thread to keep the loop free.
+    """
+    backend = backend or MERGE_BACKEND
+    if backend == "local":
+        return await asyncio.to_thread(merge_locally, image_url, audio_url)
+    if backend == "jobs":
+        return await resilience.call_async("merger", lambda: merge_via_jobs_async(image_url, audio_url),
+                                           idempotent=False)
+
+    if not VIDEO_MERGER_URL:
+        raise ValueError("VIDEO_MERGER_URL environment variable not set.")
+
+    payload = _merge_request(image_url, audio_url)
+
+    try:
+        log("info", "Sending the merge to the video merger.", url=VIDEO_MERGER_URL)
+        response = await resilience.call_async("merger", lambda: async_io.get_http_client().post(VIDEO_MERGER_URL, json=payload),
+                                               idempotent=False)
+        response.raise_for_status()
+
+        video_url = response.json().get('video_url')
+        if not video_url:
+            raise ValueError("Video URL not found in the response from the merger service.")
+
+        return video_url
+
+    except httpx.HTTPStatusError as e:
+        log("error", "Video merger call failed.", error=str(e), status=e.response.status_code, body=e.response.text)
+        raise
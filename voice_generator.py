@@ -1,65 +1,202 @@
 import os
 import requests
 import uuid
+import httpx
+
+import async_io
+import resilience
+from http_session import get_session
+from content_cache import cache, TTL_VOICE
+from scratch import scratch
+from tts_engine import split_script, synthesize_chunks, synthesize_chunks_async
+from observability import log
 
 # Get the ElevenLabs Proxy URL from environment variables
 ELEVENLABS_PROXY_URL = os.environ.get("ELEVENLABS_PROXY_URL")
+# Size of the chunks written to disk while the audio is downloading
+AUDIO_CHUNK_SIZE = int(os.environ.get("AUDIO_CHUNK_SIZE", 64 * 1024))
 
-def generate_voice_over(script_text):
+def _new_audio_file():
     """
-    Generates a voice-over MP3 from the given script using the ElevenLabs proxy,
-    saves it locally, and returns the public URL from the current application.
+    Returns a (filename, path) pair for a new, unique audio file in the
+    current job's scratch directory; filename is relative to the scratch root.
     """
-    if not ELEVENLABS_PROXY_URL:
-        raise ValueError("ELEVENLABS_PROXY_URL environment variable not set.")
+    temp_filepath = scratch.path(f"temp_audio_{uuid.uuid4()}.mp3")
+    return scratch.relative(temp_filepath), temp_filepath
+
+def public_base_url():
+    """
+    The public URL of this app. This assumes your app is accessible via its
+    Render URL, which Render exposes as RENDER_EXTERNAL_HOSTNAME (usually
+    YOUR_APP_NAME.onrender.com).
+    """
+    APP_BASE_URL = os.environ.get("RENDER_EXTERNAL_HOSTNAME") # Render provides this
+    if not APP_BASE_URL:
+        # Fallback for local testing or if variable is not set
+        APP_BASE_URL = "http://localhost:5000" # Or your local development URL
+    if "://" not in APP_BASE_URL:
+        APP_BASE_URL = f"https://{APP_BASE_URL}"
+    return APP_BASE_URL
+
+def public_temp_url(filename):
+    """ Constructs the public URL under which the app's /temp_files route serves a file. """
+    return f"{public_base_url()}/temp_files/{filename}"
+
+def local_temp_path(url):
+    """
+    Returns the local path of a file this app serves under /temp_files, or
+    None if the URL points somewhere else.
+    """
+    prefix = public_temp_url("")
+    if not url.startswith(prefix):
+        return None
+    return scratch.resolve(url[len(prefix):])
 
+def _voice_cache_params(script_text):
+    """ The inputs that determine the generated audio, used as the cache key. """
+    return {"text": script_text, "proxy": ELEVENLABS_PROXY_URL}
+
+def _cached_voice_over(script_text):
+    """ Returns the public URL of a cached voice-over for this script, or None. """
+    temp_filename, temp_filepath = _new_audio_file()
+    if not cache.get_file("voice", _voice_cache_params(script_text), temp_filepath):
+        return None
+    public_audio_url = public_temp_url(temp_filename)
+    log("info", "Voice-over served from cache.", url=public_audio_url)
+    return public_audio_url
+
+def _stream_voice(text, path):
+    """ Streams the ElevenLabs audio of a text into a local file. """
     headers = {
         "Content-Type": "application/json"
     }
     payload = {
-        "text": script_text
+        "text": text
     }
 
+    def synthesize():
+        with get_session().post(ELEVENLABS_PROXY_URL, json=payload, headers=headers, stream=True) as response:
+            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+
+            # Stream the audio into a uniquely named local file, so memory use
+            # stays flat however long the script is
+            with open(path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=AUDIO_CHUNK_SIZE):
+                    # A proxy trickling bytes must not outlast the deadline
+                    resilience.check_deadline()
+                    f.write(chunk)
+
+    # The ElevenLabs slot is held until the audio has been received
+    resilience.call("elevenlabs", synthesize)
+
+def _synthesize_chunk(text, path):
+    """
+    Synthesizes one chunk of a long script, or copies it from the cache when
+    the same sentences were voiced before (e.g. in an earlier draft).
+    """
+    if cache.get_file("voice_chunk", _voice_cache_params(text), path):
+        return
+    _stream_voice(text, path)
+    cache.put_file("voice_chunk", _voice_cache_params(text), path, TTL_VOICE)
+
+def generate_voice_over(script_text):
+    """
+    Generates a voice-over MP3 from the given script using the ElevenLabs proxy,
+    saves it locally, and returns the public URL from the current application.
+    Long scripts are synthesized sentence by sentence in parallel, and the
+    chunks joined into one file (see tts_engine).
+    """
+    if not ELEVENLABS_PROXY_URL:
+        raise ValueError("ELEVENLABS_PROXY_URL environment variable not set.")
+
+    cached_url = _cached_voice_over(script_text)
+    if cached_url:
+        return cached_url
+
     try:
-        print(f"[*] Sending request to ElevenLabs Proxy at {ELEVENLABS_PROXY_URL}...")
-        response = requests.post(ELEVENLABS_PROXY_URL, json=payload, headers=headers)
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-
-        # Generate a unique filename for the audio file
-        temp_filename = f"temp_audio_{uuid.uuid4()}.mp3"
-        temp_filepath = os.path.join("/tmp", temp_filename)
-        if not os.path.exists("/tmp"):
-             os.makedirs("/tmp") # For local testing if /tmp doesn't exist
-
-        # Save the audio content to the file locally
-        with open(temp_filepath, 'wb') as f:
-            f.write(response.content)
-        
-        print(f"[*] Audio file successfully saved locally to {temp_filepath}")
-
-        # Construct the public URL for the audio file
-        # This assumes your app is accessible via its Render URL
-        # You might need to get the base URL from an environment variable if it's not fixed
-        # For Render, it's usually https://YOUR_APP_NAME.onrender.com
-        # Let's assume the base URL is available as an environment variable for robustness
-        APP_BASE_URL = os.environ.get("RENDER_EXTERNAL_HOSTNAME") # Render provides this
-        if not APP_BASE_URL:
-            # Fallback for local testing or if variable is not set
-            APP_BASE_URL = "http://localhost:5000" # Or your local development URL
-
-        public_audio_url = f"https://{APP_BASE_URL}/temp_files/{temp_filename}" # Construct the URL
-        print(f"[*] Public audio URL: {public_audio_url}")
+        log("info", "Sending request to the ElevenLabs proxy.", url=ELEVENLABS_PROXY_URL)
+        temp_filename, temp_filepath = _new_audio_file()
+
+        chunks = split_script(script_text)
+        if len(chunks) > 1:
+            log("info", f"Synthesizing the script in {len(chunks)} chunks.")
+            synthesize_chunks(chunks, _synthesize_chunk, lambda: _new_audio_file()[1], temp_filepath)
+        else:
+            _stream_voice(script_text, temp_filepath)
+        # The joined file too, so a retry or a duplicate skips the join
+        cache.put_file("voice", _voice_cache_params(script_text), temp_filepath, TTL_VOICE)
+
+        public_audio_url = public_temp_url(temp_filename)
+        log("info", "Voice-over saved.", path=temp_filepath, url=public_audio_url)
 
         return public_audio_url # Return the public URL
 
     except requests.exceptions.RequestException as e:
-        print(f"[!] Error during ElevenLabs API call: {e}")
-        if e.response is not None:
-            print(f"[!] Response status: {e.response.status_code}")
-            print(f"[!] Response body: {e.response.text}")
+        log("error", "ElevenLabs call failed.", error=str(e),
+            status=e.response.status_code if e.response is not None else None,
+            body=e.response.text if e.response is not None else None)
+        raise
+    except Exception as e:
+        log("error", "Voice-over generation failed.", error=str(e))
+        raise
+
+async def _stream_voice_async(text, path):
+    """ Async variant of _stream_voice using the shared httpx client. """
+    client = async_io.get_http_client()
+
+    async def synthesize():
+        async with client.stream("POST", ELEVENLABS_PROXY_URL, json={"text": text}) as response:
+            if response.is_error:
+                await response.aread()
+            response.raise_for_status()
+            with open(path, 'wb') as f:
+                async for chunk in response.aiter_bytes(AUDIO_CHUNK_SIZE):
+                    f.write(chunk)
+
+    await resilience.call_async("elevenlabs", synthesize)
+
+async def _synthesize_chunk_async(text, path):
+    """ Async variant of _synthesize_chunk. """
+    if cache.get_file("voice_chunk", _voice_cache_params(text), path):
+        return
+    await _stream_voice_async(text, path)
+    cache.put_file("voice_chunk", _voice_cache_params(text), path, TTL_VOICE)
+
+async def generate_voice_over_async(script_text):
+    """
+    Async variant of generate_voice_over using the shared httpx client.
+    The audio is streamed to disk as it arrives.
+    """
+    if not ELEVENLABS_PROXY_URL:
+        raise ValueError("ELEVENLABS_PROXY_URL environment variable not set.")
+
+    cached_url = _cached_voice_over(script_text)
+    if cached_url:
+        return cached_url
+
+    try:
+        log("info", "Sending request to the ElevenLabs proxy.", url=ELEVENLABS_PROXY_URL)
+        temp_filename, temp_filepath = _new_audio_file()
+
+        chunks = split_script(script_text)
+        if len(chunks) > 1:
+            log("info", f"Synthesizing the script in {len(chunks)} chunks.")
+            await synthesize_chunks_async(chunks, _synthesize_chunk_async, lambda: _new_audio_file()[1],
+                                          temp_filepath)
+        else:
+            await _stream_voice_async(script_text, temp_filepath)
+        cache.put_file("voice", _voice_cache_params(script_text), temp_filepath, TTL_VOICE)
+
+        public_audio_url = public_temp_url(temp_filename)
+        log("info", "Voice-over saved.", path=temp_filepath, url=public_audio_url)
+
+        return public_audio_url
+
+    except httpx.HTTPStatusError as e:
+        log("error", "ElevenLabs call failed.", error=str(e), status=e.response.status_code, body=e.response.text)
         raise
     except Exception as e:
-        print(f"[!] An unexpected error occurred in voice_generator: {e}")
+        log("error", "Voice-over generation failed.", error=str(e))
         raise
 
 # Example usage (for testing)
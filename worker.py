@@ -0,0 +1,135 @@
+"""
+Runs the job worker pools outside the web server, so the web tier stays
+stateless and capacity grows with the number of worker processes:
+
+    RUN_WORKERS_IN_WEB=0 gunicorn "app:create_app()"
+    python worker.py --processes 4
+
+Importing app starts none of the web tier's background services (see
+app.init_web), so a worker process only runs its pools and their scratch GC.
+
+Every process claims jobs from the shared job database (JOB_QUEUE_DB) under
+a lease it keeps renewing, and coordinates with the others through
+COORDINATION_BACKEND (see job_queue.WorkerPool and coordination.py). A
+process that dies loses its leases, and its jobs are picked up by the rest.
+
+Run it under a process supervisor: nothing else restarts it. The web
+tier's /metrics and /stats/* then only describe the web processes, so
+scrape each worker on WORKER_METRICS_PORT, and job event streams pick up
+the workers' events by polling (JOB_EVENTS_POLL_INTERVAL).
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Processes started by `python worker.py`; each runs JOB_WORKERS video and
+# BULK_WORKERS bulk jobs at once.
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 1))
+# Seconds a stopping worker waits for its running jobs before exiting. Jobs
+# still running then are taken over by another worker once their lease expires.
+WORKER_SHUTDOWN_GRACE = float(os.environ.get("WORKER_SHUTDOWN_GRACE", 25))
+# Port of the /metrics endpoint of the first worker process (the next ones
+# use the following ports); 0 disables it.
+WORKER_METRICS_PORT = int(os.environ.get("WORKER_METRICS_PORT", 0))
+
+
+def serve_metrics(port):
+    """Exposes this process's job and stage metrics, which the web tier does not see."""
+    from observability import registry
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode("utf-8")
+            self.send_response(200 if self.path.startswith("/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+
+def run_worker(metrics_port=0):
+    """Runs one worker process until SIGTERM or SIGINT."""
+    import app
+    from observability import log, flush_logs
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    if metrics_port:
+        serve_metrics(metrics_port)
+    pools = app.start_workers()
+    log("info", "Worker process started.", pid=os.getpid(), pipeline_mode=app.PIPELINE_MODE)
+    stopping.wait()
+
+    log("info", "Worker process stopping.", pid=os.getpid())
+    for pool in pools:
+        pool.stop()
+    deadline = time.monotonic() + WORKER_SHUTDOWN_GRACE
+    while any(pool.running() for pool in pools) and time.monotonic() < deadline:
+        time.sleep(0.5)
+    unfinished = sum(len(pool.running()) for pool in pools)
+    if unfinished:
+        log("warning", f"Exiting with {unfinished} job(s) still running; they resume once their lease expires.")
+    flush_logs()
+    return 0
+
+
+def supervise(processes, metrics_port=0):
+    """Runs `processes` worker processes, restarting any that exits, until SIGTERM or SIGINT."""
+    from observability import log, flush_logs
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    def spawn(index):
+        command = [sys.executable, os.path.abspath(__file__), "--processes", "1"]
+        if metrics_port:
+            command += ["--metrics-port", str(metrics_port + index)]
+        return subprocess.Popen(command)
+
+    children = [spawn(index) for index in range(processes)]
+    log("info", f"Started {processes} worker process(es).", pids=[child.pid for child in children])
+    while not stopping.wait(1.0):
+        for index, child in enumerate(children):
+            if child.poll() is not None:
+                log("error", f"Worker process {child.pid} exited, restarting it.", exit_code=child.returncode)
+                children[index] = spawn(index)
+
+    for child in children:
+        child.terminate()
+    for child in children:
+        try:
+            child.wait(WORKER_SHUTDOWN_GRACE + 5)
+        except subprocess.TimeoutExpired:
+            child.kill()
+    flush_logs()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run video job workers without the web server.")
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES,
+                        help="worker processes to run (default: $WORKER_PROCESSES or 1)")
+    parser.add_argument("--metrics-port", type=int, default=WORKER_METRICS_PORT,
+                        help="serve /metrics from this port, +1 per extra process (default: off)")
+    args = parser.parse_args(argv)
+    if args.processes > 1:
+        return supervise(args.processes, args.metrics_port)
+    return run_worker(args.metrics_port)
+
+
+if __name__ == "__main__":
+    sys.exit(main())